@@ -0,0 +1,139 @@
+"""
+信頼区間の幅を見ながらシード数を決めるパラメータスイープ
+"""
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from joblib import Parallel, delayed
+
+from .estimators import sample_mean
+from .simulator import Simulator
+from .tracker import Tracker
+
+
+@dataclass
+class AdaptivePointResult:
+    # パラメータ点 (get_simulatorにキーワード引数として渡すもの)
+    point: Dict[str, Any]
+    # 使ったシード
+    seeds: List[int] = field(default_factory=list)
+    # 各シードでの統計量の値 (seedsと同じ順)
+    values: List[float] = field(default_factory=list)
+    # 統計量の平均と信頼区間の半幅
+    mean: float = np.nan
+    half_width: float = np.inf
+    # 目標の精度に達したか
+    converged: bool = False
+
+    def update(self, confidence: float) -> None:
+        """
+        valuesから平均と信頼区間の半幅を計算し直す (estimators.sample_meanのt分布による信頼区間)
+        """
+        if len(self.values) == 0:
+            self.mean, self.half_width = np.nan, np.inf
+            return
+        estimate = sample_mean(self.values, confidence)
+        self.mean = estimate.mean
+        self.half_width = estimate.half_width
+
+
+def _run_and_get_metric(
+    get_simulator: Callable[..., Simulator],
+    seed: int,
+    point: Dict[str, Any],
+    metric: str
+) -> float:
+    """
+    シミュレーションを実行(実行済みなら読み出し)して、Runに記録されたmetricの最終値を返す
+    """
+    sim = get_simulator(seed=seed, **point)
+    sim.run()
+    return sim.tracker.get_latest_metrics(sim.run_id)[metric]
+
+
+def run_adaptive_sweep(
+    points: List[Dict[str, Any]],  # パラメータ点のリスト
+    get_simulator: Callable[..., Simulator],  # get_simulator(seed=seed, **point)でSimulatorを作る関数
+    target_half_width: float,  # 信頼区間の半幅がこれ以下になったらその点は終了
+    metric: str = "state",  # 統計量として使うmetric (Runに記録された最終値)
+    confidence: float = 0.95,  # 信頼区間の信頼度
+    initial_seeds: int = 3,  # 最初のラウンドで使うシード数
+    seeds_per_round: int = 2,  # 2ラウンド目以降に追加するシード数
+    max_seeds: int = 100,  # 1つの点で使うシード数の上限
+    n_jobs: int = 1,  # joblibでの並列数
+    record_exp_name: Optional[str] = None,  # 指定すると各点の結果をこの実験のRunとして記録する
+    record_tracker: Optional[Tracker] = None,  # 各点の結果の記録先 (record_exp_nameと一緒に指定する)
+) -> List[AdaptivePointResult]:
+    """
+    パラメータ点ごとにシードをラウンド単位で追加しながらシミュレーションを実行する
+    統計量の平均の信頼区間の半幅がtarget_half_width以下になった点からシードの追加をやめる
+    分散の小さい点では少ないシードで済むので、全ての点で同じシード数を使うより計算量が減る
+    シードは0から順に使うので、以前のスイープで計算済みのRunはそのまま再利用される
+
+    Returns
+    -------
+    results: List[AdaptivePointResult]
+        pointsと同じ順
+    """
+    if initial_seeds < 2:
+        raise ValueError("initial_seeds should be at least 2 to estimate the variance")
+    if seeds_per_round < 1:
+        raise ValueError("seeds_per_round should be positive")
+    if record_exp_name is not None and record_tracker is None:
+        raise ValueError("record_tracker should be given with record_exp_name")
+
+    results = [AdaptivePointResult(point=point) for point in points]
+    n_seeds = initial_seeds
+    while True:
+        # まだ目標の精度に達していない点について次のラウンドのシードを決める
+        tasks = [
+            (result, seed)
+            for result in results
+            if not result.converged and len(result.seeds) < max_seeds
+            for seed in range(len(result.seeds), min(n_seeds, max_seeds))
+        ]
+        if len(tasks) == 0:
+            break
+        values = Parallel(n_jobs=n_jobs)([
+            delayed(_run_and_get_metric)(get_simulator, seed, result.point, metric)
+            for result, seed in tasks
+        ])
+        for (result, seed), value in zip(tasks, values):
+            result.seeds.append(seed)
+            result.values.append(value)
+        for result in results:
+            result.update(confidence)
+            result.converged = result.half_width <= target_half_width
+        n_seeds += seeds_per_round
+
+    if record_exp_name is not None:
+        _record_results(results, record_tracker, record_exp_name, metric, target_half_width)
+    return results
+
+
+def _record_results(
+    results: List[AdaptivePointResult],
+    tracker: Tracker,
+    exp_name: str,
+    metric: str,
+    target_half_width: float,
+) -> None:
+    """
+    各点の結果(使ったシードと統計量)をRunとして記録する
+    """
+    exp_id = tracker.get_experiment_id(exp_name)
+    for result in results:
+        with tracker.start_run(exp_id) as run_id:
+            tracker.log_params(run_id, {
+                **result.point,
+                "metric": metric,
+                "target_half_width": target_half_width,
+            })
+            tracker.log_metrics(run_id, {
+                "mean": result.mean,
+                "half_width": result.half_width,
+                "n_seeds": len(result.seeds),
+                "converged": float(result.converged),
+            })
+            tracker.set_tags(run_id, {"seeds": ",".join(str(seed) for seed in result.seeds)})
@@ -0,0 +1,154 @@
+"""
+リモートのトラッキングストアから取得したartifactのローカルキャッシュ
+"""
+import fcntl
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Iterator, List, Tuple
+
+
+class ArtifactCache:
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(
+        self,
+        cache_dir: str,  # キャッシュの保存先
+        max_bytes: int = 1 << 30,  # キャッシュ全体の容量の上限 (バイト)
+    ) -> None:
+        """
+        run_idとartifactのパスをキーにしたダウンロード済みartifactのキャッシュ
+
+        容量がmax_bytesを超えると最後に使われた時刻が古いものから削除する(LRU)。
+        書き込みは一時ファイルからのrenameで行い、削除と読み出しはロックファイルで排他するので
+        複数のプロセスから同時に読み出しても壊れたファイルを見ることはない。
+        """
+        if max_bytes < 0:
+            raise ValueError("max_bytes should be nonnegative")
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_path(self, run_id: str, artifact_path: str) -> Path:
+        return self.cache_dir.joinpath(run_id, artifact_path)
+
+    @contextmanager
+    def _lock(self, operation: int) -> Iterator[None]:
+        """
+        キャッシュディレクトリ全体のロックを取る
+        読み出しはLOCK_SH、追加と削除はLOCK_EX
+        """
+        with self.cache_dir.joinpath(".lock").open("a") as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _touch(path: Path) -> None:
+        """
+        最終使用時刻を更新する
+        ファイルシステムの時刻の粒度が粗くても順序が付くようにナノ秒で指定する
+        """
+        now = time.time_ns()
+        os.utime(path, ns=(now, now))
+
+    def _entries(self) -> List[Tuple[float, int, Path]]:
+        """
+        キャッシュ内の全ファイルを(最終使用時刻, サイズ, パス)のリストで返す
+        """
+        entries = []
+        for run_dir in self.cache_dir.iterdir():
+            # ロックファイルとダウンロード途中の一時ディレクトリは除く
+            if run_dir.name.startswith(".") or not run_dir.is_dir():
+                continue
+            for path in run_dir.rglob("*"):
+                if path.is_file():
+                    stat = path.stat()
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict(self, keep: Path) -> None:
+        """
+        容量の上限を超えている分だけ古いものから削除する
+        LOCK_EXを取った状態で呼び出す。直前に追加したkeepは削除しない
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            path.unlink()
+            total -= size
+            # 空になったrun_idのディレクトリも削除しておく
+            try:
+                path.parent.rmdir()
+            except OSError:
+                pass
+
+    def _fetch(self, client, run_id: str, artifact_path: str) -> None:
+        """
+        artifactをダウンロードしてキャッシュに追加する
+        clientはMlflowClientのようにdownload_artifacts(run_id, path, dst_path)を持つもの
+        """
+        entry_path = self._entry_path(run_id, artifact_path)
+        # 同じファイルシステム上の一時ディレクトリにダウンロードしてからrenameする
+        with tempfile.TemporaryDirectory(dir=self.cache_dir, prefix=".download-") as tmp_dir:
+            local_path = client.download_artifacts(run_id, artifact_path, tmp_dir)
+            with self._lock(fcntl.LOCK_EX):
+                entry_path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(local_path, entry_path)
+                self._touch(entry_path)
+                self._evict(keep=entry_path)
+
+    @contextmanager
+    def open(self, client, run_id: str, artifact_path: str) -> Iterator[IO[bytes]]:
+        """
+        キャッシュにあればそれを、なければダウンロードしてからartifactを開く
+
+        Parameters
+        ----------
+        client: MlflowClient
+        run_id: str
+        artifact_path: str
+            artifactのルートからの相対パス
+
+        Returns
+        -------
+        f: IO[bytes]
+        """
+        entry_path = self._entry_path(run_id, artifact_path)
+        fetched = False
+        while True:
+            with self._lock(fcntl.LOCK_SH):
+                if entry_path.exists():
+                    # 開いてしまえば他のプロセスに削除されても読み出せる
+                    f = entry_path.open("rb")
+                    self._touch(entry_path)
+                    break
+            # 他のプロセスに削除された直後なら再度ダウンロードする
+            self.misses += 1
+            fetched = True
+            self._fetch(client, run_id, artifact_path)
+        if not fetched:
+            self.hits += 1
+        with f:
+            yield f
+
+    def clear(self) -> None:
+        """
+        キャッシュを全て削除する
+        """
+        with self._lock(fcntl.LOCK_EX):
+            for path in self.cache_dir.iterdir():
+                if path.is_dir() and not path.name.startswith("."):
+                    shutil.rmtree(path)
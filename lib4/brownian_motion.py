@@ -2,10 +2,14 @@
 ブラウン運動の実装
 """
 from dataclasses import dataclass
-from typing import Optional
+from typing import Any, Dict, List, Optional
 
 import numpy as np
 
+from .retention import TrajectoryRetention, make_retention
+
+DTYPES = ("float64", "float32")
+
 
 @dataclass(frozen=True)
 class ParamBrownianMotion:
@@ -15,6 +19,9 @@ class ParamBrownianMotion:
     initial_state: float
     # ノイズの大きさ(非負実数)
     sigma: float
+    # Trueなら同じシードの乱数の符号を反転させる (antithetic variates)
+    #   同じシードでFalseの軌跡と初期状態について対称な軌跡になる
+    antithetic: bool = False
 
     def __post_init__(self):
         # 負の値の場合にエラーを出す
@@ -24,13 +31,18 @@ class ParamBrownianMotion:
 
 class BrownianMotion:
     state: float
-    state_trajectory: np.ndarray = np.array([])
+    retention: Optional[TrajectoryRetention] = None
+    # step()で使う乱数をまとめて生成しておく数
+    noise_buffer_size: int = 4096
 
     def __init__(
         self,
         param: ParamBrownianMotion,
         save_full_trajectory: bool = False,
-        total_step: Optional[int] = None
+        total_step: Optional[int] = None,
+        retention: str = "full",
+        retention_size: int = 0,
+        dtype: str = "float64"
     ) -> None:
         """
         ブラウン運動
@@ -39,33 +51,105 @@ class BrownianMotion:
         ----------
         param: ParamBrownianMotion
         save_full_trajectory: bool
-            numpy配列として状態の軌跡全てを保持しておく
+            numpy配列として状態の軌跡を保持しておく
         total_step: int (optional)
             save_full_trajectoryがTrueのときは必ず指定する
+        retention: str
+            save_full_trajectoryがTrueのときに軌跡のどのステップを保持するか
+            full(全て), last(最後のretention_sizeステップ), every(retention_sizeステップおき),
+            log(対数間隔でretention_size点) のいずれか
+        retention_size: int
+            retentionがfull以外のときに指定する
+        dtype: str
+            状態と状態軌跡の型 (float64かfloat32)
+            float32のときも乱数はfloat64で生成し、増分をfloat32に丸めてからfloat32で足していく
+            そのため同じシードのfloat64の軌跡との差は各ステップの丸め誤差の和で抑えられる
+            (float32_error_bound()を参照)
         """
+        if dtype not in DTYPES:
+            raise ValueError(f"dtype should be one of {DTYPES}")
+        self.dtype = np.dtype(dtype)
         self.initial_state = param.initial_state
         self.sigma = param.sigma
+        self.antithetic = param.antithetic
+        # 乱数に掛ける係数 (符号の反転はsigmaに含めておく)
+        self.noise_scale = -self.sigma if self.antithetic else self.sigma
         self.rng = np.random.default_rng(param.seed)
+        # step()で使う乱数のバッファ (まとめて生成したものを先頭から順に使う)
+        #   rng.normal()をn回呼んだ場合とrng.normal(size=n)は同じ乱数列になる
+        #   バッファに残っている乱数はstep()でもsteps()でも先に使う
+        self._noise_buffer: List[float] = []
+        self._noise_position = 0
+        # バッファを生成する直前の乱数生成器の状態 (get_rng_state()で使う)
+        self._noise_buffer_rng_state: Optional[Dict[str, Any]] = None
         self.state = self.initial_state
+        if self.dtype != np.float64:
+            self.state = self.dtype.type(self.initial_state)
         self.save_full_trajectory = save_full_trajectory
 
         if save_full_trajectory:
             if total_step is None:
                 raise ValueError("Please set total_step when save_full_trajectory is True")
-            # 状態軌跡を保存するnumpy配列の作成と初期化 (長さはtotal_stepに初期状態の分+1)
-            self.state_trajectory = np.empty(total_step + 1)
+            # 状態軌跡を保存する領域の作成と初期化
+            self.retention = make_retention(retention, total_step, retention_size, dtype)
             self.count = 0
             self._save_state()
 
+    @property
+    def state_trajectory(self) -> np.ndarray:
+        """
+        保持している状態軌跡 (retention="full"なら初期状態からの全ステップ)
+        """
+        if self.retention is None:
+            return np.array([], dtype=self.dtype)
+        return self.retention.values()
+
+    @property
+    def state_trajectory_steps(self) -> np.ndarray:
+        """
+        state_trajectoryの各要素が何ステップ目の状態か
+        """
+        if self.retention is None:
+            return np.array([], dtype=int)
+        return self.retention.steps()
+
     def _save_state(self) -> None:
         """
         状態が更新されたときに呼び出す。状態軌跡に情報を書き込む
         """
         if self.save_full_trajectory:
-            self.state_trajectory[self.count] = self.state
+            self.retention.save_state(self.count, self.state)
             self.count += 1
+
+    def save_states(self, states: np.ndarray) -> None:
+        """
+        連続したステップの状態をまとめて状態軌跡に書き込む
+        """
+        if self.save_full_trajectory:
+            self.retention.save(self.count, states)
+            self.count += len(states)
         return
 
+    def _fill_noise_buffer(self) -> None:
+        """
+        バッファを使い切ったときにnoise_buffer_size個の乱数をまとめて生成し直す
+        """
+        self._noise_buffer_rng_state = self.rng.bit_generator.state
+        # リストにしておくとnumpyのスカラーより要素の取り出しと計算が速い
+        self._noise_buffer = self.rng.normal(size=self.noise_buffer_size).tolist()
+        self._noise_position = 0
+
+    def _take_noise(self, n: int) -> np.ndarray:
+        """
+        n個の乱数を、バッファに残っているものから順に使って返す
+        """
+        n_buffered = min(n, len(self._noise_buffer) - self._noise_position)
+        if n_buffered == 0:
+            return self.rng.normal(size=n)
+        buffered = self._noise_buffer[self._noise_position:self._noise_position + n_buffered]
+        self._noise_position += n_buffered
+        return np.concatenate([buffered, self.rng.normal(size=n - n_buffered)])
+
     def step(self) -> float:
         """
         1stepの時間発展を実行して次の状態を返す
@@ -74,6 +158,116 @@ class BrownianMotion:
         -------
         next_state: float
         """
-        self.state += self.sigma * self.rng.normal()
-        self._save_state()
+        # 1ステップごとに呼ばれるのでメソッド呼び出しを減らしておく
+        if self._noise_position == len(self._noise_buffer):
+            self._fill_noise_buffer()
+        noise = self._noise_buffer[self._noise_position]
+        self._noise_position += 1
+        if self.dtype == np.float64:
+            self.state += self.noise_scale * noise
+        else:
+            self.state += self.dtype.type(self.noise_scale * noise)
+        if self.save_full_trajectory:
+            self.retention.save_state(self.count, self.state)
+            self.count += 1
         return self.state
+
+    def steps(self, n_step: int, save: bool = True) -> np.ndarray:
+        """
+        n_stepステップの時間発展をまとめて実行する
+        乱数列と加算の順序はstep()をn_step回呼んだ場合と同じなので結果はビット単位で一致する
+
+        Parameters
+        ----------
+        n_step: int
+        save: bool
+            Falseなら状態軌跡に書き込まない
+            途中で打ち切る場合などに、呼び出し側で必要な分だけsave_states()する
+
+        Returns
+        -------
+        states: np.ndarray (n_step, ) float
+            各ステップ後の状態
+        """
+        increments = (self.noise_scale * self._take_noise(n_step)).astype(self.dtype, copy=False)
+        # cumsumは先頭から順に足していくので逐次更新と同じ丸め誤差になる
+        states = np.cumsum(
+            np.concatenate([np.array([self.state], dtype=self.dtype), increments]),
+            dtype=self.dtype,
+        )[1:]
+        if n_step > 0:
+            self.state = states[-1]
+        if save:
+            self.save_states(states)
+        return states
+
+    def get_rng_state(self) -> Dict[str, Any]:
+        """
+        乱数生成器の現在の状態を取得する (JSONに変換できる辞書)
+        バッファに使っていない乱数が残っていれば、バッファを生成する直前の状態から
+        使った数だけ進めた状態 (バッファを使わずに1つずつ生成した場合の状態) を返す
+        """
+        if self._noise_position == len(self._noise_buffer):
+            return self.rng.bit_generator.state
+        bit_generator = type(self.rng.bit_generator)()
+        bit_generator.state = self._noise_buffer_rng_state
+        np.random.Generator(bit_generator).normal(size=self._noise_position)
+        return bit_generator.state
+
+    def restore(
+        self,
+        state: float,
+        rng_state: Dict[str, Any],
+        state_trajectory: Optional[np.ndarray] = None
+    ) -> None:
+        """
+        途中まで時間発展した状態を復元する
+
+        Parameters
+        ----------
+        state: float
+            復元する時点での状態
+        rng_state: dict
+            復元する時点でget_rng_state()が返した値
+        state_trajectory: np.ndarray (optional)
+            初期状態から復元する時点までの状態軌跡
+            save_full_trajectoryがTrueのときは必ず指定する
+        """
+        if self.save_full_trajectory:
+            if state_trajectory is None:
+                raise ValueError("Please set state_trajectory when save_full_trajectory is True")
+            self.count = 0
+            self.save_states(state_trajectory)
+        self.state = state
+        if self.dtype != np.float64:
+            self.state = self.dtype.type(state)
+        self.rng.bit_generator.state = rng_state
+        self._noise_buffer = []
+        self._noise_position = 0
+
+
+def float32_error_bound(state_trajectory: np.ndarray) -> np.ndarray:
+    """
+    float64で計算した状態軌跡から、同じシードでdtype="float32"として計算した状態軌跡の
+    各ステップでの誤差の上限を計算する
+
+    float32では初期状態の丸めと、各ステップでの増分Δの丸めと加算の丸めで
+    それぞれ高々u|Δ|, u|x|の誤差(u=2^-24)が入り、それらが足し合わされていく。
+    したがってkステップ目の誤差は u(|x_0| + Σ_{j<=k} (|Δ_j| + |x_j|)) で抑えられる。
+    float64自体の丸め誤差と2次の項の分として1%の余裕をもたせる。
+
+    Parameters
+    ----------
+    state_trajectory: np.ndarray (total_step + 1, ) float64
+        float64で計算した初期状態からの全ステップの状態軌跡
+
+    Returns
+    -------
+    error_bound: np.ndarray (total_step + 1, ) float64
+        |x^{float32}_k - x^{float64}_k| の上限
+    """
+    u = np.finfo(np.float32).eps / 2
+    abs_states = np.abs(state_trajectory)
+    abs_increments = np.abs(np.diff(state_trajectory))
+    accumulated = np.concatenate([[0.], np.cumsum(abs_increments + abs_states[1:])])
+    return 1.01 * u * (abs_states[0] + accumulated)
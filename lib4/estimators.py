@@ -0,0 +1,198 @@
+"""
+複数のRunの結果から期待値を推定する (分散減少法)
+"""
+from dataclasses import dataclass
+from typing import List, Sequence
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+# Runの結果のDataFrameの列名 (mlflow.search_runs()やExperimentSummaryと同じ)
+INITIAL_STATE_COLUMN = "params.param_bm.initial_state"
+SIGMA_COLUMN = "params.param_bm.sigma"
+SEED_COLUMN = "params.param_bm.seed"
+ANTITHETIC_COLUMN = "params.param_bm.antithetic"
+TOTAL_STEP_COLUMN = "params.total_step"
+RECORD_PER_COLUMN = "params.record_per"
+RECORD_SCHEDULE_COLUMN = "params.record_schedule"
+STATE_COLUMN = "metrics.state"
+STOPPING_TIME_COLUMN = "metrics.stopping_time"
+# aggregate_runs()で追加する制御変量の列 (squared_displacement_control()を参照)
+CONTROL_COLUMN = "control.squared_displacement"
+
+
+@dataclass(frozen=True)
+class Estimate:
+    # 期待値の推定値
+    mean: float
+    # 信頼区間の半幅
+    half_width: float
+    # 推定に使った独立なサンプルの数
+    n_samples: int
+
+
+def _half_width(std: float, n_samples: int, confidence: float) -> float:
+    if n_samples < 2:
+        return np.inf
+    return float(stats.t.ppf((1 + confidence) / 2, df=n_samples - 1) * std / np.sqrt(n_samples))
+
+
+def sample_mean(values: Sequence[float], confidence: float = 0.95) -> Estimate:
+    """
+    単純な標本平均とt分布による信頼区間
+    """
+    values = np.asarray(values, dtype=float)
+    std = values.std(ddof=1) if len(values) > 1 else np.nan
+    return Estimate(float(values.mean()), _half_width(std, len(values), confidence), len(values))
+
+
+def control_variate_mean(
+    values: Sequence[float],
+    controls: Sequence[float],
+    control_mean: float,
+    confidence: float = 0.95
+) -> Estimate:
+    """
+    期待値が既知の量(制御変量)との相関を使って期待値を推定する
+
+    E[Y]の推定値 = mean(Y) - beta (mean(C) - E[C]),  beta = Cov(Y, C) / Var(C)
+    YとCの相関が強いほど分散が小さくなる
+
+    Parameters
+    ----------
+    values: 推定したい量Yのサンプル
+    controls: 同じサンプルでの制御変量C
+    control_mean: 制御変量の期待値E[C] (解析的にわかっているもの)
+    confidence: 信頼区間の信頼度
+    """
+    values = np.asarray(values, dtype=float)
+    controls = np.asarray(controls, dtype=float)
+    n_samples = len(values)
+    if n_samples < 3:
+        return sample_mean(values, confidence)
+    control_variance = controls.var(ddof=1)
+    if control_variance > 0:
+        beta = np.cov(values, controls, ddof=1)[0, 1] / control_variance
+    else:
+        # 制御変量が定数の場合は補正できない
+        beta = 0.
+    adjusted = values - beta * (controls - control_mean)
+    # betaを推定した分だけ自由度が1つ減る
+    std = adjusted.std(ddof=2)
+    return Estimate(
+        float(adjusted.mean()),
+        _half_width(std, n_samples - 1, confidence),
+        n_samples,
+    )
+
+
+def get_state_steps(df_result: pd.DataFrame) -> np.ndarray:
+    """
+    各Runのmetrics.state(最後に記録された状態)が何ステップ目の状態か
+    停止したRunは停止時刻、そうでなければrecord_scheduleで最後に記録したステップ
+    (every: total_step以下で最後のrecord_per-1, 2 record_per-1, ..., それ以外: total_step)
+    """
+    total_steps = df_result[TOTAL_STEP_COLUMN].apply(int).to_numpy()
+    record_per = df_result[RECORD_PER_COLUMN].apply(int).to_numpy()
+    # 記録するステップがなければstep=0の初期状態
+    steps = np.maximum(total_steps - (total_steps - record_per + 1) % record_per, 0)
+    if RECORD_SCHEDULE_COLUMN in df_result.columns:
+        # パラメータを追加する前のRunはevery
+        schedules = df_result[RECORD_SCHEDULE_COLUMN].fillna("every").replace("", "every")
+        steps = np.where(schedules == "every", steps, total_steps)
+    if STOPPING_TIME_COLUMN in df_result.columns:
+        stopping_times = df_result[STOPPING_TIME_COLUMN].to_numpy(dtype=float)
+        steps = np.where(np.isnan(stopping_times), steps, stopping_times)
+    return steps.astype(float)
+
+
+def squared_displacement_control(df_result: pd.DataFrame) -> np.ndarray:
+    """
+    各Runの制御変量 C = (X_s - x_0)^2 - sigma^2 s  (sはget_state_steps()のステップ)
+
+    M_k = (X_k - x_0)^2 - sigma^2 k はマルチンゲールで、sは停止時刻かtotal_step以下の定数なので
+    任意抽出定理からE[C] = 0 になる。停止時刻や停止するまでの状態の関数と相関するので
+    初到達時刻(metrics.stopping_time)などの期待値の推定で分散を減らせる。
+    """
+    displacements = df_result[STATE_COLUMN].to_numpy(dtype=float) - \
+        df_result[INITIAL_STATE_COLUMN].to_numpy(dtype=float)
+    sigmas = df_result[SIGMA_COLUMN].to_numpy(dtype=float)
+    return displacements ** 2 - sigmas ** 2 * get_state_steps(df_result)
+
+
+def _pair_antithetic_runs(df_group: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+    """
+    同じシードのantithetic=True/Falseの組を1つのサンプルとして平均する
+    組になっていないRunはそのまま1つのサンプルとして使う
+    """
+    if ANTITHETIC_COLUMN not in df_group.columns:
+        return df_group[columns]
+    return df_group.groupby(SEED_COLUMN)[columns].mean()
+
+
+def aggregate_runs(
+    df_result: pd.DataFrame,
+    value_column: str = STATE_COLUMN,
+    group_columns: Sequence[str] = (SIGMA_COLUMN, INITIAL_STATE_COLUMN),
+    control_variate: bool = False,
+    confidence: float = 0.95,
+) -> pd.DataFrame:
+    """
+    パラメータごとに複数のRunの結果を集計して期待値を推定する
+
+    antithetic=Trueのシードが含まれていれば、同じシードのantithetic=False/Trueの組の平均を
+    1つのサンプルとして扱う。control_variate=Trueなら、最後に記録された状態の初期状態からの
+    変位の2乗から期待値sigma^2 sを引いたもの(squared_displacement_control())を
+    期待値0の制御変量として使う。
+
+    Parameters
+    ----------
+    df_result: pd.DataFrame
+        mlflow.search_runs()やExperimentSummary.load()の結果 (パラメータは文字列でもよい)
+    value_column: str
+        期待値を推定する列
+    group_columns: Sequence[str]
+        この列の値ごとに推定する
+    control_variate: bool
+        制御変量を使うか
+        (df_resultにparams.total_step, params.record_perと、停止したRunがあればmetrics.stopping_timeが必要)
+    confidence: float
+        信頼区間の信頼度
+
+    Returns
+    -------
+    df_estimate: pd.DataFrame
+        group_columnsをindexとして mean, half_width, n_runs, n_samples の列をもつ
+    """
+    if control_variate and value_column == CONTROL_COLUMN:
+        # 制御変量自身の推定値は仮定した期待値そのものになってしまう
+        raise ValueError(f"value_column should be different from the control {CONTROL_COLUMN}")
+    df_result = df_result.copy()
+    numeric_columns = [INITIAL_STATE_COLUMN, SIGMA_COLUMN, SEED_COLUMN, value_column, STATE_COLUMN]
+    for column in numeric_columns:
+        if column in df_result.columns:
+            df_result[column] = df_result[column].apply(float)
+    columns = [value_column]
+    if control_variate:
+        df_result[CONTROL_COLUMN] = squared_displacement_control(df_result)
+        columns.append(CONTROL_COLUMN)
+
+    keys = []
+    rows = []
+    for key, df_group in df_result.groupby(list(group_columns)):
+        samples = _pair_antithetic_runs(df_group, columns)
+        if control_variate:
+            estimate = control_variate_mean(
+                samples[value_column], samples[CONTROL_COLUMN], 0., confidence)
+        else:
+            estimate = sample_mean(samples[value_column], confidence)
+        keys.append(key if isinstance(key, tuple) else (key,))
+        rows.append({
+            "mean": estimate.mean,
+            "half_width": estimate.half_width,
+            "n_runs": len(df_group),
+            "n_samples": estimate.n_samples,
+        })
+    index = pd.MultiIndex.from_tuples(keys, names=list(group_columns))
+    return pd.DataFrame(rows, index=index)
@@ -0,0 +1,87 @@
+"""
+状態軌跡のフィンガープリント
+"""
+import hashlib
+from typing import Dict, Optional, Set
+
+import numpy as np
+
+# チャンクの数の上限とタグに記録するチャンクのダイジェストの長さ
+#   mlflowのタグの値は5000文字までなので 256 * (16 + 1) - 1 = 4351 文字に収める
+MAX_CHUNKS = 256
+CHUNK_DIGEST_LENGTH = 16
+# Runのタグの名前
+DIGEST_TAG = "trajectory_sha256"
+CHUNK_SIZE_TAG = "trajectory_chunk_size"
+CHUNK_DIGESTS_TAG = "trajectory_chunks"
+
+
+def get_chunk_size(total_step: int) -> int:
+    """
+    初期状態を含めたtotal_step+1個の状態をMAX_CHUNKS個以下のチャンクに分けるときの1チャンクの状態の数
+    """
+    return max(-(-(total_step + 1) // MAX_CHUNKS), 1)
+
+
+class TrajectoryFingerprint:
+    def __init__(self, total_step: int, chunks: Optional[Set[int]] = None) -> None:
+        """
+        step=0から順番に渡された状態のバイト列(リトルエンディアン)のsha256と、
+        get_chunk_size(total_step)個ずつに分けたチャンクごとのsha256を計算する
+
+        Parameters
+        ----------
+        total_step: int
+        chunks: Set[int] (optional)
+            指定するとこのチャンクのダイジェストだけを計算する (全体のダイジェストは計算しない)
+        """
+        self.chunk_size = get_chunk_size(total_step)
+        self.chunks = chunks
+        self.hasher = hashlib.sha256() if chunks is None else None
+        self.chunk_digests: Dict[int, str] = {}
+        self.count = 0
+        self._chunk_hasher = hashlib.sha256()
+
+    def update(self, states: np.ndarray) -> None:
+        """
+        続きのステップの状態を渡す
+        """
+        states = states.astype(states.dtype.newbyteorder("<"), copy=False)
+        if self.hasher is not None:
+            self.hasher.update(states.tobytes())
+        start = 0
+        while start < len(states):
+            chunk = (self.count + start) // self.chunk_size
+            end = min((chunk + 1) * self.chunk_size - self.count, len(states))
+            if self.chunks is None or chunk in self.chunks:
+                self._chunk_hasher.update(states[start:end].tobytes())
+            if (self.count + end) % self.chunk_size == 0:
+                self._finish_chunk(chunk)
+            start = end
+        self.count += len(states)
+
+    def _finish_chunk(self, chunk: int) -> None:
+        if self.chunks is None or chunk in self.chunks:
+            self.chunk_digests[chunk] = self._chunk_hasher.hexdigest()[:CHUNK_DIGEST_LENGTH]
+        self._chunk_hasher = hashlib.sha256()
+
+    def finalize(self) -> None:
+        """
+        最後の途中までのチャンクのダイジェストを確定する (最後に1回だけ呼ぶ)
+        """
+        if self.count % self.chunk_size != 0:
+            self._finish_chunk(self.count // self.chunk_size)
+
+    def hexdigest(self) -> str:
+        return self.hasher.hexdigest()
+
+    def get_tags(self) -> Dict[str, str]:
+        """
+        Runのタグとして記録する辞書 (finalize()の後に呼ぶ)
+        """
+        return {
+            DIGEST_TAG: self.hexdigest(),
+            CHUNK_SIZE_TAG: str(self.chunk_size),
+            CHUNK_DIGESTS_TAG: ",".join(
+                self.chunk_digests[chunk] for chunk in range(len(self.chunk_digests))),
+        }
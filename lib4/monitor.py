@@ -0,0 +1,296 @@
+"""
+パラメータスイープの進捗とスループットの監視
+"""
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from .simulator import Simulator
+from .tracker import Tracker
+
+# started: 計算開始, finished: 計算終了, cached: 計算済みの結果があったので何もしない, failed: 例外で終了
+EVENT_KINDS = ("started", "finished", "cached", "failed")
+
+
+class SweepEventLog:
+    def __init__(self, path: str) -> None:
+        """
+        各Runの開始・終了などのイベントを1行1つのJSONとして追記するファイル
+
+        O_APPENDで開いて1行を1回のwriteで書くので、複数のプロセスやホストから
+        同時に追記しても行が混ざらない。
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+
+    def emit(self, kind: str, key: str, n_step: int = 0, elapsed: float = 0.) -> None:
+        """
+        イベントを1つ追記する
+
+        Parameters
+        ----------
+        kind: str
+            EVENT_KINDSのどれか
+        key: str
+            パラメータを区別するキー (work_queue.get_param_keyなど)
+        n_step: int
+            finishedのときに実際に計算したステップ数
+        elapsed: float
+            finishedとfailedのときにかかった秒数
+        """
+        if kind not in EVENT_KINDS:
+            raise ValueError(f"kind should be one of {EVENT_KINDS}")
+        event = {
+            "time": time.time(),
+            "kind": kind,
+            "key": key,
+            "worker": self.worker_id,
+            "n_step": n_step,
+            "elapsed": elapsed,
+        }
+        line = (json.dumps(event) + "\n").encode()
+        fd = os.open(str(self.path), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def read(self) -> List[Dict[str, Any]]:
+        """
+        これまでのイベントを書き込まれた順に返す
+        書き込み途中の最後の行は読み飛ばす
+        """
+        if not self.path.exists():
+            return []
+        events = []
+        with self.path.open() as f:
+            for line in f:
+                if line.endswith("\n"):
+                    events.append(json.loads(line))
+        return events
+
+    def clear(self) -> None:
+        """
+        新しいスイープを始める前に以前のイベントを削除する
+        """
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def run_monitored(
+    sim: Simulator,
+    event_log: SweepEventLog,
+    key: str,
+    before_finish: Optional[Callable[[], None]] = None,
+) -> None:
+    """
+    sim.run()を実行して、その開始と結果をevent_logに記録する
+    計算済みの結果がある場合はcachedだけを記録する
+    before_finishはsim.run()にそのまま渡す
+    """
+    if sim.done:
+        event_log.emit("cached", key)
+        return
+    event_log.emit("started", key)
+    start = time.time()
+    try:
+        sim.run(before_finish=before_finish)
+    except BaseException:
+        event_log.emit("failed", key, elapsed=time.time() - start)
+        raise
+    event_log.emit("finished", key, n_step=sim.n_computed_step, elapsed=time.time() - start)
+
+
+@dataclass(frozen=True)
+class SweepProgress:
+    # スイープ全体のパラメータの数
+    n_total: int
+    # 計算が終わった数
+    n_finished: int
+    # 計算済みの結果があったので計算しなかった数
+    n_cached: int
+    # 計算中の数
+    n_running: int
+    # 例外で終了した数
+    n_failed: int
+    # まだ終わっていない数 (計算中を含み、失敗したものは含まない)
+    n_remaining: int
+    # いずれかのワーカーが動いていた秒数 (中断して再開するまでの間は含まない)
+    elapsed: float
+    # 計算が終わったRunの数と計算したステップ数の毎秒の値
+    runs_per_sec: float
+    steps_per_sec: float
+    # 残りが終わるまでの見積もり秒数 (まだ1つも終わっていなければinf)
+    eta: float
+
+    @property
+    def complete(self) -> bool:
+        return self.n_remaining == 0
+
+    def __str__(self) -> str:
+        n_done = self.n_finished + self.n_cached
+        return (
+            f"{n_done}/{self.n_total} done ({self.n_cached} cached), "
+            f"{self.n_running} running, {self.n_failed} failed, {self.n_remaining} remaining | "
+            f"{self.runs_per_sec:.2f} runs/s, {self.steps_per_sec:.3g} steps/s, "
+            f"ETA {self.eta:.0f}s"
+        )
+
+
+def summarize_events(
+    events: List[Dict[str, Any]],
+    n_total: int,
+    now: Optional[float] = None
+) -> SweepProgress:
+    """
+    イベントの列からスイープの進捗を集計する
+    同じキーのイベントが複数あれば最後のものでそのキーの状態を決める (失敗後の再実行など)
+    スループットはワーカーが動いていた時間で割るので、中断して再開したスイープでも
+    止まっていた間は含まない
+
+    Parameters
+    ----------
+    events: List[Dict[str, Any]]
+        SweepEventLog.read()の結果
+    n_total: int
+        スイープ全体のパラメータの数
+    now: float (optional)
+        経過時間の基準にする時刻。省略すると現在時刻 (全て終わっていれば最後のイベントの時刻)
+
+    Returns
+    -------
+    progress: SweepProgress
+    """
+    states: Dict[str, str] = {}
+    n_step = 0
+    for event in events:
+        states[event["key"]] = event["kind"]
+        if event["kind"] == "finished":
+            n_step += event["n_step"]
+    counts = {kind: 0 for kind in EVENT_KINDS}
+    for kind in states.values():
+        counts[kind] += 1
+    n_remaining = max(n_total - counts["finished"] - counts["cached"] - counts["failed"], 0)
+
+    if len(events) == 0:
+        elapsed = 0.
+    else:
+        if now is None:
+            now = events[-1]["time"] if n_remaining == 0 else time.time()
+        elapsed = _active_seconds(events, now)
+    runs_per_sec = counts["finished"] / elapsed if elapsed > 0 else 0.
+    steps_per_sec = n_step / elapsed if elapsed > 0 else 0.
+    if n_remaining == 0:
+        eta = 0.
+    elif runs_per_sec > 0:
+        eta = n_remaining / runs_per_sec
+    else:
+        eta = float("inf")
+    return SweepProgress(
+        n_total=n_total,
+        n_finished=counts["finished"],
+        n_cached=counts["cached"],
+        n_running=counts["started"],
+        n_failed=counts["failed"],
+        n_remaining=n_remaining,
+        elapsed=elapsed,
+        runs_per_sec=runs_per_sec,
+        steps_per_sec=steps_per_sec,
+        eta=eta,
+    )
+
+
+def _active_seconds(events: List[Dict[str, Any]], now: float) -> float:
+    """
+    いずれかのワーカーが動いていた秒数
+    各ワーカーは最初のイベントから最後のイベントまで動いていたとみなして、その区間の和集合の長さを返す
+    どのワーカーの区間にも入らない時間は中断していたとみなす
+    最後の区間は(まだ動いているとみなして)nowまで延ばす
+    """
+    spans: Dict[str, List[float]] = {}
+    for event in events:
+        span = spans.setdefault(event["worker"], [event["time"], event["time"]])
+        span[0] = min(span[0], event["time"])
+        span[1] = max(span[1], event["time"])
+    total = 0.
+    intervals = sorted(spans.values())
+    start, end = intervals[0]
+    for next_start, next_end in intervals[1:]:
+        if next_start > end:
+            total += end - start
+            start = next_start
+        end = max(end, next_end)
+    return total + max(end, now) - start
+
+
+class SweepMonitor:
+    def __init__(
+        self,
+        event_log: SweepEventLog,  # ワーカーがイベントを書き込むファイル
+        n_total: int,  # スイープ全体のパラメータの数
+        interval: float = 5.,  # with文の中で進捗を表示する間隔 (秒)
+    ) -> None:
+        """
+        ワーカーが書き込んだイベントからスイープの進捗を集計する
+        with文の中にいる間はバックグラウンドのスレッドでinterval秒ごとに進捗を表示する
+        """
+        self.event_log = event_log
+        self.n_total = n_total
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def progress(self) -> SweepProgress:
+        return summarize_events(self.event_log.read(), self.n_total)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            print(self.progress())
+
+    def __enter__(self) -> "SweepMonitor":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self._stop.set()
+        self._thread.join()
+        print(self.progress())
+
+    def write_report(
+        self,
+        tracker: Tracker,
+        exp_name: str,  # レポートを記録する実験の名前
+        params: Optional[Dict[str, Any]] = None,  # スイープの設定など一緒に記録するパラメータ
+    ) -> str:
+        """
+        スイープの最終的な集計をRunとして記録する
+        集計値をmetricとして、イベントのファイルをartifactとして保存する
+
+        Returns
+        -------
+        run_id: str
+        """
+        progress = self.progress()
+        metrics = asdict(progress)
+        metrics.pop("n_total")
+        exp_id = tracker.get_experiment_id(exp_name)
+        with tracker.start_run(exp_id) as run_id:
+            tracker.log_params(run_id, {"n_total": self.n_total, **(params or {})})
+            tracker.log_metrics(run_id, metrics)
+            tracker.set_tags(run_id, {"complete": progress.complete})
+            if self.event_log.path.exists():
+                # 書き込み中のファイルを直接渡さずにコピーしてから保存する
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    tmp_path = Path(tmp_dir).joinpath("sweep_events.jsonl")
+                    tmp_path.write_bytes(self.event_log.path.read_bytes())
+                    tracker.log_artifact(run_id, str(tmp_path))
+        return run_id
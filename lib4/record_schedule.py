@@ -0,0 +1,193 @@
+"""
+状態をmetricとして記録するステップの決め方
+"""
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+RECORD_SCHEDULES = ("every", "log", "cap", "change")
+
+
+class RecordSchedule(ABC):
+    def __init__(self, total_step: int) -> None:
+        """
+        時間発展したブロックごとに、そのうちどのステップの状態をmetricとして記録するかを決める
+        select()には連続したステップのブロックをstep=1から順番に渡す (step=0は常に記録する)
+
+        Parameters
+        ----------
+        total_step: int
+            時間発展の総ステップ数
+        """
+        self.total_step = total_step
+
+    @abstractmethod
+    def select(self, steps: np.ndarray, states: np.ndarray) -> np.ndarray:
+        """
+        ブロックのうち記録するもののインデックス (昇順)
+
+        Parameters
+        ----------
+        steps: np.ndarray (n, ) int
+            連続したステップ
+        states: np.ndarray (n, ) float
+            各ステップの状態
+
+        Returns
+        -------
+        indices: np.ndarray int
+        """
+
+    @abstractmethod
+    def describe(self) -> str:
+        """
+        Runのタグに記録する説明
+        """
+
+
+class StrideSchedule(RecordSchedule):
+    def __init__(self, total_step: int, record_per: int) -> None:
+        """
+        record_perステップおきに記録する (record_per-1, 2 record_per-1, ...)
+        """
+        super().__init__(total_step)
+        self.record_per = record_per
+
+    def select(self, steps: np.ndarray, states: np.ndarray) -> np.ndarray:
+        return np.flatnonzero(steps % self.record_per == self.record_per - 1)
+
+    def describe(self) -> str:
+        return f"every:{self.record_per}"
+
+
+class CappedSchedule(RecordSchedule):
+    def __init__(self, total_step: int, max_points: int) -> None:
+        """
+        記録する点の数がmax_points以下になるように間隔を決めて、その倍数のステップと最後のステップを記録する
+        点の数は常に記録するstep=0も含めて数えるので、max_pointsは2以上にする
+        """
+        super().__init__(total_step)
+        if max_points < 2:
+            raise ValueError("max_points should be at least 2")
+        self.max_points = max_points
+        #   step=0, strideの倍数, 最後のステップで 1 + ceil(total_step / stride) 点になる
+        self.stride = max(-(-total_step // (max_points - 1)), 1)
+
+    def select(self, steps: np.ndarray, states: np.ndarray) -> np.ndarray:
+        return np.flatnonzero((steps % self.stride == 0) | (steps == self.total_step))
+
+    def describe(self) -> str:
+        return f"cap:{self.max_points}(stride={self.stride})"
+
+
+class LogSpacedSchedule(RecordSchedule):
+    def __init__(self, total_step: int, n_point: int) -> None:
+        """
+        1からtotal_stepまで対数間隔に並べたn_point個のステップを記録する
+        間隔が1より細かくなるところは重複を除くので、記録する点の数はn_point以下になる
+        """
+        super().__init__(total_step)
+        self.n_point = n_point
+        log_steps = np.round(np.geomspace(1, max(total_step, 1), n_point)).astype(int)
+        self.target_steps = np.unique(log_steps)
+        self.target_steps = self.target_steps[self.target_steps <= total_step]
+
+    def select(self, steps: np.ndarray, states: np.ndarray) -> np.ndarray:
+        if len(steps) == 0:
+            return np.array([], dtype=int)
+        start, end = np.searchsorted(self.target_steps, [steps[0], steps[-1] + 1])
+        return self.target_steps[start:end] - steps[0]
+
+    def describe(self) -> str:
+        return f"log:{self.n_point}"
+
+
+class ChangeSchedule(RecordSchedule):
+    # 変化したステップを探すときの最初の窓の幅
+    initial_window: int = 64
+
+    def __init__(self, total_step: int, tolerance: float, initial_state: float) -> None:
+        """
+        最後に記録した状態からtoleranceより大きく変化したステップと、最後のステップを記録する
+        """
+        super().__init__(total_step)
+        self.tolerance = tolerance
+        self.last_value = initial_state
+
+    def _find_change(self, states: np.ndarray, start: int) -> int:
+        """
+        states[start:]のうち最初にlast_valueから変化したインデックス (なければlen(states))
+        変化するまでの長さに比例する計算量で済むように窓の幅を倍々に広げながら探す
+        """
+        window = self.initial_window
+        while start < len(states):
+            end = min(start + window, len(states))
+            moved = np.abs(states[start:end] - self.last_value) > self.tolerance
+            if moved.any():
+                return start + int(np.argmax(moved))
+            start = end
+            window *= 2
+        return len(states)
+
+    def select(self, steps: np.ndarray, states: np.ndarray) -> np.ndarray:
+        indices = []
+        index = self._find_change(states, 0)
+        while index < len(states):
+            indices.append(index)
+            self.last_value = states[index]
+            index = self._find_change(states, index + 1)
+        if len(steps) > 0 and steps[-1] == self.total_step \
+                and (len(indices) == 0 or indices[-1] != len(steps) - 1):
+            indices.append(len(steps) - 1)
+        return np.array(indices, dtype=int)
+
+    def describe(self) -> str:
+        return f"change:{self.tolerance!r}"
+
+
+def make_record_schedule(
+    mode: str,
+    total_step: int,
+    record_per: int = 10,
+    points: int = 0,
+    tolerance: float = 0.,
+    initial_state: float = 0.,
+) -> RecordSchedule:
+    """
+    記録方法の名前からRecordScheduleを作る
+
+    Parameters
+    ----------
+    mode: str
+        every: record_perステップおき
+        log: 対数間隔でpoints点
+        cap: points点以下になるように間隔を自動で決める
+        change: toleranceより大きく変化したときだけ
+    total_step: int
+    record_per: int
+    points: int
+        mode="log"では正の整数、mode="cap"ではstep=0を含めた点の数として2以上の整数を指定する
+    tolerance: float
+        mode="change"では正の数を指定する
+    initial_state: float
+        mode="change"で最初に比べる状態 (step=0の状態)
+
+    Returns
+    -------
+    schedule: RecordSchedule
+    """
+    if mode not in RECORD_SCHEDULES:
+        raise ValueError(f"mode should be one of {RECORD_SCHEDULES}")
+    if mode == "every":
+        return StrideSchedule(total_step, record_per)
+    elif mode == "change":
+        if tolerance <= 0:
+            raise ValueError("tolerance should be positive for mode=change")
+        return ChangeSchedule(total_step, tolerance, initial_state)
+    if points <= 0:
+        raise ValueError(f"points should be positive for mode={mode}")
+    if mode == "log":
+        return LogSpacedSchedule(total_step, points)
+    if points < 2:
+        raise ValueError("points should be at least 2 for mode=cap")
+    return CappedSchedule(total_step, points)
@@ -0,0 +1,181 @@
+"""
+フィンガープリントを使った再現性の確認と重複したRunの検出
+"""
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from .brownian_motion import BrownianMotion
+from .fingerprint import (
+    CHUNK_DIGESTS_TAG,
+    CHUNK_SIZE_TAG,
+    DIGEST_TAG,
+    TrajectoryFingerprint,
+    get_chunk_size,
+)
+from .simulator import ParamSimulator, param_from_mlflow
+from .stop_condition import find_stop
+from .tracker import Tracker
+
+
+def compute_fingerprint(
+    param: ParamSimulator,
+    chunks: Optional[Sequence[int]] = None,
+    block_size: int = 10000,
+) -> TrajectoryFingerprint:
+    """
+    パラメータからシミュレーションをやり直してフィンガープリントを計算する
+    chunksを指定した場合は最後に指定したチャンクまでしか時間発展させない
+
+    Parameters
+    ----------
+    param: ParamSimulator
+    chunks: Sequence[int] (optional)
+        ダイジェストを計算するチャンク
+    block_size: int
+        何ステップずつまとめて時間発展させるか
+
+    Returns
+    -------
+    fingerprint: TrajectoryFingerprint
+    """
+    fingerprint = TrajectoryFingerprint(param.total_step, None if chunks is None else set(chunks))
+    # 軌跡は保持せず、状態を順番にフィンガープリントに渡すだけにする
+    bm = BrownianMotion(param.param_bm, dtype=param.dtype)
+    fingerprint.update(np.array([bm.state], dtype=bm.dtype))
+    end_step = param.total_step
+    if chunks is not None and len(chunks) > 0:
+        end_step = min(end_step, (max(chunks) + 1) * fingerprint.chunk_size - 1)
+    step = 0
+    while step < end_step:
+        states = bm.steps(min(block_size, end_step - step), save=False)
+        stop = find_stop(param.stop_condition, states, bm.initial_state)
+        if stop is not None:
+            states = states[:stop[0] + 1]
+        fingerprint.update(states)
+        step += len(states)
+        if stop is not None:
+            break
+    fingerprint.finalize()
+    return fingerprint
+
+
+@dataclass
+class FingerprintCheck:
+    run_id: str
+    # 計算し直して比べたチャンク
+    checked_chunks: List[int] = field(default_factory=list)
+    # ダイジェストが一致しなかったチャンク
+    mismatched_chunks: List[int] = field(default_factory=list)
+    # 全体のダイジェストが一致したか (チャンクを指定した場合は比べないのでNone)
+    digest_matched: Optional[bool] = None
+
+    @property
+    def matched(self) -> bool:
+        return len(self.mismatched_chunks) == 0 and self.digest_matched is not False
+
+
+def _verify(
+    run_id: str,
+    params: Dict[str, str],
+    tags: Dict[str, str],
+    chunks: Optional[Sequence[int]],
+    block_size: int,
+) -> FingerprintCheck:
+    if DIGEST_TAG not in tags:
+        raise ValueError(f"Run {run_id} does not have a trajectory fingerprint")
+    param = param_from_mlflow(params)
+    recorded = tags[CHUNK_DIGESTS_TAG].split(",")
+    if int(tags[CHUNK_SIZE_TAG]) != get_chunk_size(param.total_step):
+        raise ValueError(f"Run {run_id} has an unexpected chunk size")
+    if chunks is not None:
+        chunks = sorted(set(chunks))
+        if any(chunk < 0 or chunk >= len(recorded) for chunk in chunks):
+            raise ValueError(f"chunks should be in [0, {len(recorded)})")
+
+    fingerprint = compute_fingerprint(param, chunks, block_size)
+    check = FingerprintCheck(run_id, checked_chunks=list(range(len(recorded))))
+    if chunks is None:
+        check.digest_matched = fingerprint.hexdigest() == tags[DIGEST_TAG]
+    else:
+        check.checked_chunks = chunks
+    check.mismatched_chunks = [
+        chunk for chunk in check.checked_chunks
+        if fingerprint.chunk_digests.get(chunk) != recorded[chunk]
+    ]
+    return check
+
+
+def verify_run(
+    tracker: Tracker,
+    run_id: str,
+    chunks: Optional[Sequence[int]] = None,
+    block_size: int = 10000,
+) -> FingerprintCheck:
+    """
+    Runに記録されたパラメータからシミュレーションをやり直して、タグのフィンガープリントと比べる
+    artifactは読み出さない。chunksを指定すると疑わしいチャンクだけを比べる
+
+    Parameters
+    ----------
+    tracker: Tracker
+    run_id: str
+    chunks: Sequence[int] (optional)
+        比べるチャンク。省略すると全てのチャンクと全体のダイジェストを比べる
+    block_size: int
+
+    Returns
+    -------
+    check: FingerprintCheck
+    """
+    return _verify(run_id, tracker.get_params(run_id), tracker.get_tags(run_id), chunks, block_size)
+
+
+def audit_experiment(
+    tracker: Tracker,
+    exp_name: str,
+    chunks: Optional[Sequence[int]] = None,
+    block_size: int = 10000,
+) -> List[FingerprintCheck]:
+    """
+    実験のフィンガープリントをもつ全てのFINISHEDのRunについてverify_run()する
+    非決定的な計算が紛れ込んでいないかを、artifactを読み出さずに確認できる
+
+    Returns
+    -------
+    checks: List[FingerprintCheck]
+    """
+    df_result = tracker.search_runs(tracker.get_experiment_id(exp_name), {})
+    if f"tags.{DIGEST_TAG}" not in df_result.columns:
+        return []
+    checks = []
+    for _, row in df_result[df_result[f"tags.{DIGEST_TAG}"].notna()].iterrows():
+        params = {k[len("params."):]: v for k, v in row.items()
+                  if k.startswith("params.") and isinstance(v, str)}
+        tags = {k[len("tags."):]: v for k, v in row.items()
+                if k.startswith("tags.") and isinstance(v, str)}
+        checks.append(_verify(row["run_id"], params, tags, chunks, block_size))
+    return checks
+
+
+def find_identical_runs(df_result: pd.DataFrame) -> List[List[str]]:
+    """
+    状態軌跡のダイジェストが同じRunの組を探す (重複して計算したRunの検出)
+
+    Parameters
+    ----------
+    df_result: pd.DataFrame
+        tracker.search_runs()やmlflow.search_runs()の結果
+
+    Returns
+    -------
+    groups: List[List[str]]
+        ダイジェストが同じ2つ以上のRunのrun_idのリスト
+    """
+    column = f"tags.{DIGEST_TAG}"
+    if column not in df_result.columns:
+        return []
+    groups = df_result[df_result[column].notna()].groupby(column)["run_id"].apply(list)
+    return [run_ids for run_ids in groups if len(run_ids) > 1]
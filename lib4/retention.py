@@ -0,0 +1,207 @@
+"""
+状態軌跡の保持方法
+"""
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+RETENTION_MODES = ("full", "last", "every", "log")
+
+
+class TrajectoryRetention(ABC):
+    def __init__(self, total_step: int, dtype: str = "float64") -> None:
+        """
+        状態軌跡のうちどのステップを保持するかを決めて、その値を保存する
+        save()には連続したステップの状態をstep=0から順番に渡す
+
+        Parameters
+        ----------
+        total_step: int
+            時間発展の総ステップ数 (初期状態の分を含めてtotal_step+1個の状態が渡される)
+        dtype: str
+            保存する配列の型
+        """
+        self.total_step = total_step
+        self.dtype = dtype
+
+    @abstractmethod
+    def save(self, first_step: int, states: np.ndarray) -> None:
+        """
+        first_stepから始まる連続したステップの状態を渡して、保持するものを保存する
+        """
+
+    def save_state(self, step: int, state: float) -> None:
+        """
+        1ステップ分の状態を渡して、保持するものなら保存する
+        BrownianMotion.step()から毎ステップ呼ばれるので、配列を作らずに済むように各保持方法で上書きする
+        """
+        self.save(step, np.array([state], dtype=self.dtype))
+
+    @abstractmethod
+    def steps(self) -> np.ndarray:
+        """
+        保持しているステップ (昇順)
+        """
+
+    @abstractmethod
+    def values(self) -> np.ndarray:
+        """
+        保持しているステップの状態 (steps()と同じ順)
+        """
+
+
+class FullRetention(TrajectoryRetention):
+    def __init__(self, total_step: int, dtype: str = "float64") -> None:
+        """
+        全てのステップの状態を保持する
+        """
+        super().__init__(total_step, dtype)
+        self.buffer = np.empty(total_step + 1, dtype=dtype)
+        self.count = 0
+
+    def save(self, first_step: int, states: np.ndarray) -> None:
+        self.buffer[first_step:first_step + len(states)] = states
+        self.count = first_step + len(states)
+
+    def save_state(self, step: int, state: float) -> None:
+        self.buffer[step] = state
+        self.count = step + 1
+
+    def steps(self) -> np.ndarray:
+        return np.arange(self.count)
+
+    def values(self) -> np.ndarray:
+        return self.buffer[:self.count]
+
+
+class RingBufferRetention(TrajectoryRetention):
+    def __init__(self, total_step: int, size: int, dtype: str = "float64") -> None:
+        """
+        最後のsizeステップの状態だけをリングバッファに保持する
+        """
+        super().__init__(total_step, dtype)
+        self.size = size
+        self.buffer = np.empty(size, dtype=dtype)
+        self.count = 0
+
+    def save(self, first_step: int, states: np.ndarray) -> None:
+        # バッファより長い場合は最後のsize個だけ書けばよい
+        if len(states) > self.size:
+            first_step += len(states) - self.size
+            states = states[-self.size:]
+        self.buffer[np.arange(first_step, first_step + len(states)) % self.size] = states
+        self.count = first_step + len(states)
+
+    def save_state(self, step: int, state: float) -> None:
+        self.buffer[step % self.size] = state
+        self.count = step + 1
+
+    def steps(self) -> np.ndarray:
+        return np.arange(max(self.count - self.size, 0), self.count)
+
+    def values(self) -> np.ndarray:
+        if self.count <= self.size:
+            return self.buffer[:self.count].copy()
+        # 一番古いものから並べ直す
+        head = self.count % self.size
+        return np.concatenate([self.buffer[head:], self.buffer[:head]])
+
+
+class DecimatedRetention(TrajectoryRetention):
+    def __init__(self, total_step: int, every: int, dtype: str = "float64") -> None:
+        """
+        everyステップおきの状態を保持する
+        """
+        super().__init__(total_step, dtype)
+        self.every = every
+        self.buffer = np.empty(total_step // every + 1, dtype=dtype)
+        self.count = 0
+
+    def save(self, first_step: int, states: np.ndarray) -> None:
+        # first_step以上で最初のeveryの倍数から保存する
+        first_index = -(-first_step // self.every)
+        selected = states[first_index * self.every - first_step::self.every]
+        self.buffer[first_index:first_index + len(selected)] = selected
+        self.count = first_index + len(selected)
+
+    def save_state(self, step: int, state: float) -> None:
+        if step % self.every == 0:
+            self.buffer[step // self.every] = state
+            self.count = step // self.every + 1
+
+    def steps(self) -> np.ndarray:
+        return np.arange(self.count) * self.every
+
+    def values(self) -> np.ndarray:
+        return self.buffer[:self.count]
+
+
+class LogSpacedRetention(TrajectoryRetention):
+    def __init__(self, total_step: int, n_point: int, dtype: str = "float64") -> None:
+        """
+        初期状態と、1からtotal_stepまで対数間隔に並べたn_point個のステップの状態を保持する
+        間隔が1より細かくなるところは重複を除くので、保持する点の数はn_point+1以下になる
+        """
+        super().__init__(total_step, dtype)
+        log_steps = np.round(np.geomspace(1, max(total_step, 1), n_point)).astype(int)
+        self.target_steps = np.unique(np.concatenate([[0], log_steps]))
+        self.target_steps = self.target_steps[self.target_steps <= total_step]
+        self.buffer = np.empty(len(self.target_steps), dtype=dtype)
+        self.count = 0
+
+    def save(self, first_step: int, states: np.ndarray) -> None:
+        start, end = np.searchsorted(self.target_steps, [first_step, first_step + len(states)])
+        self.buffer[start:end] = states[self.target_steps[start:end] - first_step]
+        self.count = end
+
+    def save_state(self, step: int, state: float) -> None:
+        # 渡されるステップは順番なので次に保存するステップと比べるだけでよい
+        if self.count < len(self.target_steps) and self.target_steps[self.count] == step:
+            self.buffer[self.count] = state
+            self.count += 1
+
+    def steps(self) -> np.ndarray:
+        return self.target_steps[:self.count]
+
+    def values(self) -> np.ndarray:
+        return self.buffer[:self.count]
+
+
+def make_retention(
+    mode: str,
+    total_step: int,
+    size: int = 0,
+    dtype: str = "float64"
+) -> TrajectoryRetention:
+    """
+    保持方法の名前からTrajectoryRetentionを作る
+
+    Parameters
+    ----------
+    mode: str
+        full: 全ステップ
+        last: 最後のsizeステップ
+        every: sizeステップおき
+        log: 対数間隔でsize点
+    total_step: int
+    size: int
+        mode="full"以外では正の整数を指定する
+    dtype: str
+        保存する配列の型
+
+    Returns
+    -------
+    retention: TrajectoryRetention
+    """
+    if mode not in RETENTION_MODES:
+        raise ValueError(f"mode should be one of {RETENTION_MODES}")
+    if mode == "full":
+        return FullRetention(total_step, dtype)
+    if size <= 0:
+        raise ValueError(f"size should be positive for mode={mode}")
+    if mode == "last":
+        return RingBufferRetention(total_step, size, dtype)
+    elif mode == "every":
+        return DecimatedRetention(total_step, size, dtype)
+    else:
+        return LogSpacedRetention(total_step, size, dtype)
@@ -1,16 +1,22 @@
 """
 ブラウン運動シミュレータ
 """
-import tempfile
+import json
+import time
 from dataclasses import asdict, dataclass
-from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import mlflow
 import numpy as np
 from flatten_dict import flatten, unflatten
 
-from .brownian_motion import BrownianMotion, ParamBrownianMotion
+from .artifact_cache import ArtifactCache
+from .brownian_motion import DTYPES, BrownianMotion, ParamBrownianMotion
+from .fingerprint import TrajectoryFingerprint
+from .record_schedule import RECORD_SCHEDULES, make_record_schedule
+from .retention import RETENTION_MODES
+from .stop_condition import ParamStopCondition, check_stop_condition, find_stop
+from .tracker import MlflowTracker, Tracker
 
 
 @dataclass(frozen=True)
@@ -19,18 +25,124 @@ class ParamSimulator:
     total_step: int = 1000
     # 何ステップおきにmlflowに記録するか
     record_per: int = 10
+    # metricを記録するステップの決め方
+    #   every: record_perステップおき, log: 対数間隔でrecord_points点,
+    #   cap: step=0も含めて全体でrecord_points点以下になるように間隔を自動で決める,
+    #   change: 前回記録した状態からrecord_toleranceより大きく変化したときだけ
+    #   (every以外では最後のステップも記録する)
+    record_schedule: str = "every"
+    record_points: int = 0
+    record_tolerance: float = 0.
     # 軌跡全部をmlflow artifact全体として保存するか
     save_full_traj: bool = True
+    # 軌跡のどのステップを保存するか
+    #   full: 全ステップ, last: 最後のtraj_retention_sizeステップ,
+    #   every: traj_retention_sizeステップおき, log: 対数間隔でtraj_retention_size点
+    traj_retention: str = "full"
+    traj_retention_size: int = 0
+    # 状態と状態軌跡の型 (float64かfloat32)
+    dtype: str = "float64"
     # ブラウン運動のパラメータ
     param_bm: ParamBrownianMotion = ParamBrownianMotion(
         seed=0, initial_state=0., sigma=1.)
+    # 停止条件 (満たしたらtotal_stepより前でも終了する)
+    stop_condition: ParamStopCondition = ParamStopCondition()
+
+    def __post_init__(self):
+        if self.record_schedule not in RECORD_SCHEDULES:
+            raise ValueError(f"record_schedule should be one of {RECORD_SCHEDULES}")
+        if self.record_schedule in ("log", "cap") and self.record_points <= 0:
+            raise ValueError("record_points should be positive")
+        if self.record_schedule == "cap" and self.record_points < 2:
+            raise ValueError("record_points should be at least 2 for record_schedule=cap")
+        if self.record_schedule == "change" and self.record_tolerance <= 0:
+            raise ValueError("record_tolerance should be positive")
+        if self.traj_retention not in RETENTION_MODES:
+            raise ValueError(f"traj_retention should be one of {RETENTION_MODES}")
+        if self.traj_retention != "full" and self.traj_retention_size <= 0:
+            raise ValueError("traj_retention_size should be positive")
+        if self.dtype not in DTYPES:
+            raise ValueError(f"dtype should be one of {DTYPES}")
+        check_stop_condition(self.stop_condition, self.param_bm.initial_state)
+
+
+# 最初のバージョンから記録しているパラメータ
+#   それ以外は後から追加したもので、追加する前のRunには記録されていない
+#   記録されていないパラメータはデフォルト値とみなす (param_from_mlflow()と同じ)
+CORE_PARAM_KEYS = (
+    "total_step", "record_per", "save_full_traj",
+    "param_bm.seed", "param_bm.initial_state", "param_bm.sigma",
+)
+
+
+def split_search_params(params: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    flattenしたパラメータを、検索で等しいことを要求するものと、Runに記録されていなくても
+    一致したとみなすもの (後から追加したパラメータでデフォルト値のもの) に分ける
+
+    Returns
+    -------
+    params: dict
+        Tracker.search_runs()のparams
+    defaults: dict
+        Tracker.search_runs()のdefaults
+    """
+    default_values = flatten(asdict(ParamSimulator()), reducer="dot")
+    required, defaults = {}, {}
+    for key, value in params.items():
+        if key not in CORE_PARAM_KEYS and key in default_values and value == default_values[key]:
+            defaults[key] = value
+        else:
+            required[key] = value
+    return required, defaults
+
+
+def get_param_parsers() -> Dict[str, Callable[[str], Any]]:
+    """
+    ParamSimulatorの各パラメータについて文字列から元の型に戻す関数を返す
+    mlflowにはパラメータが文字列として保存されている
+    """
+    parsers: Dict[str, Callable[[str], Any]] = {}
+    for key, value in flatten(asdict(ParamSimulator()), reducer="dot").items():
+        if isinstance(value, bool):
+            parsers[key] = lambda v: v == "True"
+        elif isinstance(value, int):
+            parsers[key] = int
+        elif isinstance(value, float):
+            parsers[key] = float
+    return parsers
+
+
+def param_from_mlflow(params: Dict[str, str]) -> ParamSimulator:
+    """
+    mlflowに文字列として保存されたflattenしたパラメータからParamSimulatorを作り直す
+    保存されていないパラメータ(後から追加されたものなど)はデフォルト値にする
+    """
+    parsers = get_param_parsers()
+    values = flatten(asdict(ParamSimulator()), reducer="dot")
+    for key, value in params.items():
+        if key in values:
+            values[key] = parsers.get(key, str)(value)
+    values = unflatten(values, splitter="dot")
+    return ParamSimulator(**{
+        **values,
+        "param_bm": ParamBrownianMotion(**values["param_bm"]),
+        "stop_condition": ParamStopCondition(**values["stop_condition"]),
+    })
 
 
 class Simulator:
     done: bool = False
     result: Dict[str, Any] = {}
     state_trajectory: Optional[np.ndarray] = None
+    state_trajectory_steps: Optional[np.ndarray] = None
     run_id: Optional[str] = None
+    stopping_time: Optional[int] = None
+    # run()で実際に計算したステップ数 (延長した場合は延長元の分を含まない)
+    n_computed_step: int = 0
+    base_result: Optional[Dict[str, Any]] = None
+    # 状態軌跡のフィンガープリント (run()で計算してタグとして記録する)
+    fingerprint: Optional[TrajectoryFingerprint] = None
 
     def __init__(
         self,
@@ -40,26 +152,41 @@ class Simulator:
         run_name: Optional[str] = None,  # mlflowのRunにつける名前
         run_tags: Optional[Dict[str, Any]] = None,  # mlflowのRunにつけるタグ
         check_previous_runs: bool = True,  # 同じパラメータでの実験結果がないか検索する
+        artifact_cache: Optional[ArtifactCache] = None,  # ダウンロードしたartifactのキャッシュ
+        extend_previous_runs: bool = False,  # total_stepだけが短い実験結果があれば続きから計算する
+        block_size: int = 10000,  # 何ステップずつまとめて時間発展させるか
+        tracker: Optional[Tracker] = None,  # 結果の記録先 (省略するとcache_dirのmlflow)
     ) -> None:
         self.cache_dir = cache_dir
+        self.block_size = block_size
         self.total_step = param.total_step
         self.record_per = param.record_per
+        self.stop_condition = param.stop_condition
         self.save_full_trajectory = param.save_full_traj
-        self.bm = BrownianMotion(param.param_bm, param.save_full_traj, self.total_step)
+        self.traj_retention = param.traj_retention
+        self.bm = BrownianMotion(
+            param.param_bm, param.save_full_traj, self.total_step,
+            retention=param.traj_retention, retention_size=param.traj_retention_size,
+            dtype=param.dtype,
+        )
+        self.record_schedule = make_record_schedule(
+            param.record_schedule, self.total_step,
+            record_per=param.record_per, points=param.record_points,
+            tolerance=param.record_tolerance, initial_state=self.bm.state,
+        )
 
         # パラメータをflattenした辞書として取得する
         #   flattenすることでmlflowが受け取ってくれる
         #   パラメータに階層構造があってもドットでつなげてくれる
         self.params_mlflow = flatten(asdict(param), reducer='dot')
 
-        # mlflowをセットアップする
-        mlflow.set_tracking_uri(self.cache_dir)
-        self.mlflow_client = mlflow.tracking.MlflowClient(tracking_uri=self.cache_dir)
-        exp = self.mlflow_client.get_experiment_by_name(exp_name)
-        if exp is not None:
-            self.exp_id = exp.experiment_id
-        else:
-            self.exp_id = self.mlflow_client.create_experiment(exp_name)
+        # 記録先をセットアップする
+        if tracker is None:
+            tracker = MlflowTracker(self.cache_dir, artifact_cache=artifact_cache)
+        elif artifact_cache is not None:
+            raise ValueError("artifact_cache should be given to MlflowTracker when tracker is given")
+        self.tracker = tracker
+        self.exp_id = self.tracker.get_experiment_id(exp_name)
         self.run_tags = run_tags
         self.run_name = run_name
 
@@ -67,60 +194,196 @@ class Simulator:
         #   check_previous_runs=Trueなら過去の結果をmlflowから取り出す
         if check_previous_runs:
             # 同じパラメータでFINISHEDステータスになっている結果があるか検索する
-            query = " and ".join([f"param.{k} = '{v}'" for k, v in self.params_mlflow.items()])
-            query += " and attributes.status = 'FINISHED'"
-            df_result = mlflow.search_runs(
-                experiment_ids=[self.exp_id],
-                filter_string=query,
-                max_results=1,
-            )
+            #   後から追加したパラメータがデフォルト値なら、それを記録していない古いRunも探す
+            params, defaults = split_search_params(self.params_mlflow)
+            df_result = self.tracker.search_runs(
+                self.exp_id, params, max_results=1, defaults=defaults)
             if len(df_result) > 0:
                 self.done = True
                 # convert the pandas DataFrame to an unflattened dict
                 self.result = unflatten(df_result.iloc[0].to_dict(), splitter="dot")
                 self.run_id = self.result["run_id"]
 
-    def run(self) -> None:
+        # 同じ結果がなければ延長元にできる実験結果を探しておく
+        #   every以外の記録方法では記録するステップがtotal_stepによって変わるので延長しない
+        if not self.done and extend_previous_runs and param.record_schedule == "every":
+            self.base_result = self._search_base_run()
+
+    def _search_base_run(self) -> Optional[Dict[str, Any]]:
+        """
+        total_step以外のパラメータが同じで、total_stepがより短いFINISHEDの結果を検索する
+        候補が複数あれば一番長いものを返す
+
+        Returns
+        -------
+        base_result: dict (optional)
+            見つからなければNone
+        """
+        params, defaults = split_search_params(
+            {k: v for k, v in self.params_mlflow.items() if k != "total_step"})
+        df_result = self.tracker.search_runs(self.exp_id, params, defaults=defaults)
+        # 停止条件で途中終了したRunは延長できない
+        if "tags.stop_reason" in df_result.columns:
+            df_result = df_result[df_result["tags.stop_reason"].isna()]
+        if len(df_result) == 0:
+            return None
+        # パラメータは文字列として保存されているので数字に直す
+        total_steps = df_result["params.total_step"].apply(int)
+        shorter = total_steps < self.total_step
+        if not shorter.any():
+            return None
+        base_index = total_steps[shorter].idxmax()
+        return unflatten(df_result.loc[base_index].to_dict(), splitter="dot")
+
+    def _restore_from_base_run(self) -> int:
+        """
+        延長元の実験結果の最終時刻の状態を復元し、metricの履歴を新しいRunにコピーする
+        終了時に保存した乱数生成器の状態がなければ延長元の区間をもう一度計算して早送りする
+
+        Returns
+        -------
+        base_total_step: int
+            延長元のtotal_step
+        """
+        base_run_id = self.base_result["run_id"]
+        base_total_step = int(self.base_result["params"]["total_step"])
+        print(f"Extending Run (ID={base_run_id}) from step {base_total_step}")
+        tags = self.base_result.get("tags", {})
+        # 全ステップの軌跡を保持していない場合は延長元のartifactから復元できないので早送りする
+        can_restore = not self.save_full_trajectory or self.traj_retention == "full"
+        if can_restore and isinstance(tags.get("rng_state"), str) \
+                and isinstance(tags.get("final_state"), str):
+            base_trajectory = None
+            if self.save_full_trajectory:
+                base_trajectory = self._load_artifact(base_run_id, "state_trajectory.bin")
+                self.fingerprint.update(base_trajectory)
+            else:
+                # 延長元の区間の状態がないのでフィンガープリントは計算できない
+                self.fingerprint = None
+            self.bm.restore(
+                state=float(tags["final_state"]),
+                rng_state=json.loads(tags["rng_state"]),
+                state_trajectory=base_trajectory,
+            )
+        else:
+            # run()と同じくblock_sizeステップずつ早送りして、長い配列をまとめて作らないようにする
+            self.fingerprint.update(np.array([self.bm.state], dtype=self.bm.dtype))
+            step = 0
+            while step < base_total_step:
+                n_step = min(self.block_size, base_total_step - step)
+                self.fingerprint.update(self.bm.steps(n_step))
+                step += n_step
+
+        metric_history = self.tracker.get_metric_history(base_run_id, "state")
+        self.tracker.log_metric_history(self.run_id, metric_history)
+        self.tracker.set_tags(self.run_id, {"extended_from": base_run_id})
+        return base_total_step
+
+    def run(self, before_finish: Optional[Callable[[], None]] = None) -> None:
         """
         シミュレーションを１試行実行する
+
+        Parameters
+        ----------
+        before_finish: Callable[[], None] (optional)
+            結果を全て記録してRunを終了する直前に呼ぶ関数
+            例外を出すとRunはFINISHEDにならずにFAILEDで終わる (作業キューのリースの確認など)
         """
         # すでに実行済みの場合は実行しない
         if self.done:
             print("Simulation already finished!")
             return
 
-        # mlflowのRunを開始する
-        with mlflow.start_run(
-            experiment_id=self.exp_id,
+        # Runを開始する
+        with self.tracker.start_run(
+            self.exp_id,
             run_name=self.run_name,
             tags=self.run_tags
-        ) as run:
-            self.run_id = run.info.run_id
+        ) as run_id:
+            self.run_id = run_id
             print(f"Starting Run {self.run_name} (ID={self.run_id})")
             print(self.params_mlflow)
-            mlflow.log_params(self.params_mlflow)
+            self.tracker.log_params(self.run_id, self.params_mlflow)
+            self.tracker.set_tags(self.run_id, {
+                "sampling_scheme": "antithetic" if self.bm.antithetic else "plain",
+                "record_schedule": self.record_schedule.describe(),
+            })
 
-            # 初期化
-            state = self.bm.state
-            mlflow.log_metrics({
-                "state": state,
-            }, step=0)
+            self.fingerprint = TrajectoryFingerprint(self.total_step)
+            if self.base_result is not None:
+                # 延長元の結果の続きから計算する
+                start_step = self._restore_from_base_run()
+            else:
+                # 初期化
+                start_step = 0
+                state = self.bm.state
+                self.fingerprint.update(np.array([state], dtype=self.bm.dtype))
+                self.tracker.log_metrics(self.run_id, {
+                    "state": state,
+                }, step=0)
             # シミュレーション開始 (初期時刻がstep=0で、そこからtotal_step回更新)
-            for step in range(1, self.total_step + 1):
-                state = self.bm.step()
+            #   block_sizeステップずつまとめて時間発展させて、停止条件もまとめて判定する
+            step = start_step
+            stop = None
+            while step < self.total_step and stop is None:
+                n_step = min(self.block_size, self.total_step - step)
+                states = self.bm.steps(n_step, save=False)
+                block_steps = np.arange(step + 1, step + n_step + 1)
+
+                stop = find_stop(self.stop_condition, states, self.bm.initial_state)
+                if stop is not None:
+                    # 停止条件を満たしたステップより後は捨てる
+                    states = states[:stop[0] + 1]
+                    block_steps = block_steps[:stop[0] + 1]
+                    self.bm.state = states[-1]
+                self.bm.save_states(states)
+                if self.fingerprint is not None:
+                    self.fingerprint.update(states)
 
-                if step % self.record_per == self.record_per - 1:
-                    mlflow.log_metrics({
-                        "state": state,
-                    }, step=step)
+                # 記録するステップをまとめて選んで、ブロックごとにまとめて記録する
+                recorded = self.record_schedule.select(block_steps, states)
+                timestamp = int(time.time() * 1000)
+                self.tracker.log_metric_history(self.run_id, [
+                    mlflow.entities.Metric("state", float(state), timestamp, int(record_step))
+                    for record_step, state in zip(block_steps[recorded], states[recorded])
+                ])
+                step += len(states)
+            self.n_computed_step = step - start_step
 
-            # 状態軌跡をmlflowにartifactとして保存
+            if stop is not None:
+                # 停止した時刻と理由を記録する
+                #   停止した状態は記録するステップに選ばれていなかったときだけ記録する
+                self.stopping_time = step
+                metrics = {"stopping_time": step}
+                if stop[0] not in recorded:
+                    metrics["state"] = self.bm.state
+                self.tracker.log_metrics(self.run_id, metrics, step=step)
+                self.tracker.set_tags(self.run_id, {"stop_reason": stop[1]})
+
+            # 状態軌跡のフィンガープリントを記録する
+            #   artifactを読み出さなくても軌跡が同じかどうかを比べられる (reproducibility.py)
+            if self.fingerprint is not None:
+                self.fingerprint.finalize()
+                self.tracker.set_tags(self.run_id, self.fingerprint.get_tags())
+
+            # 状態軌跡をmlflowにartifactとして保存 (途中で停止した場合はそこまで)
+            #   全ステップではない場合はどのステップの状態かも保存する
             self.state_trajectory = self.bm.state_trajectory
-            with tempfile.TemporaryDirectory() as tmp_dir:
-                tmp_path = Path(tmp_dir).joinpath("state_trajectory.bin")
-                with tmp_path.open("wb") as f:
-                    np.save(f, self.state_trajectory)
-                mlflow.log_artifact(str(tmp_path))
+            self.state_trajectory_steps = self.bm.state_trajectory_steps
+            #   シリアライズは記録先に任せる (NoOpTrackerなら何も書かない)
+            self.tracker.log_array(self.run_id, "state_trajectory.bin", self.state_trajectory)
+            if self.traj_retention != "full":
+                self.tracker.log_array(
+                    self.run_id, "state_trajectory_steps.bin", self.state_trajectory_steps)
+
+            # 後から延長できるように最終時刻の状態を保存しておく
+            if stop is None:
+                self.tracker.set_tags(self.run_id, {
+                    "final_state": repr(float(self.bm.state)),
+                    "rng_state": json.dumps(self.bm.get_rng_state()),
+                })
+            if before_finish is not None:
+                before_finish()
 
         self.done = True
         return
@@ -130,7 +393,7 @@ class Simulator:
         シミュレーションを実行したあとで状態の軌跡を取得する
         run_idが必要なので、check_previous_run=Trueでコンストラクタを呼び出すか
         run()を実行したあとでないとRuntimeErrorを発生させる
-        これはrecord_perステップおきに保存されたものを取得する。軌跡全体を取得するにはget_state_trajectory()
+        これはrecord_scheduleで選んだステップ(デフォルトではrecord_perステップおき)に保存されたものを取得する。軌跡全体を取得するにはget_state_trajectory()
 
         Returns
         -------
@@ -139,34 +402,49 @@ class Simulator:
         if self.run_id is None:
             raise RuntimeError("Please run simulation first or set the params of finished result")
 
-        return self.mlflow_client.get_metric_history(self.run_id, "state")
+        return self.tracker.get_metric_history(self.run_id, "state")
 
-    def get_state_trajectory(self) -> np.ndarray:
+    def get_state_trajectory(
+        self,
+        return_steps: bool = False
+    ) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
         """
         シミュレーションを実行したあとで状態の軌跡全体を取得する
         record_perステップおきにmetricとして保存されたものを取得するにはget_metric_histroy()
 
+        Parameters
+        ----------
+        return_steps: bool
+            Trueなら保持している各状態が何ステップ目のものかも返す
+            traj_retentionがfull以外の場合に使う
+
         Returns
         -------
         state_trajectory: np.ndarray (total_step, ) float
+        (return_stepsがTrueの場合は (steps, state_trajectory))
         """
         if self.state_trajectory is not None:
             # run()でシミュレーションを実行した後なら実行結果のデータがすでにある
-            return self.state_trajectory
+            pass
         elif self.result is not None:
-            # 以前実行した結果がある場合はそのartifactから読み出す
-            parent_path = Path(self.cache_dir).parent
-            artifact_path = parent_path.joinpath(
-                self.result["artifact_uri"],
-                "state_trajectory.bin"
-            )
-            if artifact_path.exists():
-                data = np.load(str(artifact_path))
-                # キャッシュしておく
-                self.state_trajectory = data
-                return data
+            # 以前実行した結果がある場合はそのartifactから読み出す (キャッシュしておく)
+            self.state_trajectory = self._load_artifact(self.run_id, "state_trajectory.bin")
+            if self.traj_retention != "full":
+                self.state_trajectory_steps = self._load_artifact(
+                    self.run_id, "state_trajectory_steps.bin")
             else:
-                raise FileNotFoundError(f"{str(artifact_path)} does not exists!")
+                self.state_trajectory_steps = np.arange(len(self.state_trajectory))
         else:
             # シミュレーションを一度も実行していない
             raise RuntimeError("Please run simulation first")
+
+        if return_steps:
+            return self.state_trajectory_steps, self.state_trajectory
+        return self.state_trajectory
+
+    def _load_artifact(self, run_id: str, name: str) -> np.ndarray:
+        """
+        実行済みのRunのartifactからnumpy配列を読み出す
+        """
+        with self.tracker.open_artifact(run_id, name) as f:
+            return np.load(f)
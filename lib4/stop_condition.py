@@ -0,0 +1,124 @@
+"""
+シミュレーションの停止条件 (初到達時刻の計算)
+"""
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .brownian_motion import BrownianMotion, ParamBrownianMotion
+
+STOP_CONDITION_KINDS = ("none", "level", "interval")
+
+
+@dataclass(frozen=True)
+class ParamStopCondition:
+    # 停止条件の種類
+    #   none: 停止しない
+    #   level: 初期状態から見てlevelの反対側に到達したら停止 (levelは初期状態と違う値にする)
+    #   interval: 区間[lower, upper]の外に出たら停止
+    kind: str = "none"
+    # kind="level"のときの境界
+    level: float = 0.
+    # kind="interval"のときの区間
+    lower: float = -np.inf
+    upper: float = np.inf
+
+    def __post_init__(self):
+        if self.kind not in STOP_CONDITION_KINDS:
+            raise ValueError(f"kind should be one of {STOP_CONDITION_KINDS}")
+        if self.kind == "interval" and self.lower > self.upper:
+            raise ValueError("lower should be smaller than upper")
+
+
+def check_stop_condition(param: ParamStopCondition, initial_state: float) -> None:
+    """
+    停止条件が初期状態に対して意味を持つか確かめる
+    kind="level"でlevelが初期状態と同じだと、どちら側に到達したら停止するのか決まらない
+    """
+    if param.kind == "level" and param.level == initial_state:
+        raise ValueError("level should be different from initial_state for kind=level")
+
+
+def find_stop(
+    param: ParamStopCondition,
+    states: np.ndarray,
+    initial_state: float
+) -> Optional[Tuple[int, str]]:
+    """
+    連続したステップの状態の中で最初に停止条件を満たすものを探す
+
+    Parameters
+    ----------
+    param: ParamStopCondition
+    states: np.ndarray (n_step, ) float
+        連続したステップの状態
+    initial_state: float
+        シミュレーションの初期状態 (levelのどちら側から出発したかの判定に使う)
+
+    Returns
+    -------
+    (index, reason): (int, str) (optional)
+        最初に停止条件を満たしたstatesのインデックスと停止理由 ("level", "lower", "upper")
+        停止条件を満たさなければNone
+    """
+    if param.kind == "none":
+        return None
+    elif param.kind == "level":
+        if initial_state < param.level:
+            hit = states >= param.level
+        else:
+            hit = states <= param.level
+    else:
+        hit = (states < param.lower) | (states > param.upper)
+
+    if not hit.any():
+        return None
+    index = int(np.argmax(hit))
+    if param.kind == "level":
+        reason = "level"
+    elif states[index] < param.lower:
+        reason = "lower"
+    else:
+        reason = "upper"
+    return index, reason
+
+
+def simulate_first_passage(
+    params_bm: List[ParamBrownianMotion],
+    stop_condition: ParamStopCondition,
+    total_step: int,
+    block_size: int = 10000,
+) -> np.ndarray:
+    """
+    複数のブラウン運動について停止条件を満たした時刻を計算する
+    block_sizeステップずつまとめて時間発展させ、停止したものはそれ以降計算しない
+
+    Parameters
+    ----------
+    params_bm: List[ParamBrownianMotion]
+    stop_condition: ParamStopCondition
+    total_step: int
+        最大で何ステップ時間発展するか
+    block_size: int
+        一度にまとめて時間発展させるステップ数
+
+    Returns
+    -------
+    stopping_times: np.ndarray (len(params_bm), ) int
+        停止したステップ。total_stepまでに停止しなかったものは-1
+    """
+    for param in params_bm:
+        check_stop_condition(stop_condition, param.initial_state)
+    stopping_times = np.full(len(params_bm), -1)
+    active = {i: BrownianMotion(param) for i, param in enumerate(params_bm)}
+    step = 0
+    while active and step < total_step:
+        n_step = min(block_size, total_step - step)
+        for i, bm in list(active.items()):
+            hit = find_stop(stop_condition, bm.steps(n_step), bm.initial_state)
+            if hit is not None:
+                stopping_times[i] = step + hit[0] + 1
+                del active[i]
+        step += n_step
+    return stopping_times
@@ -0,0 +1,219 @@
+"""
+実験結果の集計テーブル
+"""
+import os
+from dataclasses import asdict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import mlflow
+import numpy as np
+import pandas as pd
+from flatten_dict import flatten
+
+from .simulator import param_from_mlflow
+from .tracker import get_auxiliary_path
+
+
+class ExperimentSummary:
+    # チャンクファイルがこの数を超えたら1つにまとめ直す
+    max_chunks: int = 32
+
+    def __init__(
+        self,
+        exp_name: str,  # mlflowの実験の名前
+        cache_dir: str = "./mlruns",  # mlflowのデータ保存先
+        table_dir: Optional[str] = None,  # 集計テーブルの保存先のディレクトリ
+    ) -> None:
+        """
+        実験のFINISHEDのRunについて、型付きのパラメータと最終時刻のmetricを列ごとに保存したテーブル
+
+        テーブルは列ごとのnumpy配列をまとめたnpzファイル(チャンク)として保存する。
+        sync()では前回から新しく終了したRunだけをトラッキングストアから読み出して、
+        新しいチャンクとして追加する。チャンクが増えすぎたら1つにまとめ直す。
+        列名はmlflow.search_runs()と同じく"params.param_bm.sigma"や"metrics.state"のようにする。
+        """
+        self.exp_name = exp_name
+        self.cache_dir = cache_dir
+        if table_dir is None:
+            table_dir = get_auxiliary_path(cache_dir, "summary", exp_name)
+        self.table_dir = Path(table_dir)
+        # FINISHEDにならずに終わったRunのID (次のsync()から読み出さない)
+        self.skipped_path = self.table_dir.joinpath("skipped.txt")
+        self.mlflow_client = mlflow.tracking.MlflowClient(tracking_uri=self.cache_dir)
+
+    def _get_chunk_paths(self) -> List[Path]:
+        if not self.table_dir.is_dir():
+            return []
+        return sorted(self.table_dir.glob("*.npz"))
+
+    def load(self) -> pd.DataFrame:
+        """
+        保存されている集計テーブルを読み出す
+        まだ一度もsync()していなければ空のDataFrameを返す
+
+        Returns
+        -------
+        df_summary: pd.DataFrame
+        """
+        while True:
+            try:
+                chunks = []
+                for path in self._get_chunk_paths():
+                    with np.load(str(path)) as data:
+                        chunks.append(pd.DataFrame({key: data[key] for key in data.files}))
+                break
+            except FileNotFoundError:
+                # 読み出し中に他のプロセスがチャンクをまとめ直した場合は読み直す
+                continue
+        if len(chunks) == 0:
+            return pd.DataFrame({"run_id": np.array([], dtype=str)})
+        if len(chunks) == 1:
+            return chunks[0]
+        # まとめ直している途中で古いチャンクと重複していれば新しい方を残す
+        df_summary = pd.concat(chunks, ignore_index=True)
+        df_summary = df_summary.drop_duplicates("run_id", keep="last", ignore_index=True)
+        # 後から追加された文字列の列で値がない部分は空文字列にする
+        for key in df_summary.columns:
+            if df_summary[key].dtype == object:
+                df_summary[key] = df_summary[key].fillna("")
+        return df_summary
+
+    def _load_run_ids(self) -> Set[str]:
+        """
+        集計テーブルにあるRunと、FINISHEDにならずに終わったRunのID
+        """
+        run_ids: Set[str] = set()
+        for path in self._get_chunk_paths():
+            with np.load(str(path)) as data:
+                run_ids.update(data["run_id"])
+        if self.skipped_path.exists():
+            run_ids.update(self.skipped_path.read_text().split())
+        return run_ids
+
+    def _save(self, df_summary: pd.DataFrame) -> None:
+        """
+        新しいチャンクとして保存する
+        一時ファイルに書いてからrenameして、読み出し中のプロセスが壊れたファイルを見ないようにする
+        """
+        self.table_dir.mkdir(parents=True, exist_ok=True)
+        chunk_paths = self._get_chunk_paths()
+        index = int(chunk_paths[-1].stem) + 1 if len(chunk_paths) > 0 else 0
+        chunk_path = self.table_dir.joinpath(f"{index:06d}.npz")
+        tmp_path = self.table_dir.joinpath(f".{chunk_path.name}.{os.getpid()}.tmp")
+        columns = {}
+        for key in df_summary.columns:
+            column = df_summary[key]
+            if column.dtype.kind in "biuf":
+                columns[key] = column.to_numpy()
+            else:
+                # 文字列の列はpickleなしで読めるようにnumpyの文字列型にする
+                columns[key] = column.fillna("").astype(str).to_numpy(dtype=str)
+        with tmp_path.open("wb") as f:
+            np.savez(f, **columns)
+        os.replace(tmp_path, chunk_path)
+
+    def _compact(self) -> None:
+        """
+        チャンクを1つにまとめ直す
+        まとめたものを新しいチャンクとして書いてから古いチャンクを消す
+        """
+        chunk_paths = self._get_chunk_paths()
+        self._save(self.load())
+        for path in chunk_paths:
+            path.unlink()
+
+    def _get_new_runs(
+        self,
+        exp_id: str,
+        known_run_ids: Set[str],
+    ) -> Tuple[List[mlflow.entities.Run], List[str]]:
+        """
+        集計テーブルにまだないFINISHEDのRunを取得する
+
+        Returns
+        -------
+        new_runs: List[mlflow.entities.Run]
+        skipped_run_ids: List[str]
+            FAILEDかKILLEDで終わっていて、今後も集計テーブルに入らないRunのID
+        """
+        exp_dir = Path(self.cache_dir).joinpath(exp_id)
+        if exp_dir.is_dir():
+            # ローカルのファイルストアならディレクトリ名がrun_idなので、新しいRunだけを読み出せる
+            runs = [
+                self.mlflow_client.get_run(path.name)
+                for path in sorted(exp_dir.iterdir())
+                if path.is_dir() and path.name not in known_run_ids
+            ]
+        else:
+            # それ以外のトラッキングストアでは検索結果から新しいRunを選ぶ
+            runs = []
+            page_token = None
+            while True:
+                page = self.mlflow_client.search_runs(
+                    experiment_ids=[exp_id],
+                    filter_string="attributes.status = 'FINISHED'",
+                    page_token=page_token,
+                )
+                runs += [run for run in page if run.info.run_id not in known_run_ids]
+                page_token = page.token
+                if not page_token:
+                    break
+        new_runs = [
+            run for run in runs
+            if run.info.status == "FINISHED" and run.info.lifecycle_stage == "active"
+        ]
+        # RUNNINGのRunはこれから終了するかもしれないので次のsync()でも読み出す
+        skipped_run_ids = [
+            run.info.run_id for run in runs if run.info.status in ("FAILED", "KILLED")
+        ]
+        return new_runs, skipped_run_ids
+
+    @staticmethod
+    def _get_row(run: mlflow.entities.Run) -> Dict[str, Any]:
+        """
+        1つのRunの情報を集計テーブルの1行分の辞書にする
+        パラメータを追加する前のRunにも同じ型の列ができるように、
+        記録されていないParamSimulatorのパラメータはデフォルト値で埋める
+        """
+        # ParamSimulatorにないパラメータは文字列のままにする
+        params: Dict[str, Any] = dict(run.data.params)
+        if "total_step" in params:
+            # Simulatorで記録したRun
+            params.update(flatten(asdict(param_from_mlflow(params)), reducer="dot"))
+        row: Dict[str, Any] = {
+            "run_id": run.info.run_id,
+            "start_time": run.info.start_time,
+            "end_time": run.info.end_time,
+        }
+        for key, value in params.items():
+            row[f"params.{key}"] = value
+        for key, value in run.data.metrics.items():
+            row[f"metrics.{key}"] = value
+        return row
+
+    def sync(self) -> int:
+        """
+        前回のsync()以降に終了したRunを集計テーブルに新しいチャンクとして追加する
+
+        Returns
+        -------
+        n_new_runs: int
+            追加したRunの数
+        """
+        exp = self.mlflow_client.get_experiment_by_name(self.exp_name)
+        if exp is None:
+            raise ValueError(f"Experiment {self.exp_name} does not exist")
+
+        new_runs, skipped_run_ids = self._get_new_runs(exp.experiment_id, self._load_run_ids())
+        if len(skipped_run_ids) > 0:
+            self.table_dir.mkdir(parents=True, exist_ok=True)
+            with self.skipped_path.open("a") as f:
+                f.write("".join(f"{run_id}\n" for run_id in skipped_run_ids))
+        if len(new_runs) == 0:
+            return 0
+
+        self._save(pd.DataFrame([self._get_row(run) for run in new_runs]))
+        if len(self._get_chunk_paths()) > self.max_chunks:
+            self._compact()
+        return len(new_runs)
@@ -0,0 +1,450 @@
+"""
+実験結果の記録先 (mlflow, メモリ上, 記録しない)
+"""
+import io
+import tempfile
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import IO, Any, ContextManager, Dict, Iterator, List, Optional
+
+import mlflow
+import numpy as np
+import pandas as pd
+from mlflow.entities import Metric, Param, RunTag
+
+from .artifact_cache import ArtifactCache
+
+# log_batchが一度に受け付けるmetricの数の上限
+MLFLOW_MAX_METRICS_PER_BATCH = 1000
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def get_auxiliary_path(cache_dir: str, *parts: str) -> str:
+    """
+    mlflowのデータ以外に保存するもの(集計テーブル、作業キューなど)の置き場所
+    mlrunsの中に置くとmlflowが実験のディレクトリと間違えるので横に置く
+    """
+    return str(Path(cache_dir).parent.joinpath(*parts))
+
+
+def _filter_by_defaults(
+    df_result: pd.DataFrame,
+    defaults: Dict[str, Any],
+    max_results: Optional[int] = None,
+) -> pd.DataFrame:
+    """
+    search_runs()の結果からdefaultsのパラメータが等しいか記録されていないRunだけを残す
+    """
+    for key, value in defaults.items():
+        column = f"params.{key}"
+        if column in df_result.columns:
+            df_result = df_result[df_result[column].isna() | (df_result[column] == str(value))]
+    if max_results is not None:
+        df_result = df_result.head(max_results)
+    return df_result.reset_index(drop=True)
+
+
+class Tracker(ABC):
+    """
+    Simulatorが実験結果を記録・検索するためのインターフェース
+    run_idやexperiment_idは文字列、パラメータとタグの値はmlflowと同じく文字列として扱う
+    """
+
+    @abstractmethod
+    def get_experiment_id(self, exp_name: str) -> str:
+        """
+        実験の名前からexperiment_idを返す (なければ作る)
+        """
+
+    @abstractmethod
+    def search_runs(
+        self,
+        exp_id: str,
+        params: Dict[str, Any],
+        max_results: Optional[int] = None,
+        defaults: Optional[Dict[str, Any]] = None,
+    ) -> pd.DataFrame:
+        """
+        paramsの全てのパラメータが等しいFINISHEDのRunを新しい順に検索する
+        defaultsのパラメータは等しいか、Runに記録されていなければ一致したとみなす
+        (パラメータを追加する前に記録されたRunはそのパラメータをもたない)
+
+        Returns
+        -------
+        df_result: pd.DataFrame
+            mlflow.search_runs()と同じく run_id, artifact_uri, params.*, metrics.*, tags.* の列をもつ
+        """
+
+    @abstractmethod
+    def start_run(
+        self,
+        exp_id: str,
+        run_name: Optional[str] = None,
+        tags: Optional[Dict[str, Any]] = None,
+    ) -> ContextManager[str]:
+        """
+        Runを開始してrun_idを返すコンテキストマネージャ (@contextmanagerで実装する)
+        with文を正常に抜けたらFINISHED、例外で抜けたらFAILEDになる
+        """
+
+    @abstractmethod
+    def log_params(self, run_id: str, params: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    def log_metrics(self, run_id: str, metrics: Dict[str, float], step: int = 0) -> None:
+        ...
+
+    @abstractmethod
+    def log_metric_history(self, run_id: str, metrics: List[Metric]) -> None:
+        """
+        他のRunから取得したmetricの履歴をそのまま記録する
+        """
+
+    @abstractmethod
+    def set_tags(self, run_id: str, tags: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    def log_artifact(self, run_id: str, local_path: str) -> None:
+        """
+        ローカルのファイルをartifactのルートに同じ名前で保存する
+        """
+
+    def log_array(self, run_id: str, name: str, array: np.ndarray) -> None:
+        """
+        numpy配列をnp.save()の形式でnameという名前のartifactとして保存する
+        (np.load()で読み出せる)
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_path = Path(tmp_dir).joinpath(name)
+            with tmp_path.open("wb") as f:
+                np.save(f, array)
+            self.log_artifact(run_id, str(tmp_path))
+
+    @abstractmethod
+    def open_artifact(self, run_id: str, artifact_path: str) -> ContextManager[IO[bytes]]:
+        """
+        artifactを開くコンテキストマネージャ (@contextmanagerで実装する)
+        なければFileNotFoundError
+        """
+
+    @abstractmethod
+    def get_metric_history(self, run_id: str, key: str) -> List[Metric]:
+        ...
+
+    @abstractmethod
+    def get_latest_metrics(self, run_id: str) -> Dict[str, float]:
+        """
+        各metricの最後のステップの値
+        """
+
+    @abstractmethod
+    def get_params(self, run_id: str) -> Dict[str, str]:
+        ...
+
+    @abstractmethod
+    def get_tags(self, run_id: str) -> Dict[str, str]:
+        ...
+
+
+class MlflowTracker(Tracker):
+    def __init__(
+        self,
+        cache_dir: str = "./mlruns",  # mlflowのデータ保存先 (トラッキングURI)
+        artifact_cache: Optional[ArtifactCache] = None,  # ダウンロードしたartifactのキャッシュ
+    ) -> None:
+        """
+        mlflowのトラッキングストアに記録する
+        """
+        self.cache_dir = cache_dir
+        self.artifact_cache = artifact_cache
+        mlflow.set_tracking_uri(self.cache_dir)
+        self.client = mlflow.tracking.MlflowClient(tracking_uri=self.cache_dir)
+
+    def get_experiment_id(self, exp_name: str) -> str:
+        exp = self.client.get_experiment_by_name(exp_name)
+        if exp is not None:
+            return exp.experiment_id
+        try:
+            return self.client.create_experiment(exp_name)
+        except mlflow.exceptions.MlflowException:
+            # 他のプロセスが同時に同じ実験を作った場合
+            return self.client.get_experiment_by_name(exp_name).experiment_id
+
+    def search_runs(
+        self,
+        exp_id: str,
+        params: Dict[str, Any],
+        max_results: Optional[int] = None,
+        defaults: Optional[Dict[str, Any]] = None,
+    ) -> pd.DataFrame:
+        query = " and ".join([f"param.{k} = '{v}'" for k, v in params.items()] +
+                             ["attributes.status = 'FINISHED'"])
+        if defaults:
+            # 「記録されていない」はフィルタで書けないので取得してから絞り込む
+            df_result = mlflow.search_runs(experiment_ids=[exp_id], filter_string=query)
+            return _filter_by_defaults(df_result, defaults, max_results)
+        kwargs = {} if max_results is None else {"max_results": max_results}
+        return mlflow.search_runs(experiment_ids=[exp_id], filter_string=query, **kwargs)
+
+    @contextmanager
+    def start_run(
+        self,
+        exp_id: str,
+        run_name: Optional[str] = None,
+        tags: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[str]:
+        with mlflow.start_run(experiment_id=exp_id, run_name=run_name, tags=tags) as run:
+            yield run.info.run_id
+
+    def log_params(self, run_id: str, params: Dict[str, Any]) -> None:
+        self.client.log_batch(run_id, params=[Param(k, str(v)) for k, v in params.items()])
+
+    def log_metrics(self, run_id: str, metrics: Dict[str, float], step: int = 0) -> None:
+        timestamp = _now_ms()
+        self.client.log_batch(run_id, metrics=[
+            Metric(k, float(v), timestamp, step) for k, v in metrics.items()
+        ])
+
+    def log_metric_history(self, run_id: str, metrics: List[Metric]) -> None:
+        # log_batchは一度に1000個までしか受け付けないので分割する
+        for i in range(0, len(metrics), MLFLOW_MAX_METRICS_PER_BATCH):
+            self.client.log_batch(run_id, metrics=metrics[i:i + MLFLOW_MAX_METRICS_PER_BATCH])
+
+    def set_tags(self, run_id: str, tags: Dict[str, Any]) -> None:
+        self.client.log_batch(run_id, tags=[RunTag(k, str(v)) for k, v in tags.items()])
+
+    def log_artifact(self, run_id: str, local_path: str) -> None:
+        self.client.log_artifact(run_id, local_path)
+
+    @contextmanager
+    def open_artifact(self, run_id: str, artifact_path: str) -> Iterator[IO[bytes]]:
+        if self.artifact_cache is not None:
+            # トラッキングストアがリモートにある場合はローカルのキャッシュを経由して読み出す
+            with self.artifact_cache.open(self.client, run_id, artifact_path) as f:
+                yield f
+            return
+
+        artifact_uri = self.client.get_run(run_id).info.artifact_uri
+        local_path = Path(self.cache_dir).parent.joinpath(artifact_uri, artifact_path)
+        if not local_path.exists():
+            raise FileNotFoundError(f"{str(local_path)} does not exists!")
+        with local_path.open("rb") as f:
+            yield f
+
+    def get_metric_history(self, run_id: str, key: str) -> List[Metric]:
+        return self.client.get_metric_history(run_id, key)
+
+    def get_latest_metrics(self, run_id: str) -> Dict[str, float]:
+        return self.client.get_run(run_id).data.metrics
+
+    def get_params(self, run_id: str) -> Dict[str, str]:
+        return self.client.get_run(run_id).data.params
+
+    def get_tags(self, run_id: str) -> Dict[str, str]:
+        return self.client.get_run(run_id).data.tags
+
+
+@dataclass
+class _MemoryRun:
+    run_id: str
+    experiment_id: str
+    start_time: int
+    end_time: Optional[int] = None
+    status: str = "RUNNING"
+    params: Dict[str, str] = field(default_factory=dict)
+    tags: Dict[str, str] = field(default_factory=dict)
+    metrics: Dict[str, List[Metric]] = field(default_factory=dict)
+    artifacts: Dict[str, bytes] = field(default_factory=dict)
+
+    def latest_metrics(self) -> Dict[str, float]:
+        # mlflowと同じくステップ、タイムスタンプの順で最後のもの
+        return {
+            key: max(history, key=lambda m: (m.step, m.timestamp)).value
+            for key, history in self.metrics.items()
+        }
+
+
+class InMemoryTracker(Tracker):
+    def __init__(self) -> None:
+        """
+        プロセスのメモリ上に記録する
+        同じインスタンスを使うSimulatorどうしでは過去の結果の検索や延長もできる
+        ディスクに書かないのでテストやパラメータの確認のための試し実行に使う
+        (joblibのプロセス並列では各プロセスにコピーが渡されるので結果は共有されない)
+        """
+        self.experiments: Dict[str, str] = {}
+        self.runs: Dict[str, _MemoryRun] = {}
+
+    def get_experiment_id(self, exp_name: str) -> str:
+        if exp_name not in self.experiments:
+            self.experiments[exp_name] = str(len(self.experiments))
+        return self.experiments[exp_name]
+
+    def search_runs(
+        self,
+        exp_id: str,
+        params: Dict[str, Any],
+        max_results: Optional[int] = None,
+        defaults: Optional[Dict[str, Any]] = None,
+    ) -> pd.DataFrame:
+        rows = []
+        for run in reversed(list(self.runs.values())):
+            if run.experiment_id != exp_id or run.status != "FINISHED":
+                continue
+            if any(run.params.get(k) != str(v) for k, v in params.items()):
+                continue
+            if any(run.params.get(k, str(v)) != str(v) for k, v in (defaults or {}).items()):
+                continue
+            rows.append({
+                "run_id": run.run_id,
+                "experiment_id": run.experiment_id,
+                "status": run.status,
+                "artifact_uri": f"memory://{run.run_id}",
+                "start_time": run.start_time,
+                "end_time": run.end_time,
+                **{f"metrics.{k}": v for k, v in run.latest_metrics().items()},
+                **{f"params.{k}": v for k, v in run.params.items()},
+                **{f"tags.{k}": v for k, v in run.tags.items()},
+            })
+            if max_results is not None and len(rows) >= max_results:
+                break
+        return pd.DataFrame(rows)
+
+    @contextmanager
+    def start_run(
+        self,
+        exp_id: str,
+        run_name: Optional[str] = None,
+        tags: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[str]:
+        run = _MemoryRun(run_id=uuid.uuid4().hex, experiment_id=exp_id, start_time=_now_ms())
+        self.runs[run.run_id] = run
+        if run_name is not None:
+            run.tags["mlflow.runName"] = run_name
+        self.set_tags(run.run_id, tags or {})
+        try:
+            yield run.run_id
+        except BaseException:
+            run.status = "FAILED"
+            raise
+        else:
+            run.status = "FINISHED"
+        finally:
+            run.end_time = _now_ms()
+
+    def log_params(self, run_id: str, params: Dict[str, Any]) -> None:
+        self.runs[run_id].params.update({k: str(v) for k, v in params.items()})
+
+    def log_metrics(self, run_id: str, metrics: Dict[str, float], step: int = 0) -> None:
+        timestamp = _now_ms()
+        self.log_metric_history(run_id, [
+            Metric(k, float(v), timestamp, step) for k, v in metrics.items()
+        ])
+
+    def log_metric_history(self, run_id: str, metrics: List[Metric]) -> None:
+        run_metrics = self.runs[run_id].metrics
+        for metric in metrics:
+            run_metrics.setdefault(metric.key, []).append(metric)
+
+    def set_tags(self, run_id: str, tags: Dict[str, Any]) -> None:
+        self.runs[run_id].tags.update({k: str(v) for k, v in tags.items()})
+
+    def log_artifact(self, run_id: str, local_path: str) -> None:
+        path = Path(local_path)
+        self.runs[run_id].artifacts[path.name] = path.read_bytes()
+
+    def log_array(self, run_id: str, name: str, array: np.ndarray) -> None:
+        # 一時ファイルを経由せずにメモリ上でシリアライズする
+        buffer = io.BytesIO()
+        np.save(buffer, array)
+        self.runs[run_id].artifacts[name] = buffer.getvalue()
+
+    @contextmanager
+    def open_artifact(self, run_id: str, artifact_path: str) -> Iterator[IO[bytes]]:
+        artifacts = self.runs[run_id].artifacts
+        if artifact_path not in artifacts:
+            raise FileNotFoundError(f"{artifact_path} does not exists in Run {run_id}!")
+        yield io.BytesIO(artifacts[artifact_path])
+
+    def get_metric_history(self, run_id: str, key: str) -> List[Metric]:
+        return list(self.runs[run_id].metrics.get(key, []))
+
+    def get_latest_metrics(self, run_id: str) -> Dict[str, float]:
+        return self.runs[run_id].latest_metrics()
+
+    def get_params(self, run_id: str) -> Dict[str, str]:
+        return dict(self.runs[run_id].params)
+
+    def get_tags(self, run_id: str) -> Dict[str, str]:
+        return dict(self.runs[run_id].tags)
+
+
+class NoOpTracker(Tracker):
+    """
+    何も記録しない
+    過去の結果は常に見つからないので、パラメータの確認や計算時間の見積もりのための空実行に使う
+    """
+
+    def get_experiment_id(self, exp_name: str) -> str:
+        return "0"
+
+    def search_runs(
+        self,
+        exp_id: str,
+        params: Dict[str, Any],
+        max_results: Optional[int] = None,
+        defaults: Optional[Dict[str, Any]] = None,
+    ) -> pd.DataFrame:
+        return pd.DataFrame({"run_id": []})
+
+    @contextmanager
+    def start_run(
+        self,
+        exp_id: str,
+        run_name: Optional[str] = None,
+        tags: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[str]:
+        yield uuid.uuid4().hex
+
+    def log_params(self, run_id: str, params: Dict[str, Any]) -> None:
+        pass
+
+    def log_metrics(self, run_id: str, metrics: Dict[str, float], step: int = 0) -> None:
+        pass
+
+    def log_metric_history(self, run_id: str, metrics: List[Metric]) -> None:
+        pass
+
+    def set_tags(self, run_id: str, tags: Dict[str, Any]) -> None:
+        pass
+
+    def log_artifact(self, run_id: str, local_path: str) -> None:
+        pass
+
+    def log_array(self, run_id: str, name: str, array: np.ndarray) -> None:
+        # 保存しないのでシリアライズもしない
+        pass
+
+    def open_artifact(self, run_id: str, artifact_path: str) -> ContextManager[IO[bytes]]:
+        raise FileNotFoundError(f"NoOpTracker does not keep artifacts ({artifact_path})")
+
+    def get_metric_history(self, run_id: str, key: str) -> List[Metric]:
+        return []
+
+    def get_latest_metrics(self, run_id: str) -> Dict[str, float]:
+        return {}
+
+    def get_params(self, run_id: str) -> Dict[str, str]:
+        return {}
+
+    def get_tags(self, run_id: str) -> Dict[str, str]:
+        return {}
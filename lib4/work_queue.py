@@ -0,0 +1,349 @@
+"""
+共有ファイルシステム上のリースファイルを使った複数ホストでのパラメータスイープ
+"""
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from dataclasses import asdict
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import mlflow
+from flatten_dict import flatten
+
+from .monitor import SweepEventLog, SweepMonitor, run_monitored
+from .simulator import ParamSimulator, Simulator
+from .tracker import Tracker, get_auxiliary_path
+
+# 実験の作成に使うキー (パラメータのキーはsha1なので重ならない)
+EXPERIMENT_KEY = "experiment"
+# スイープの集計の記録に使うキーの接頭辞 (後ろにスイープのIDをつける)
+REPORT_KEY_PREFIX = "report-"
+
+
+def get_param_key(param: ParamSimulator) -> str:
+    """
+    パラメータから作業キューのキーを作る (パラメータが同じなら同じキーになる)
+    """
+    params_flat = flatten(asdict(param), reducer="dot")
+    text = json.dumps({k: str(v) for k, v in params_flat.items()}, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def get_sweep_id(params: List[ParamSimulator]) -> str:
+    """
+    スイープするパラメータの集合からスイープのIDを作る
+    全ワーカーに同じパラメータを渡すので、ワーカー同士で相談しなくても同じIDになる
+    """
+    keys = sorted(get_param_key(param) for param in params)
+    return hashlib.sha1("\n".join(keys).encode()).hexdigest()
+
+
+def get_event_log(queue_dir: str, params: List[ParamSimulator]) -> SweepEventLog:
+    """
+    スイープの各Runの開始と結果を記録するファイル
+    以前のスイープのイベントと混ざらないように、スイープごとに別のファイルにする
+    """
+    return SweepEventLog(str(Path(queue_dir).joinpath(f"events-{get_sweep_id(params)}.jsonl")))
+
+
+class LeaseLostError(RuntimeError):
+    """
+    計算中にリースの期限が切れて、他のワーカーに奪われた
+    """
+
+
+class LeaseQueue:
+    def __init__(
+        self,
+        queue_dir: str,  # リースファイルの保存先 (全てのワーカーから見える共有ディレクトリ)
+        lease_seconds: float = 60.,  # 更新されないリースが期限切れになるまでの秒数
+        worker_id: Optional[str] = None,  # リースの持ち主の名前
+    ) -> None:
+        """
+        キーごとに<key>.leaseと<key>.doneのファイルで作業の状態を管理する
+
+        リースはO_EXCLでファイルを作ることで取得するので、同時に1つのワーカーしか取得できない。
+        持ち主はlease_secondsより短い間隔でファイルの更新時刻を新しくし続ける。
+        更新されなくなったリースは(ワーカーが落ちたとみなして)他のワーカーが奪って計算し直す。
+        ホスト間の時計は大きくずれていないことを前提にしている。
+        """
+        self.queue_dir = Path(queue_dir)
+        self.queue_dir.mkdir(parents=True, exist_ok=True)
+        self.lease_seconds = lease_seconds
+        if worker_id is None:
+            worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.worker_id = worker_id
+        self.tokens: Dict[str, str] = {}
+
+    def _lease_path(self, key: str) -> Path:
+        return self.queue_dir.joinpath(f"{key}.lease")
+
+    def _done_path(self, key: str) -> Path:
+        return self.queue_dir.joinpath(f"{key}.done")
+
+    def is_done(self, key: str) -> bool:
+        return self._done_path(key).exists()
+
+    def is_leased(self, key: str) -> bool:
+        """
+        期限切れでないリースがあるか
+        """
+        try:
+            return time.time() - self._lease_path(key).stat().st_mtime <= self.lease_seconds
+        except FileNotFoundError:
+            return False
+
+    def _create_lease(self, key: str) -> bool:
+        # 同じworker_idでも取得したリースごとに区別できるようにする
+        token = f"{self.worker_id}-{uuid.uuid4().hex}"
+        try:
+            fd = os.open(str(self._lease_path(key)), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(token)
+        self.tokens[key] = token
+        return True
+
+    def _break_expired_lease(self, key: str) -> None:
+        """
+        期限切れのリースを削除する
+        複数のワーカーが同時に削除しようとしても、renameできるのは1つだけ
+        """
+        lease_path = self._lease_path(key)
+        try:
+            stat = lease_path.stat()
+        except FileNotFoundError:
+            return
+        if time.time() - stat.st_mtime <= self.lease_seconds:
+            return
+        expired_path = self.queue_dir.joinpath(f".{key}.{uuid.uuid4().hex}.expired")
+        try:
+            os.rename(lease_path, expired_path)
+        except FileNotFoundError:
+            return
+        if time.time() - expired_path.stat().st_mtime > self.lease_seconds:
+            expired_path.unlink()
+            return
+        # 確認してからrenameするまでの間に他のワーカーが新しいリースを取っていたので戻す
+        try:
+            os.link(expired_path, lease_path)
+        except FileExistsError:
+            pass
+        expired_path.unlink()
+
+    def claim(self, key: str) -> bool:
+        """
+        リースの取得を試みる
+
+        Returns
+        -------
+        claimed: bool
+            取得できたらTrue。すでに終わっているか、他のワーカーが計算中ならFalse
+        """
+        if self.is_done(key):
+            return False
+        if self._create_lease(key):
+            # リースを取る直前に他のワーカーが終わらせていた場合
+            if self.is_done(key):
+                self.release(key)
+                return False
+            return True
+        self._break_expired_lease(key)
+        return self._create_lease(key)
+
+    def owns(self, key: str) -> bool:
+        """
+        自分が取得したリースがまだ有効か
+        """
+        try:
+            return self._lease_path(key).read_text() == self.tokens.get(key)
+        except FileNotFoundError:
+            return False
+
+    def renew(self, key: str) -> bool:
+        """
+        リースの期限を延長する
+
+        Returns
+        -------
+        renewed: bool
+            リースを失っていたらFalse
+        """
+        if not self.owns(key):
+            return False
+        os.utime(self._lease_path(key))
+        return True
+
+    def complete(self, key: str) -> None:
+        """
+        作業が終わったことを記録してリースを解放する
+        """
+        self._done_path(key).touch()
+        self.release(key)
+
+    def release(self, key: str) -> None:
+        """
+        リースを解放する (他のワーカーが取得できるようになる)
+        """
+        if self.owns(key):
+            self._lease_path(key).unlink()
+        self.tokens.pop(key, None)
+
+
+class LeaseRenewer:
+    def __init__(self, queue: LeaseQueue, key: str) -> None:
+        """
+        with文の中にいる間、バックグラウンドのスレッドでリースを更新し続ける
+        """
+        self.queue = queue
+        self.key = key
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.queue.lease_seconds / 3):
+            if not self.queue.renew(self.key):
+                self.lost = True
+                return
+
+    def __enter__(self) -> "LeaseRenewer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def _check_lease(queue: LeaseQueue, key: str) -> None:
+    """
+    Runを終了する直前にリースを延長する
+    延長できればRunを終了するまでの間に他のワーカーに奪われることはない
+    """
+    if not queue.renew(key):
+        raise LeaseLostError(f"Lease for {key} expired while running")
+
+
+def run_sweep_worker(
+    exp_name: str,  # mlflowの実験の名前
+    params: List[ParamSimulator],  # スイープするパラメータ (全ワーカーで同じものを渡す)
+    cache_dir: str = "./mlruns",  # mlflowのデータ保存先 (全ワーカーから見える共有ディレクトリ)
+    queue_dir: Optional[str] = None,  # リースファイルの保存先
+    lease_seconds: float = 60.,  # 更新されないリースが期限切れになるまでの秒数
+    poll_seconds: float = 1.,  # 他のワーカーの終了を待つときの間隔
+    worker_id: Optional[str] = None,
+    simulator_kwargs: Optional[Dict[str, Any]] = None,  # Simulatorに渡すその他の引数
+    report_exp_name: Optional[str] = None,  # スイープの集計を記録する実験の名前
+    report_tracker: Optional[Tracker] = None,  # スイープの集計の記録先
+    report_params: Optional[Dict[str, Any]] = None,  # スイープの集計と一緒に記録するパラメータ
+) -> int:
+    """
+    作業キューからパラメータを1つずつ取得して計算するワーカー
+    複数のホストで同時に実行しても、各パラメータはどれか1つのワーカーでだけ計算される
+    (計算中にリースを奪われたワーカーのRunはFINISHEDにせずにFAILEDで終える)
+    全てのパラメータが終わるまで(他のワーカーが計算中のものも含めて)戻らない
+    各Runの開始と結果はget_event_log()のファイルに記録するので、SweepMonitorで進捗を集計できる
+    report_exp_nameを指定すると、全て終わった後に最初にそれに気づいたワーカーだけが
+    スイープの集計をreport_trackerに記録する
+
+    Returns
+    -------
+    n_run: int
+        このワーカーが計算したパラメータの数
+    """
+    if report_exp_name is not None and report_tracker is None:
+        raise ValueError("report_tracker should be given to record the report")
+    if queue_dir is None:
+        queue_dir = get_auxiliary_path(cache_dir, "queue", exp_name)
+    if simulator_kwargs is None:
+        simulator_kwargs = {}
+    queue = LeaseQueue(queue_dir, lease_seconds=lease_seconds, worker_id=worker_id)
+    event_log = get_event_log(queue_dir, params)
+    keys = [get_param_key(param) for param in params]
+
+    # mlflowのファイルストアは同時に実験を作ると壊れるので、1つのワーカーだけが作る
+    while not queue.is_done(EXPERIMENT_KEY):
+        if queue.claim(EXPERIMENT_KEY):
+            try:
+                mlflow_client = mlflow.tracking.MlflowClient(tracking_uri=cache_dir)
+                if mlflow_client.get_experiment_by_name(exp_name) is None:
+                    mlflow_client.create_experiment(exp_name)
+                queue.complete(EXPERIMENT_KEY)
+            finally:
+                queue.release(EXPERIMENT_KEY)
+        else:
+            time.sleep(poll_seconds)
+
+    n_run = 0
+    while True:
+        remaining = False
+        for key, param in zip(keys, params):
+            if queue.is_done(key):
+                continue
+            if not queue.claim(key):
+                remaining = remaining or not queue.is_done(key)
+                continue
+            try:
+                with LeaseRenewer(queue, key):
+                    sim = Simulator(exp_name, param, cache_dir=cache_dir, **simulator_kwargs)
+                    # 過去の結果を検索している間にリースを失っていたら、奪ったワーカーに任せる
+                    if not queue.owns(key):
+                        remaining = True
+                        continue
+                    computed = not sim.done
+                    run_monitored(
+                        sim, event_log, key, before_finish=lambda: _check_lease(queue, key))
+                # 以前のスイープなどですでに計算済みなら記録だけする
+                if computed:
+                    n_run += 1
+                if queue.owns(key):
+                    queue.complete(key)
+                else:
+                    # Runを終了した後で奪われた場合は、奪ったワーカーがこのRunを見つけて完了にする
+                    remaining = True
+            except LeaseLostError as e:
+                # 奪ったワーカーが計算し直すので、このRunはFAILEDのままにして完了にしない
+                print(e)
+                remaining = True
+            finally:
+                queue.release(key)
+        if not remaining:
+            break
+        time.sleep(poll_seconds)
+
+    if report_exp_name is not None:
+        _write_report(
+            queue, SweepMonitor(event_log, len(params)), get_sweep_id(params),
+            report_tracker, report_exp_name, report_params,
+        )
+    return n_run
+
+
+def _write_report(
+    queue: LeaseQueue,
+    monitor: SweepMonitor,
+    sweep_id: str,
+    tracker: Tracker,
+    exp_name: str,
+    params: Optional[Dict[str, Any]],
+) -> None:
+    """
+    全てのパラメータが終わった後に、スイープの集計を1つのワーカーだけが記録する
+    同じスイープをもう一度実行しても、記録済みなら何もしない
+    """
+    key = f"{REPORT_KEY_PREFIX}{sweep_id}"
+    if not queue.claim(key):
+        return
+    try:
+        with LeaseRenewer(queue, key):
+            monitor.write_report(tracker, exp_name, {"sweep_id": sweep_id, **(params or {})})
+        queue.complete(key)
+    finally:
+        queue.release(key)
@@ -5,28 +5,47 @@ Overview:
 
 Usage:
     simulation.py [<num_cpus>]
+    simulation.py worker
+    simulation.py adaptive [<num_cpus>]
+    simulation.py dryrun
 
 Options:
     num_cpus    : 並列数（Default: CPU数)
+    worker      : mlrunsと同じ場所の作業キューから1つずつ取得して計算する
+                  mlrunsを共有している複数のホストで同時に実行できる
+                  全て終わると1つのワーカーだけがスイープの集計をsim4_sweepsに記録する
+    adaptive    : N_seedで固定せずに、最終状態の平均の信頼区間の半幅が
+                  target_half_width以下になるまで(x0, sigma)ごとにシードを追加する
+    dryrun      : mlflowに記録せずに全てのパラメータを1度ずつ計算する (パラメータの確認用)
 """
 import sys
 from pathlib import Path
 
 from joblib import Parallel, cpu_count, delayed
 
+from lib4.adaptive import run_adaptive_sweep
 from lib4.brownian_motion import ParamBrownianMotion
+from lib4.monitor import SweepEventLog, SweepMonitor, run_monitored
 from lib4.simulator import ParamSimulator, Simulator
+from lib4.tracker import MlflowTracker, NoOpTracker, get_auxiliary_path
+from lib4.work_queue import get_event_log, get_param_key, run_sweep_worker
 
 N_seed = 5
 x0s = [1.0, -1.0]
 sigmas = [0.1, 0.2]
+# adaptiveのときの目標の精度とシード数の上限
+target_half_width = 1.0
+max_seeds = 100
+# このファイルがある場所にmlrunsディレクトリをつくる
+#   この指定をするとnotebookからimportしたときにも同じmlrunsを参照できる
+cache_dir = str(Path(__file__).parent.joinpath("mlruns"))
 
 
-def get_simulator(
+def get_param(
     seed: int, x0: float, sigma: float
-) -> Simulator:
+) -> ParamSimulator:
     """
-    Simulatorクラスのインスタンスを作成する
+    シミュレーションのパラメータを作成する
 
     Parameters
     ----------
@@ -36,9 +55,9 @@ def get_simulator(
 
     Returns
     -------
-    sim: Simulator
+    param: ParamSimulator
     """
-    param = ParamSimulator(
+    return ParamSimulator(
         total_step=500,
         record_per=10,
         save_full_traj=True,
@@ -46,33 +65,90 @@ def get_simulator(
             seed=seed, initial_state=x0, sigma=sigma
         )
     )
+
+
+def get_simulator(
+    seed: int, x0: float, sigma: float
+) -> Simulator:
+    """
+    Simulatorクラスのインスタンスを作成する
+
+    Parameters
+    ----------
+    seed: int
+    x0: int
+    sigma: float
+
+    Returns
+    -------
+    sim: Simulator
+    """
     sim = Simulator(
         exp_name="sim4",
-        param=param,
-        # このファイルがある場所にmlrunsディレクトリをつくる
-        #   この指定をするとnotebookからimportしたときにも同じmlrunsを参照できる
-        cache_dir=str(Path(__file__).parent.joinpath("mlruns"))
+        param=get_param(seed, x0, sigma),
+        cache_dir=cache_dir,
     )
     return sim
 
 
-def process(*args, **kwargs) -> None:
+def process(seed: int, x0: float, sigma: float, event_log: SweepEventLog) -> None:
     """
-    シミュレーターを実行するだけの関数
+    シミュレーターを実行して、進捗をevent_logに記録する関数
     """
-    sim = get_simulator(*args, **kwargs)
-    sim.run()
+    sim = get_simulator(seed, x0, sigma)
+    run_monitored(sim, event_log, get_param_key(get_param(seed, x0, sigma)))
 
 
 if __name__ == "__main__":
+    points = [(seed, x0, sigma) for seed in range(N_seed) for x0 in x0s for sigma in sigmas]
+    if len(sys.argv) == 2 and sys.argv[1] == "worker":
+        # 全ワーカーの進捗はキューのディレクトリのこのスイープのイベントから集計する
+        queue_dir = get_auxiliary_path(cache_dir, "queue", "sim4")
+        params = [get_param(seed, x0, sigma) for seed, x0, sigma in points]
+        with SweepMonitor(get_event_log(queue_dir, params), len(points)):
+            # スイープの集計は最初に全て終わったことに気づいたワーカーが記録する
+            run_sweep_worker(
+                "sim4", params, cache_dir=cache_dir, queue_dir=queue_dir,
+                report_exp_name="sim4_sweeps", report_tracker=MlflowTracker(cache_dir),
+            )
+        sys.exit()
+
+    if len(sys.argv) == 2 and sys.argv[1] == "dryrun":
+        for seed, x0, sigma in points:
+            Simulator("sim4", get_param(seed, x0, sigma), tracker=NoOpTracker()).run()
+        sys.exit()
+
+    # mlflowのファイルストアは同時に実験を作ると壊れるので、並列に実行する前に作っておく
+    tracker = MlflowTracker(cache_dir)
+    tracker.get_experiment_id("sim4")
+
+    if len(sys.argv) >= 2 and sys.argv[1] == "adaptive":
+        n_cpus = int(sys.argv[2]) if len(sys.argv) == 3 else cpu_count()
+        results = run_adaptive_sweep(
+            [{"x0": x0, "sigma": sigma} for x0 in x0s for sigma in sigmas],
+            get_simulator,
+            target_half_width=target_half_width,
+            max_seeds=max_seeds,
+            n_jobs=n_cpus,
+            record_exp_name="sim4_adaptive",
+            record_tracker=tracker,
+        )
+        for result in results:
+            print(f"{result.point}: {len(result.seeds)} seeds, "
+                  f"mean={result.mean:.3f} +/- {result.half_width:.3f}")
+        sys.exit()
+
     if len(sys.argv) == 2:
         n_cpus = int(sys.argv[1])
     else:
         n_cpus = cpu_count()
 
-    Parallel(n_jobs=n_cpus)([
-        delayed(process)(seed, x0, sigma)
-        for seed in range(N_seed)
-        for x0 in x0s
-        for sigma in sigmas
-    ])
+    event_log = SweepEventLog(get_auxiliary_path(cache_dir, "monitor", "sim4.jsonl"))
+    event_log.clear()
+    with SweepMonitor(event_log, len(points)) as monitor:
+        Parallel(n_jobs=n_cpus)([
+            delayed(process)(seed, x0, sigma, event_log)
+            for seed, x0, sigma in points
+        ])
+    # スイープの集計(計算済みでスキップした数を含む)を別の実験に記録する
+    monitor.write_report(tracker, "sim4_sweeps", {"n_jobs": n_cpus})
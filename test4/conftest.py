@@ -0,0 +1,56 @@
+import tempfile
+from dataclasses import fields
+from pathlib import Path
+from typing import Any
+
+import pytest
+from lib4.brownian_motion import ParamBrownianMotion
+from lib4.simulator import ParamSimulator, Simulator
+from lib4.tracker import InMemoryTracker
+
+
+@pytest.fixture
+def tmp_dir():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        yield Path(tmp_dir)
+
+
+@pytest.fixture
+def mlflow_cache_dir(tmp_dir):
+    yield str(tmp_dir.joinpath("mlruns"))
+
+
+@pytest.fixture
+def memory_tracker():
+    return InMemoryTracker()
+
+
+@pytest.fixture
+def param_brownian_motion():
+    return ParamBrownianMotion(
+        seed=123, initial_state=0., sigma=1.
+    )
+
+
+@pytest.fixture
+def make_simulator(memory_tracker, param_brownian_motion):
+    """
+    テスト用のSimulatorを作る関数
+    キーワード引数のうちParamSimulatorのフィールドはパラメータに、それ以外はSimulatorに渡す
+    param_bmを省略するとparam_brownian_motion、trackerもcache_dirも省略するとmemory_trackerを使う
+    """
+    param_keys = {field.name for field in fields(ParamSimulator)}
+
+    def make_simulator(exp_name: str = "test", **kwargs: Any) -> Simulator:
+        param_kwargs = {"param_bm": param_brownian_motion}
+        simulator_kwargs = {}
+        for key, value in kwargs.items():
+            if key in param_keys:
+                param_kwargs[key] = value
+            else:
+                simulator_kwargs[key] = value
+        if "tracker" not in simulator_kwargs and "cache_dir" not in simulator_kwargs:
+            simulator_kwargs["tracker"] = memory_tracker
+        return Simulator(exp_name, ParamSimulator(**param_kwargs), **simulator_kwargs)
+
+    return make_simulator
@@ -0,0 +1,104 @@
+import mlflow
+import numpy as np
+import pytest
+from lib4.adaptive import AdaptivePointResult, run_adaptive_sweep
+from lib4.brownian_motion import ParamBrownianMotion
+from lib4.simulator import ParamSimulator, Simulator
+from lib4.tracker import MlflowTracker
+
+
+class SimulatorFactory:
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+
+    def __call__(self, seed: int, x0: float, sigma: float) -> Simulator:
+        return Simulator(
+            exp_name="test",
+            param=ParamSimulator(
+                total_step=20,
+                record_per=10,
+                save_full_traj=False,
+                param_bm=ParamBrownianMotion(seed=seed, initial_state=x0, sigma=sigma),
+            ),
+            cache_dir=self.cache_dir,
+        )
+
+
+class TestAdaptiveSweep:
+    def test_point_result_update(self):
+        result = AdaptivePointResult(point={}, values=[1.])
+        result.update(0.95)
+        assert result.mean == 1.
+        assert result.half_width == np.inf
+
+        result = AdaptivePointResult(point={}, values=[1., 3.])
+        result.update(0.95)
+        assert result.mean == 2.
+        # t_{0.975}(1) = 12.706..., s = sqrt(2)
+        assert np.isclose(result.half_width, 12.7062047 * np.sqrt(2) / np.sqrt(2))
+
+    def test_invalid_initial_seeds_fail(self, mlflow_cache_dir):
+        with pytest.raises(ValueError):
+            run_adaptive_sweep([], SimulatorFactory(mlflow_cache_dir), 1., initial_seeds=1)
+
+    def test_record_without_tracker_fail(self, mlflow_cache_dir):
+        with pytest.raises(ValueError):
+            run_adaptive_sweep(
+                [], SimulatorFactory(mlflow_cache_dir), 1., record_exp_name="test_adaptive")
+
+    def test_adaptive_sweep(self, mlflow_cache_dir):
+        get_simulator = SimulatorFactory(mlflow_cache_dir)
+        points = [{"x0": 0., "sigma": 0.1}, {"x0": 0., "sigma": 1.}]
+        target_half_width = 1.5
+        max_seeds = 60
+        results = run_adaptive_sweep(
+            points, get_simulator, target_half_width,
+            initial_seeds=3, seeds_per_round=4, max_seeds=max_seeds,
+            record_exp_name="test_adaptive",
+            record_tracker=MlflowTracker(mlflow_cache_dir),
+        )
+        assert [result.point for result in results] == points
+        for result in results:
+            assert result.converged
+            assert result.half_width <= target_half_width
+            assert result.seeds == list(range(len(result.seeds)))
+        # 分散の小さい点は最初のラウンドで終わり、大きい点ではシードを追加する
+        assert len(results[0].seeds) == 3
+        assert 3 < len(results[1].seeds) < max_seeds
+        # 全ての点で同じシード数を使うより少ない
+        assert sum(len(result.seeds) for result in results) < len(results[1].seeds) * len(points)
+
+        # 統計量はRunに記録された最終状態
+        sim = get_simulator(seed=0, **points[1])
+        assert sim.done
+        assert results[1].values[0] == sim.get_metric_history()[-1].value
+
+        # 使ったシードが記録されている
+        client = mlflow.tracking.MlflowClient(tracking_uri=mlflow_cache_dir)
+        exp = client.get_experiment_by_name("test_adaptive")
+        runs = client.search_runs([exp.experiment_id], "params.sigma = '1.0'")
+        assert len(runs) == 1
+        assert runs[0].data.tags["seeds"] == ",".join(str(seed) for seed in results[1].seeds)
+        assert runs[0].data.metrics["n_seeds"] == len(results[1].seeds)
+
+    def test_max_seeds(self, mlflow_cache_dir):
+        results = run_adaptive_sweep(
+            [{"x0": 0., "sigma": 1.}], SimulatorFactory(mlflow_cache_dir), 1e-3,
+            initial_seeds=3, seeds_per_round=3, max_seeds=7,
+        )
+        assert not results[0].converged
+        assert results[0].seeds == list(range(7))
+
+    def test_reuse_previous_runs(self, mlflow_cache_dir):
+        """
+        2回目のスイープでは計算済みのRunを再利用する
+        """
+        points = [{"x0": 1., "sigma": 0.5}]
+        results1 = run_adaptive_sweep(
+            points, SimulatorFactory(mlflow_cache_dir), 1.)
+        results2 = run_adaptive_sweep(
+            points, SimulatorFactory(mlflow_cache_dir), 1.)
+        assert results1[0].values == results2[0].values
+        client = mlflow.tracking.MlflowClient(tracking_uri=mlflow_cache_dir)
+        exp = client.get_experiment_by_name("test")
+        assert len(client.search_runs([exp.experiment_id])) == len(results1[0].seeds)
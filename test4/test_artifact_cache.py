@@ -0,0 +1,127 @@
+import multiprocessing
+from pathlib import Path
+
+import numpy as np
+import pytest
+from lib4.artifact_cache import ArtifactCache
+from lib4.brownian_motion import ParamBrownianMotion
+from lib4.simulator import ParamSimulator, Simulator
+
+
+class LocalArtifactServer:
+    """
+    ディレクトリをartifactサーバーに見立てたもの
+    ダウンロード回数を数える
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.n_download = 0
+
+    def put(self, run_id: str, artifact_path: str, data: bytes) -> None:
+        path = self.root.joinpath(run_id, artifact_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+    def download_artifacts(self, run_id: str, path: str, dst_path: str) -> str:
+        self.n_download += 1
+        local_path = Path(dst_path).joinpath(path)
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        local_path.write_bytes(self.root.joinpath(run_id, path).read_bytes())
+        return str(local_path)
+
+
+@pytest.fixture
+def server(tmp_dir):
+    server = LocalArtifactServer(tmp_dir.joinpath("server"))
+    for i in range(4):
+        server.put(f"run{i}", "data.bin", bytes([i]) * 100)
+    return server
+
+
+def read_in_other_process(cache_dir: str, server_root: str, run_id: str) -> bytes:
+    cache = ArtifactCache(cache_dir)
+    with cache.open(LocalArtifactServer(Path(server_root)), run_id, "data.bin") as f:
+        return f.read()
+
+
+class TestArtifactCache:
+    def test_negative_max_bytes_fail(self, tmp_dir):
+        with pytest.raises(ValueError):
+            ArtifactCache(str(tmp_dir.joinpath("cache")), max_bytes=-1)
+
+    def test_hit_and_miss(self, tmp_dir, server):
+        cache = ArtifactCache(str(tmp_dir.joinpath("cache")))
+        with cache.open(server, "run0", "data.bin") as f:
+            assert f.read() == bytes([0]) * 100
+        assert (cache.hits, cache.misses) == (0, 1)
+
+        with cache.open(server, "run0", "data.bin") as f:
+            assert f.read() == bytes([0]) * 100
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert server.n_download == 1
+
+        # 別のインスタンスからでもディスク上のキャッシュを使う
+        cache2 = ArtifactCache(str(tmp_dir.joinpath("cache")))
+        with cache2.open(server, "run0", "data.bin") as f:
+            assert f.read() == bytes([0]) * 100
+        assert (cache2.hits, cache2.misses) == (1, 0)
+        assert server.n_download == 1
+
+    def test_lru_eviction(self, tmp_dir, server):
+        cache = ArtifactCache(str(tmp_dir.joinpath("cache")), max_bytes=250)
+        for run_id in ["run0", "run1"]:
+            with cache.open(server, run_id, "data.bin"):
+                pass
+        # run0を使ったのでrun1のほうが古くなる
+        with cache.open(server, "run0", "data.bin"):
+            pass
+        # 3つめを追加すると容量を超えるので一番古いrun1が消える
+        with cache.open(server, "run2", "data.bin"):
+            pass
+        assert server.n_download == 3
+
+        with cache.open(server, "run0", "data.bin"):
+            pass
+        assert server.n_download == 3
+        with cache.open(server, "run1", "data.bin"):
+            pass
+        assert server.n_download == 4
+
+    def test_clear(self, tmp_dir, server):
+        cache = ArtifactCache(str(tmp_dir.joinpath("cache")))
+        with cache.open(server, "run0", "data.bin"):
+            pass
+        cache.clear()
+        with cache.open(server, "run0", "data.bin"):
+            pass
+        assert server.n_download == 2
+
+    def test_multiprocess_read(self, tmp_dir, server):
+        cache_dir = str(tmp_dir.joinpath("cache"))
+        args = [(cache_dir, str(server.root), f"run{i % 4}") for i in range(16)]
+        with multiprocessing.Pool(4) as pool:
+            results = pool.starmap(read_in_other_process, args)
+        for (_, _, run_id), data in zip(args, results):
+            assert data == bytes([int(run_id[-1])]) * 100
+
+    def test_simulator_get_state_trajectory(self, tmp_dir):
+        cache_dir = str(tmp_dir.joinpath("mlruns"))
+        param = ParamSimulator(
+            total_step=100,
+            record_per=10,
+            save_full_traj=True,
+            param_bm=ParamBrownianMotion(seed=123, initial_state=0., sigma=1.),
+        )
+        sim1 = Simulator(exp_name="test", param=param, cache_dir=cache_dir)
+        sim1.run()
+
+        artifact_cache = ArtifactCache(str(tmp_dir.joinpath("artifact_cache")))
+        for i in range(3):
+            sim = Simulator(
+                exp_name="test", param=param, cache_dir=cache_dir,
+                artifact_cache=artifact_cache,
+            )
+            assert sim.done
+            assert np.array_equal(sim.get_state_trajectory(), sim1.get_state_trajectory())
+        assert (artifact_cache.hits, artifact_cache.misses) == (2, 1)
@@ -1,6 +1,6 @@
 import numpy as np
 import pytest
-from lib4.brownian_motion import BrownianMotion, ParamBrownianMotion
+from lib4.brownian_motion import BrownianMotion, ParamBrownianMotion, float32_error_bound
 
 CORRECT_DATASET = [
     # (seed, initial_state, sigma, state_trajectory)
@@ -123,3 +123,174 @@ class TestBrownianMotion:
             bm2.step()
 
         assert np.allclose(bm1.state - bm2.state, init1 - init2)
+
+    @pytest.mark.parametrize("seed, initial_state, sigma, state_trajectory", CORRECT_DATASET)
+    def test_steps(self, seed, initial_state, sigma, state_trajectory):
+        bm = BrownianMotion(
+            param=ParamBrownianMotion(
+                seed=seed,
+                initial_state=initial_state,
+                sigma=sigma
+            ),
+            save_full_trajectory=True,
+            total_step=state_trajectory.shape[0] - 1
+        )
+        states = bm.steps(state_trajectory.shape[0] - 1)
+        assert np.allclose(states, state_trajectory[1:])
+        assert np.allclose(bm.state_trajectory, state_trajectory)
+
+    @pytest.mark.parametrize("seed", [123, 456])
+    def test_steps_bitwise_equal_to_step(self, seed):
+        """
+        まとめて時間発展させても1stepずつ時間発展させたときとビット単位で一致する
+        """
+        param = ParamBrownianMotion(seed=seed, initial_state=0.3, sigma=2.0)
+        bm1 = BrownianMotion(param, save_full_trajectory=True, total_step=1000)
+        for i in range(1000):
+            bm1.step()
+
+        bm2 = BrownianMotion(param, save_full_trajectory=True, total_step=1000)
+        bm2.steps(400)
+        bm2.steps(600)
+        assert np.array_equal(bm1.state_trajectory, bm2.state_trajectory)
+        assert bm1.state == bm2.state
+
+    @pytest.mark.parametrize("seed", [123, 456])
+    def test_restore(self, seed):
+        param = ParamBrownianMotion(seed=seed, initial_state=0.3, sigma=2.0)
+        bm1 = BrownianMotion(param, save_full_trajectory=True, total_step=100)
+        bm1.steps(40)
+        state, rng_state = bm1.state, bm1.get_rng_state()
+        trajectory = bm1.state_trajectory[:41].copy()
+        bm1.steps(60)
+
+        bm2 = BrownianMotion(param, save_full_trajectory=True, total_step=100)
+        bm2.restore(state, rng_state, trajectory)
+        bm2.steps(60)
+        assert np.array_equal(bm1.state_trajectory, bm2.state_trajectory)
+
+    def test_restore_without_trajectory_fail(self):
+        param = ParamBrownianMotion(seed=123, initial_state=0.3, sigma=2.0)
+        bm = BrownianMotion(param, save_full_trajectory=True, total_step=100)
+        with pytest.raises(ValueError):
+            bm.restore(0., bm.get_rng_state())
+
+    def test_init_unknown_dtype_fail(self):
+        with pytest.raises(ValueError):
+            BrownianMotion(
+                ParamBrownianMotion(seed=123, initial_state=0.0, sigma=10.0),
+                dtype="float16"
+            )
+
+    @pytest.mark.parametrize("seed", [123, 456])
+    def test_float32_steps_bitwise_equal_to_step(self, seed):
+        param = ParamBrownianMotion(seed=seed, initial_state=0.3, sigma=2.0)
+        bm1 = BrownianMotion(param, save_full_trajectory=True, total_step=1000, dtype="float32")
+        for i in range(1000):
+            bm1.step()
+
+        bm2 = BrownianMotion(param, save_full_trajectory=True, total_step=1000, dtype="float32")
+        bm2.steps(400)
+        bm2.steps(600)
+        assert bm1.state_trajectory.dtype == np.float32
+        assert bm2.state_trajectory.dtype == np.float32
+        assert np.array_equal(bm1.state_trajectory, bm2.state_trajectory)
+        assert bm1.state == bm2.state
+
+    @pytest.mark.parametrize("seed", [123, 456])
+    @pytest.mark.parametrize("initial_state, sigma", [(0., 1.), (1e3, 1e-2), (-5., 30.)])
+    def test_float32_error_bound(self, seed, initial_state, sigma):
+        """
+        float32で計算した軌跡とfloat64で計算した軌跡の差がfloat32_error_bound()以下になる
+        """
+        total_step = 100000
+        param = ParamBrownianMotion(seed=seed, initial_state=initial_state, sigma=sigma)
+        bm64 = BrownianMotion(param, save_full_trajectory=True, total_step=total_step)
+        bm64.steps(total_step)
+        bm32 = BrownianMotion(
+            param, save_full_trajectory=True, total_step=total_step, dtype="float32")
+        bm32.steps(total_step)
+
+        error = np.abs(bm32.state_trajectory.astype(np.float64) - bm64.state_trajectory)
+        error_bound = float32_error_bound(bm64.state_trajectory)
+        assert (error <= error_bound).all()
+        # 上限が緩すぎないことも確認しておく (相対誤差で1e-2程度には収まる)
+        assert error_bound[-1] < 1e-2 * (np.abs(bm64.state_trajectory).max() + sigma)
+
+    @pytest.mark.parametrize("seed", [123, 456])
+    @pytest.mark.parametrize("dtype", ["float64", "float32"])
+    def test_antithetic(self, seed, dtype):
+        """
+        antithetic=Trueの軌跡は同じシードの軌跡を初期状態について反転させたもの
+        """
+        bm = BrownianMotion(
+            ParamBrownianMotion(seed=seed, initial_state=0., sigma=2.),
+            save_full_trajectory=True, total_step=100, dtype=dtype)
+        bm_antithetic = BrownianMotion(
+            ParamBrownianMotion(seed=seed, initial_state=0., sigma=2., antithetic=True),
+            save_full_trajectory=True, total_step=100, dtype=dtype)
+        bm.steps(50)
+        bm_antithetic.steps(50)
+        for i in range(50):
+            bm.step()
+            bm_antithetic.step()
+        # 初期状態が0なら丸め誤差も含めて符号が反転するだけ
+        assert np.array_equal(bm.state_trajectory, -bm_antithetic.state_trajectory)
+
+    @pytest.mark.parametrize("dtype", ["float64", "float32"])
+    def test_buffered_step_same_stream(self, dtype):
+        """
+        step()が使う乱数はまとめて生成しても1つずつrng.normal()した場合と同じ
+        """
+        param = ParamBrownianMotion(seed=123, initial_state=0.3, sigma=2.0)
+        bm = BrownianMotion(param, dtype=dtype)
+        n_step = 3 * BrownianMotion.noise_buffer_size + 5
+        states = [bm.step() for _ in range(n_step)]
+
+        rng = np.random.default_rng(123)
+        state = np.dtype(dtype).type(0.3)
+        for i in range(n_step):
+            if dtype == "float64":
+                state += 2.0 * rng.normal()
+            else:
+                state += np.float32(2.0 * rng.normal())
+            assert states[i] == state
+
+    @pytest.mark.parametrize("n_before", [0, 1, 100, 4096, 5000])
+    def test_steps_after_buffered_step(self, n_before):
+        """
+        step()のバッファに残っている乱数をsteps()が先に使う
+        """
+        param = ParamBrownianMotion(seed=123, initial_state=0.3, sigma=2.0)
+        bm1 = BrownianMotion(param, save_full_trajectory=True, total_step=10000)
+        for i in range(n_before):
+            bm1.step()
+        bm1.steps(50)
+        bm1.step()
+        bm1.steps(10000 - n_before - 51)
+
+        bm2 = BrownianMotion(param, save_full_trajectory=True, total_step=10000)
+        bm2.steps(10000)
+        assert np.array_equal(bm1.state_trajectory, bm2.state_trajectory)
+
+    @pytest.mark.parametrize("n_before", [0, 1, 100, 4096, 5000])
+    def test_restore_after_buffered_step(self, n_before):
+        """
+        バッファの途中でget_rng_state()しても、そこから続きを計算できる
+        """
+        param = ParamBrownianMotion(seed=123, initial_state=0.3, sigma=2.0)
+        bm1 = BrownianMotion(param)
+        for i in range(n_before):
+            bm1.step()
+        state, rng_state = bm1.state, bm1.get_rng_state()
+        # バッファを使わずに1つずつ生成した場合の乱数生成器の状態と同じ
+        rng = np.random.default_rng(123)
+        for i in range(n_before):
+            rng.normal()
+        assert rng_state == rng.bit_generator.state
+        states1 = [bm1.step() for _ in range(100)]
+
+        bm2 = BrownianMotion(param)
+        bm2.restore(state, rng_state)
+        states2 = [bm2.step() for _ in range(100)]
+        assert states1 == states2
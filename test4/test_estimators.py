@@ -0,0 +1,128 @@
+import mlflow
+import numpy as np
+import pandas as pd
+import pytest
+from lib4.brownian_motion import ParamBrownianMotion
+from lib4.estimators import (
+    CONTROL_COLUMN,
+    aggregate_runs,
+    control_variate_mean,
+    get_state_steps,
+    sample_mean,
+)
+from lib4.simulator import ParamSimulator, Simulator
+from lib4.stop_condition import ParamStopCondition
+
+
+class TestEstimators:
+    def test_sample_mean(self):
+        estimate = sample_mean([1., 3.])
+        assert estimate.mean == 2.
+        assert np.isclose(estimate.half_width, 12.7062047)
+        assert estimate.n_samples == 2
+
+    def test_control_variate_mean(self):
+        rng = np.random.default_rng(0)
+        controls = rng.normal(1., 1., size=200)
+        values = 2. * controls + rng.normal(0., 0.1, size=200)
+        estimate_plain = sample_mean(values)
+        estimate_cv = control_variate_mean(values, controls, control_mean=1.)
+        # 真の値は2
+        assert abs(estimate_cv.mean - 2.) < estimate_cv.half_width
+        assert estimate_cv.half_width < 0.1 * estimate_plain.half_width
+
+    def test_control_variate_constant_control(self):
+        estimate = control_variate_mean([1., 2., 3.], [1., 1., 1.], control_mean=1.)
+        assert estimate.mean == 2.
+
+    @pytest.mark.parametrize("total_step, record_per, record_schedule, expected", [
+        (500, 10, "every", 499),
+        (500, 1, "every", 500),
+        (5, 10, "every", 0),
+        (500, 10, "cap", 500),
+        (500, 10, "", 499),
+    ])
+    def test_state_steps(self, total_step, record_per, record_schedule, expected, memory_tracker):
+        df_result = pd.DataFrame({
+            "params.total_step": [str(total_step)] * 2,
+            "params.record_per": [str(record_per)] * 2,
+            "params.record_schedule": [record_schedule] * 2,
+            "metrics.stopping_time": [np.nan, 3.],
+        })
+        assert list(get_state_steps(df_result)) == [expected, 3]
+
+        # 実際に最後に記録されたステップと一致する
+        if record_schedule != "":
+            sim = Simulator(
+                "test",
+                ParamSimulator(
+                    total_step=total_step, record_per=record_per,
+                    record_schedule=record_schedule, record_points=10,
+                    param_bm=ParamBrownianMotion(seed=0, initial_state=0., sigma=1.),
+                ),
+                tracker=memory_tracker,
+            )
+            sim.run()
+            df_result = memory_tracker.search_runs(memory_tracker.get_experiment_id("test"), {})
+            assert get_state_steps(df_result)[0] == sim.get_metric_history()[-1].step
+
+    def test_aggregate_runs_control_variate(self, memory_tracker):
+        """
+        初到達時刻の期待値を(X_τ - x_0)^2 - sigma^2 τ を制御変量として推定する
+        """
+        n_runs = 40
+        for seed in range(n_runs):
+            Simulator(
+                "test",
+                ParamSimulator(
+                    total_step=2000,
+                    save_full_traj=False,
+                    param_bm=ParamBrownianMotion(seed=seed, initial_state=1., sigma=1.),
+                    stop_condition=ParamStopCondition(kind="interval", lower=-9., upper=11.),
+                ),
+                tracker=memory_tracker,
+            ).run()
+        # パラメータはmlflow.search_runs()と同じく文字列
+        df_result = memory_tracker.search_runs(memory_tracker.get_experiment_id("test"), {})
+        assert df_result["metrics.stopping_time"].notna().all()
+
+        key = (1.0, 1.0)
+        df_plain = aggregate_runs(df_result, "metrics.stopping_time")
+        df_cv = aggregate_runs(df_result, "metrics.stopping_time", control_variate=True)
+        assert df_cv.loc[key, "n_runs"] == n_runs
+        assert abs(df_cv.loc[key, "mean"] - df_plain.loc[key, "mean"]) < \
+            df_plain.loc[key, "half_width"]
+        assert 0 < df_cv.loc[key, "half_width"] < 0.3 * df_plain.loc[key, "half_width"]
+
+        # 制御変量自身を推定しようとするとエラー
+        df_result[CONTROL_COLUMN] = 0.
+        with pytest.raises(ValueError):
+            aggregate_runs(df_result, CONTROL_COLUMN, control_variate=True)
+
+    def test_aggregate_antithetic_runs(self, mlflow_cache_dir):
+        for seed in range(5):
+            for antithetic in [False, True]:
+                sim = Simulator(
+                    exp_name="test",
+                    param=ParamSimulator(
+                        total_step=100,
+                        record_per=10,
+                        save_full_traj=False,
+                        param_bm=ParamBrownianMotion(
+                            seed=seed, initial_state=0., sigma=1., antithetic=antithetic),
+                    ),
+                    cache_dir=mlflow_cache_dir,
+                )
+                sim.run()
+                run = sim.tracker.client.get_run(sim.run_id)
+                assert run.data.tags["sampling_scheme"] == ("antithetic" if antithetic else "plain")
+
+        exp = mlflow.tracking.MlflowClient(mlflow_cache_dir).get_experiment_by_name("test")
+        df_result = mlflow.search_runs([exp.experiment_id])
+        df_estimate = aggregate_runs(df_result)
+        # 同じシードの組は1つのサンプルとしてまとめられる
+        assert df_estimate["n_runs"].iloc[0] == 10
+        assert df_estimate["n_samples"].iloc[0] == 5
+        # 最終状態の組の平均は初期状態に一致する
+        assert df_estimate["mean"].iloc[0] == 0.
+        assert df_estimate["half_width"].iloc[0] == 0.
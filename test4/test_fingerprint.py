@@ -0,0 +1,164 @@
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import pytest
+from lib4.brownian_motion import ParamBrownianMotion
+from lib4.fingerprint import (
+    CHUNK_DIGEST_LENGTH,
+    CHUNK_DIGESTS_TAG,
+    DIGEST_TAG,
+    MAX_CHUNKS,
+    TrajectoryFingerprint,
+    get_chunk_size,
+)
+from lib4.reproducibility import (
+    audit_experiment,
+    compute_fingerprint,
+    find_identical_runs,
+    verify_run,
+)
+from lib4.simulator import ParamSimulator, Simulator
+from lib4.stop_condition import ParamStopCondition
+from lib4.tracker import MlflowTracker
+
+
+def get_param(total_step=1000, record_per=10, save_full_traj=True, **kwargs):
+    return ParamSimulator(
+        total_step=total_step,
+        record_per=record_per,
+        save_full_traj=save_full_traj,
+        param_bm=ParamBrownianMotion(seed=123, initial_state=0., sigma=1.),
+        **kwargs,
+    )
+
+
+class TestTrajectoryFingerprint:
+    @pytest.mark.parametrize("total_step", [0, 10, 255, 256, 1000])
+    def test_digests(self, total_step):
+        states = np.random.default_rng(0).normal(size=total_step + 1)
+        chunk_size = get_chunk_size(total_step)
+        expected_chunks = [
+            hashlib.sha256(states[i:i + chunk_size].tobytes()).hexdigest()[:CHUNK_DIGEST_LENGTH]
+            for i in range(0, len(states), chunk_size)
+        ]
+        assert len(expected_chunks) <= MAX_CHUNKS
+
+        # どのように分けて渡しても同じ
+        for block_size in [1, 7, 1000]:
+            fingerprint = TrajectoryFingerprint(total_step)
+            for i in range(0, len(states), block_size):
+                fingerprint.update(states[i:i + block_size])
+            fingerprint.finalize()
+            assert fingerprint.hexdigest() == hashlib.sha256(states.tobytes()).hexdigest()
+            assert [fingerprint.chunk_digests[i] for i in range(len(expected_chunks))] == \
+                expected_chunks
+
+        # 指定したチャンクだけ計算する
+        fingerprint = TrajectoryFingerprint(total_step, chunks={0})
+        fingerprint.update(states)
+        fingerprint.finalize()
+        assert fingerprint.chunk_digests == {0: expected_chunks[0]}
+
+    @pytest.mark.parametrize("total_step", [10 ** 4, 10 ** 8, 10 ** 12])
+    def test_tag_length(self, total_step):
+        # チャンクの数はMAX_CHUNKS以下なのでタグはmlflowの上限の5000文字に収まる
+        n_chunks = -(-(total_step + 1) // get_chunk_size(total_step))
+        assert n_chunks <= MAX_CHUNKS
+        assert n_chunks * (CHUNK_DIGEST_LENGTH + 1) - 1 <= 5000
+
+
+class TestSimulatorFingerprint:
+    def test_tags(self, make_simulator, memory_tracker):
+        sim = make_simulator(block_size=64)
+        sim.run()
+        tags = memory_tracker.get_tags(sim.run_id)
+        state_trajectory = sim.get_state_trajectory()
+        assert tags[DIGEST_TAG] == hashlib.sha256(state_trajectory.tobytes()).hexdigest()
+
+        # 軌跡を保存しなくても同じフィンガープリントになる
+        sim_no_traj = make_simulator(save_full_traj=False)
+        sim_no_traj.run()
+        assert memory_tracker.get_tags(sim_no_traj.run_id)[DIGEST_TAG] == tags[DIGEST_TAG]
+        assert find_identical_runs(
+            memory_tracker.search_runs(memory_tracker.get_experiment_id("test"), {})
+        ) == [[sim_no_traj.run_id, sim.run_id]]
+
+    @pytest.mark.parametrize("save_full_traj", [True, False])
+    @pytest.mark.parametrize("drop_end_state_tags", [True, False])
+    def test_extend(self, make_simulator, memory_tracker, save_full_traj, drop_end_state_tags):
+        def get_simulator(exp_name, total_step):
+            return make_simulator(
+                exp_name, total_step=total_step, save_full_traj=save_full_traj,
+                extend_previous_runs=True)
+
+        sim_short = get_simulator("test", 500)
+        sim_short.run()
+        if drop_end_state_tags:
+            for key in ["rng_state", "final_state"]:
+                del memory_tracker.runs[sim_short.run_id].tags[key]
+        sim_long = get_simulator("test", 2000)
+        assert sim_long.base_result is not None
+        sim_long.run()
+        sim_fresh = get_simulator("test_fresh", 2000)
+        sim_fresh.run()
+
+        tags_long = memory_tracker.get_tags(sim_long.run_id)
+        if not save_full_traj and not drop_end_state_tags:
+            # 延長元の区間の状態がないので計算しない
+            assert DIGEST_TAG not in tags_long
+        else:
+            assert tags_long[DIGEST_TAG] == memory_tracker.get_tags(sim_fresh.run_id)[DIGEST_TAG]
+
+
+class TestVerify:
+    @pytest.mark.parametrize("param", [
+        get_param(),
+        get_param(dtype="float32"),
+        get_param(stop_condition=ParamStopCondition(kind="interval", lower=-10., upper=10.)),
+    ])
+    def test_verify_run(self, memory_tracker, param):
+        sim = Simulator("test", param, tracker=memory_tracker)
+        sim.run()
+        check = verify_run(memory_tracker, sim.run_id)
+        assert check.matched
+        assert check.digest_matched
+        n_chunks = len(memory_tracker.get_tags(sim.run_id)[CHUNK_DIGESTS_TAG].split(","))
+        assert check.checked_chunks == list(range(n_chunks))
+
+        check = verify_run(memory_tracker, sim.run_id, chunks=[n_chunks - 1, 1])
+        assert check.matched
+        assert check.digest_matched is None
+        assert check.checked_chunks == [1, n_chunks - 1]
+
+        with pytest.raises(ValueError):
+            verify_run(memory_tracker, sim.run_id, chunks=[n_chunks])
+
+    def test_detect_mismatch(self, make_simulator, memory_tracker):
+        sim = make_simulator()
+        sim.run()
+        tags = memory_tracker.runs[sim.run_id].tags
+        chunks = tags[CHUNK_DIGESTS_TAG].split(",")
+        chunks[3] = "0" * CHUNK_DIGEST_LENGTH
+        tags[CHUNK_DIGESTS_TAG] = ",".join(chunks)
+
+        check = verify_run(memory_tracker, sim.run_id, chunks=[2, 3])
+        assert not check.matched
+        assert check.mismatched_chunks == [3]
+        # 疑わしいチャンクまでしか時間発展しない
+        fingerprint = compute_fingerprint(get_param(), chunks=[2, 3])
+        assert fingerprint.count == 4 * fingerprint.chunk_size
+        assert sorted(fingerprint.chunk_digests) == [2, 3]
+
+    def test_audit_experiment_without_artifacts(self, mlflow_cache_dir):
+        for record_per in [10, 20]:
+            Simulator("test", get_param(record_per=record_per), cache_dir=mlflow_cache_dir).run()
+        # artifactを消しても確認できる
+        for path in Path(mlflow_cache_dir).rglob("state_trajectory.bin"):
+            path.unlink()
+        tracker = MlflowTracker(mlflow_cache_dir)
+        checks = audit_experiment(tracker, "test")
+        assert len(checks) == 2
+        assert all(check.matched for check in checks)
+        df_result = tracker.search_runs(tracker.get_experiment_id("test"), {})
+        assert len(find_identical_runs(df_result)) == 1
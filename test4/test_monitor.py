@@ -0,0 +1,220 @@
+import multiprocessing
+
+import pytest
+from lib4.brownian_motion import ParamBrownianMotion
+from lib4.monitor import SweepEventLog, SweepMonitor, run_monitored, summarize_events
+from lib4.simulator import ParamSimulator, Simulator
+from lib4.stop_condition import ParamStopCondition
+from lib4.tracker import InMemoryTracker
+from lib4.work_queue import get_event_log, get_sweep_id, run_sweep_worker
+
+
+def get_param(seed=0, total_step=100, stop_condition=ParamStopCondition()):
+    return ParamSimulator(
+        total_step=total_step,
+        record_per=10,
+        save_full_traj=False,
+        param_bm=ParamBrownianMotion(seed=seed, initial_state=0., sigma=1.),
+        stop_condition=stop_condition,
+    )
+
+
+def emit_events(path: str, worker: int, n_event: int) -> None:
+    event_log = SweepEventLog(path)
+    for i in range(n_event):
+        event_log.emit("finished", f"{worker}-{i}", n_step=i)
+
+
+class TestSweepEventLog:
+    def test_emit_and_read(self, tmp_dir):
+        event_log = SweepEventLog(str(tmp_dir.joinpath("monitor", "events.jsonl")))
+        assert event_log.read() == []
+        event_log.emit("started", "a")
+        event_log.emit("finished", "a", n_step=10, elapsed=0.5)
+        events = event_log.read()
+        assert [(e["kind"], e["key"], e["n_step"]) for e in events] == \
+            [("started", "a", 0), ("finished", "a", 10)]
+        with pytest.raises(ValueError):
+            event_log.emit("unknown", "a")
+        event_log.clear()
+        assert event_log.read() == []
+
+    def test_partial_line_is_skipped(self, tmp_dir):
+        event_log = SweepEventLog(str(tmp_dir.joinpath("events.jsonl")))
+        event_log.emit("started", "a")
+        with event_log.path.open("a") as f:
+            f.write('{"time": 1')
+        assert len(event_log.read()) == 1
+
+    def test_multiprocess(self, tmp_dir):
+        """
+        複数のプロセスから同時に追記しても行が壊れない
+        """
+        path = str(tmp_dir.joinpath("events.jsonl"))
+        n_workers, n_event = 4, 200
+        with multiprocessing.Pool(n_workers) as pool:
+            pool.starmap(emit_events, [(path, i, n_event) for i in range(n_workers)])
+        events = SweepEventLog(path).read()
+        assert len(events) == n_workers * n_event
+        assert len({e["key"] for e in events}) == n_workers * n_event
+
+
+class TestSummarizeEvents:
+    def test_empty(self):
+        progress = summarize_events([], n_total=3)
+        assert (progress.n_remaining, progress.runs_per_sec, progress.eta) == (3, 0., float("inf"))
+        assert not progress.complete
+
+    def test_counts_and_rates(self):
+        events = [
+            {"time": 0., "worker": "w0", "kind": "cached", "key": "a", "n_step": 0},
+            {"time": 0., "worker": "w0", "kind": "started", "key": "b", "n_step": 0},
+            {"time": 0., "worker": "w0", "kind": "started", "key": "c", "n_step": 0},
+            {"time": 1., "worker": "w0", "kind": "failed", "key": "c", "n_step": 0},
+            {"time": 1., "worker": "w0", "kind": "started", "key": "d", "n_step": 0},
+            {"time": 2., "worker": "w0", "kind": "finished", "key": "b", "n_step": 100},
+            # 失敗したものを再実行した
+            {"time": 2., "worker": "w0", "kind": "started", "key": "c", "n_step": 0},
+            {"time": 4., "worker": "w0", "kind": "finished", "key": "c", "n_step": 300},
+        ]
+        progress = summarize_events(events, n_total=6, now=4.)
+        assert (progress.n_finished, progress.n_cached, progress.n_running, progress.n_failed) == \
+            (2, 1, 1, 0)
+        assert progress.n_remaining == 3
+        assert progress.runs_per_sec == 0.5
+        assert progress.steps_per_sec == 100.
+        assert progress.eta == 6.
+        assert "3/6 done (1 cached)" in str(progress)
+
+    def test_resumed_after_gap(self):
+        events = [
+            {"time": 0., "worker": "w0", "kind": "started", "key": "a", "n_step": 0},
+            {"time": 1., "worker": "w1", "kind": "started", "key": "b", "n_step": 0},
+            {"time": 2., "worker": "w0", "kind": "finished", "key": "a", "n_step": 100},
+            {"time": 3., "worker": "w1", "kind": "finished", "key": "b", "n_step": 100},
+            # 全てのワーカーが止まってから再開した
+            {"time": 1000., "worker": "w2", "kind": "started", "key": "c", "n_step": 0},
+            {"time": 1001., "worker": "w2", "kind": "finished", "key": "c", "n_step": 100},
+        ]
+        progress = summarize_events(events, n_total=6, now=1003.)
+        # 止まっていた間は経過時間に含めない
+        assert progress.elapsed == 6.
+        assert progress.runs_per_sec == 0.5
+        assert progress.steps_per_sec == 50.
+        assert progress.eta == 6.
+
+    def test_complete(self):
+        events = [
+            {"time": 10., "worker": "w0", "kind": "finished", "key": "a", "n_step": 100},
+            {"time": 12., "worker": "w0", "kind": "finished", "key": "b", "n_step": 100},
+        ]
+        # 全て終わっていれば最後のイベントの時刻までで集計する
+        progress = summarize_events(events, n_total=2)
+        assert progress.complete
+        assert (progress.elapsed, progress.steps_per_sec, progress.eta) == (2., 100., 0.)
+
+
+class TestSweepMonitor:
+    def test_run_monitored(self, tmp_dir, monkeypatch):
+        tracker = InMemoryTracker()
+        event_log = SweepEventLog(str(tmp_dir.joinpath("events.jsonl")))
+        run_monitored(Simulator("test", get_param(0), tracker=tracker), event_log, "0")
+        run_monitored(Simulator("test", get_param(0), tracker=tracker), event_log, "0")
+        # 停止条件で途中終了した場合は停止までのステップ数
+        sim = Simulator(
+            "test", get_param(1, stop_condition=ParamStopCondition(kind="level", level=1.)),
+            tracker=tracker)
+        run_monitored(sim, event_log, "1")
+        assert sim.stopping_time is not None
+
+        def fail(self, before_finish=None):
+            raise RuntimeError
+        monkeypatch.setattr(Simulator, "run", fail)
+        with pytest.raises(RuntimeError):
+            run_monitored(Simulator("test", get_param(2), tracker=tracker), event_log, "2")
+
+        events = event_log.read()
+        assert [(e["kind"], e["key"]) for e in events] == [
+            ("started", "0"), ("finished", "0"), ("cached", "0"),
+            ("started", "1"), ("finished", "1"), ("started", "2"), ("failed", "2"),
+        ]
+        assert events[1]["n_step"] == 100
+        assert events[4]["n_step"] == sim.stopping_time
+
+    def test_extended_run_counts_new_steps(self, tmp_dir):
+        tracker = InMemoryTracker()
+        event_log = SweepEventLog(str(tmp_dir.joinpath("events.jsonl")))
+        Simulator("test", get_param(0, total_step=300), tracker=tracker).run()
+        sim = Simulator(
+            "test", get_param(0, total_step=1000), tracker=tracker, extend_previous_runs=True)
+        run_monitored(sim, event_log, "0")
+        assert event_log.read()[-1]["n_step"] == 700
+
+    def test_write_report(self, tmp_dir):
+        tracker = InMemoryTracker()
+        event_log = SweepEventLog(str(tmp_dir.joinpath("events.jsonl")))
+        monitor = SweepMonitor(event_log, n_total=2, interval=0.01)
+        with monitor:
+            for seed in range(2):
+                sim = Simulator("test", get_param(seed), tracker=tracker)
+                run_monitored(sim, event_log, str(seed))
+        run_id = monitor.write_report(tracker, "sweeps", {"n_jobs": 1})
+
+        df_report = tracker.search_runs(tracker.get_experiment_id("sweeps"), {"n_jobs": 1})
+        assert list(df_report["run_id"]) == [run_id]
+        assert df_report["params.n_total"].iloc[0] == "2"
+        assert df_report["metrics.n_finished"].iloc[0] == 2
+        assert df_report["metrics.n_cached"].iloc[0] == 0
+        assert df_report["tags.complete"].iloc[0] == "True"
+        with tracker.open_artifact(run_id, "sweep_events.jsonl") as f:
+            assert len(f.read().splitlines()) == 4
+
+    def test_sweep_worker_events(self, tmp_dir):
+        cache_dir = str(tmp_dir.joinpath("mlruns"))
+        params = [get_param(seed) for seed in range(3)]
+        run_sweep_worker("test", params, cache_dir=cache_dir, poll_seconds=0.1)
+        event_log = get_event_log(str(tmp_dir.joinpath("queue", "test")), params)
+        progress = summarize_events(event_log.read(), n_total=len(params))
+        assert (progress.n_finished, progress.n_cached, progress.n_remaining) == (3, 0, 0)
+        assert progress.steps_per_sec > 0
+
+    def test_sweep_worker_events_per_sweep(self, tmp_dir):
+        cache_dir = str(tmp_dir.joinpath("mlruns"))
+        queue_dir = str(tmp_dir.joinpath("queue", "test"))
+        params1 = [get_param(seed) for seed in range(3)]
+        params2 = [get_param(seed) for seed in range(1, 5)]
+        # パラメータの順番によらず同じスイープになる
+        assert get_sweep_id(params1) == get_sweep_id(params1[::-1])
+        assert get_sweep_id(params1) != get_sweep_id(params2)
+
+        run_sweep_worker("test", params1, cache_dir=cache_dir, poll_seconds=0.1)
+        first_sweep_end = get_event_log(queue_dir, params1).read()[-1]["time"]
+        run_sweep_worker("test", params2, cache_dir=cache_dir, poll_seconds=0.1)
+        # 前のスイープのイベントは含まない (重なるパラメータは前のスイープで計算済み)
+        events = get_event_log(queue_dir, params2).read()
+        assert all(event["time"] >= first_sweep_end for event in events)
+        progress = summarize_events(events, n_total=len(params2))
+        assert (progress.n_finished, progress.n_remaining) == (2, 2)
+
+    def test_sweep_worker_report(self, tmp_dir):
+        cache_dir = str(tmp_dir.joinpath("mlruns"))
+        params = [get_param(seed) for seed in range(3)]
+        tracker = InMemoryTracker()
+        for _ in range(2):
+            run_sweep_worker(
+                "test", params, cache_dir=cache_dir, poll_seconds=0.1,
+                report_exp_name="sweeps", report_tracker=tracker, report_params={"n_jobs": 1},
+            )
+        # 2回目は記録済みなので記録しない
+        df_report = tracker.search_runs(tracker.get_experiment_id("sweeps"), {"n_jobs": 1})
+        assert len(df_report) == 1
+        assert df_report["params.sweep_id"].iloc[0] == get_sweep_id(params)
+        assert df_report["metrics.n_finished"].iloc[0] == 3
+        assert df_report["tags.complete"].iloc[0] == "True"
+
+    def test_sweep_worker_report_without_tracker_fail(self, tmp_dir):
+        with pytest.raises(ValueError):
+            run_sweep_worker(
+                "test", [get_param()], cache_dir=str(tmp_dir.joinpath("mlruns")),
+                report_exp_name="sweeps",
+            )
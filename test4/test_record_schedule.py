@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+from lib4.record_schedule import (
+    CappedSchedule,
+    ChangeSchedule,
+    LogSpacedSchedule,
+    RecordSchedule,
+    StrideSchedule,
+    make_record_schedule,
+)
+
+
+def select_in_blocks(schedule, states, block_size):
+    """
+    step=1からの状態をblock_sizeずつに分けてselect()に渡し、選ばれたステップを返す
+    """
+    selected = []
+    for start in range(0, len(states), block_size):
+        steps = np.arange(start + 1, min(start + block_size, len(states)) + 1)
+        indices = schedule.select(steps, states[start:start + block_size])
+        selected.append(steps[indices])
+    return np.concatenate(selected)
+
+
+class TestRecordSchedule:
+    @pytest.mark.parametrize("block_size", [1, 7, 1000])
+    def test_stride(self, block_size):
+        schedule = StrideSchedule(total_step=100, record_per=10)
+        steps = select_in_blocks(schedule, np.zeros(100), block_size)
+        assert np.array_equal(steps, np.arange(9, 100, 10))
+        assert schedule.describe() == "every:10"
+
+    @pytest.mark.parametrize("total_step, max_points, expected_stride", [
+        (1000, 10, 112),
+        (1001, 10, 112),
+        (1000, 1000, 2),
+        (1000, 1001, 1),
+        (999, 1000, 1),
+        (1000, 2, 1000),
+        (5, 10, 1),
+    ])
+    def test_capped(self, total_step, max_points, expected_stride):
+        schedule = CappedSchedule(total_step, max_points)
+        assert schedule.stride == expected_stride
+        steps = select_in_blocks(schedule, np.zeros(total_step), 64)
+        # step=0も含めて数える
+        assert len(steps) + 1 <= max_points
+        assert steps[-1] == total_step
+        assert np.all(steps[:-1] % expected_stride == 0)
+
+    def test_capped_fail(self):
+        with pytest.raises(ValueError):
+            CappedSchedule(1000, 1)
+
+    @pytest.mark.parametrize("block_size", [1, 7, 1000])
+    def test_log_spaced(self, block_size):
+        schedule = LogSpacedSchedule(total_step=1000, n_point=4)
+        steps = select_in_blocks(schedule, np.zeros(1000), block_size)
+        assert np.array_equal(steps, [1, 10, 100, 1000])
+
+    @pytest.mark.parametrize("block_size", [1, 7, 100, 100000])
+    def test_change(self, block_size):
+        rng = np.random.default_rng(0)
+        states = np.cumsum(rng.normal(size=10000))
+        tolerance = 5.
+        schedule = ChangeSchedule(total_step=len(states), tolerance=tolerance, initial_state=0.)
+        steps = select_in_blocks(schedule, states, block_size)
+
+        # 素直に1ステップずつ判定した結果と同じ
+        expected = []
+        last_value = 0.
+        for step, state in enumerate(states, start=1):
+            if abs(state - last_value) > tolerance:
+                expected.append(step)
+                last_value = state
+        if expected[-1] != len(states):
+            expected.append(len(states))
+        assert np.array_equal(steps, expected)
+        assert len(steps) < len(states) // 10
+
+    def test_abstract(self):
+        with pytest.raises(TypeError):
+            RecordSchedule(100)
+
+    def test_make_record_schedule_fail(self):
+        with pytest.raises(ValueError):
+            make_record_schedule("unknown", 100)
+        with pytest.raises(ValueError):
+            make_record_schedule("log", 100, points=0)
+        with pytest.raises(ValueError):
+            make_record_schedule("cap", 100, points=0)
+        with pytest.raises(ValueError):
+            make_record_schedule("cap", 100, points=1)
+        with pytest.raises(ValueError):
+            make_record_schedule("change", 100, tolerance=0.)
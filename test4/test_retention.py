@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+from lib4.retention import (DecimatedRetention, FullRetention, LogSpacedRetention,
+                            RingBufferRetention, TrajectoryRetention, make_retention)
+
+
+def save_in_blocks(retention, states, block_sizes):
+    """
+    statesをblock_sizesの長さに区切って順番にsave()する
+    """
+    first_step = 0
+    for block_size in block_sizes:
+        retention.save(first_step, states[first_step:first_step + block_size])
+        first_step += block_size
+    retention.save(first_step, states[first_step:])
+
+
+@pytest.fixture
+def states():
+    # 状態の値をステップ数と同じにしておくと確認しやすい
+    return np.arange(101, dtype=float)
+
+
+BLOCK_SIZES = [[], [1] * 100, [1, 2, 3, 50], [37, 37]]
+
+
+class TestRetention:
+    @pytest.mark.parametrize("mode, size", [("unknown", 1), ("last", 0), ("every", -1)])
+    def test_make_retention_fail(self, mode, size):
+        with pytest.raises(ValueError):
+            make_retention(mode, 100, size)
+
+    def test_abstract(self):
+        with pytest.raises(TypeError):
+            TrajectoryRetention(100)
+
+    @pytest.mark.parametrize("mode, size, cls", [
+        ("full", 0, FullRetention),
+        ("last", 10, RingBufferRetention),
+        ("every", 10, DecimatedRetention),
+        ("log", 10, LogSpacedRetention),
+    ])
+    def test_make_retention(self, mode, size, cls):
+        assert isinstance(make_retention(mode, 100, size), cls)
+
+    @pytest.mark.parametrize("block_sizes", BLOCK_SIZES)
+    def test_full(self, states, block_sizes):
+        retention = FullRetention(100)
+        save_in_blocks(retention, states, block_sizes)
+        assert np.array_equal(retention.steps(), np.arange(101))
+        assert np.array_equal(retention.values(), states)
+
+    @pytest.mark.parametrize("block_sizes", BLOCK_SIZES)
+    @pytest.mark.parametrize("size", [1, 7, 200])
+    def test_ring_buffer(self, states, block_sizes, size):
+        retention = RingBufferRetention(100, size)
+        save_in_blocks(retention, states, block_sizes)
+        expected_steps = np.arange(max(101 - size, 0), 101)
+        assert np.array_equal(retention.steps(), expected_steps)
+        assert np.array_equal(retention.values(), states[expected_steps])
+
+    def test_ring_buffer_partially_filled(self, states):
+        retention = RingBufferRetention(100, 50)
+        retention.save(0, states[:20])
+        assert np.array_equal(retention.steps(), np.arange(20))
+        assert np.array_equal(retention.values(), states[:20])
+
+    @pytest.mark.parametrize("block_sizes", BLOCK_SIZES)
+    @pytest.mark.parametrize("every", [1, 3, 10, 200])
+    def test_decimated(self, states, block_sizes, every):
+        retention = DecimatedRetention(100, every)
+        save_in_blocks(retention, states, block_sizes)
+        expected_steps = np.arange(0, 101, every)
+        assert np.array_equal(retention.steps(), expected_steps)
+        assert np.array_equal(retention.values(), states[expected_steps])
+
+    @pytest.mark.parametrize("block_sizes", BLOCK_SIZES)
+    def test_log_spaced(self, states, block_sizes):
+        retention = LogSpacedRetention(100, 5)
+        save_in_blocks(retention, states, block_sizes)
+        expected_steps = np.array([0, 1, 3, 10, 32, 100])
+        assert np.array_equal(retention.steps(), expected_steps)
+        assert np.array_equal(retention.values(), states[expected_steps])
+
+    def test_log_spaced_dense(self, states):
+        """
+        点の数がステップ数より多くても重複しない
+        """
+        retention = LogSpacedRetention(100, 1000)
+        save_in_blocks(retention, states, [])
+        assert np.array_equal(retention.steps(), np.arange(101))
+
+    @pytest.mark.parametrize("mode, size", [
+        ("full", 0), ("last", 7), ("last", 200), ("every", 3), ("log", 5), ("log", 1000),
+    ])
+    @pytest.mark.parametrize("n_scalar", [1, 50, 101])
+    def test_save_state(self, states, mode, size, n_scalar):
+        """
+        1ステップずつsave_state()しても、途中からsave()に切り替えても同じ
+        """
+        expected = make_retention(mode, 100, size)
+        expected.save(0, states)
+        retention = make_retention(mode, 100, size)
+        for step in range(n_scalar):
+            retention.save_state(step, states[step])
+        retention.save(n_scalar, states[n_scalar:])
+        assert retention.count == expected.count
+        assert np.array_equal(retention.steps(), expected.steps())
+        assert np.array_equal(retention.values(), expected.values())
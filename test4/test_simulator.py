@@ -1,24 +1,9 @@
-import tempfile
-from pathlib import Path
-
 import numpy as np
 import pytest
 from lib4.brownian_motion import ParamBrownianMotion
-from lib4.simulator import ParamSimulator, Simulator
-
-
-@pytest.fixture
-def mlflow_cache_dir():
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        cache_dir = Path(tmp_dir).joinpath("mlruns")
-        yield str(cache_dir)
-
-
-@pytest.fixture
-def param_brownian_motion():
-    return ParamBrownianMotion(
-        seed=123, initial_state=0., sigma=1.
-    )
+from lib4.simulator import ParamSimulator, Simulator, param_from_mlflow
+from lib4.stop_condition import ParamStopCondition
+from lib4.tracker import MlflowTracker
 
 
 class TestSimulator:
@@ -91,3 +76,304 @@ class TestSimulator:
         state_trajectory1 = sim1.get_state_trajectory()
         state_trajectory2 = sim2.get_state_trajectory()
         assert np.allclose(state_trajectory1, state_trajectory2)
+
+    @pytest.mark.parametrize("save_full_traj", [True, False])
+    @pytest.mark.parametrize("drop_end_state_tags", [True, False])
+    def test_extend_previous_run(
+        self, make_simulator, mlflow_cache_dir, save_full_traj, drop_end_state_tags
+    ):
+        def get_simulator(exp_name, total_step):
+            return make_simulator(
+                exp_name, total_step=total_step, save_full_traj=save_full_traj,
+                cache_dir=mlflow_cache_dir, extend_previous_runs=True)
+
+        sim_short = get_simulator("test", 500)
+        assert sim_short.base_result is None
+        sim_short.run()
+        if drop_end_state_tags:
+            # 終了時の状態が保存されていない古いRunでも早送りして延長できる
+            sim_short.tracker.client.delete_tag(sim_short.run_id, "rng_state")
+            sim_short.tracker.client.delete_tag(sim_short.run_id, "final_state")
+
+        sim_long = get_simulator("test", 5000)
+        assert sim_long.base_result["run_id"] == sim_short.run_id
+        sim_long.run()
+        assert sim_long.run_id != sim_short.run_id
+        run = sim_long.tracker.client.get_run(sim_long.run_id)
+        assert run.data.tags["extended_from"] == sim_short.run_id
+
+        # 最初から計算した結果とビット単位で一致する
+        sim_fresh = get_simulator("test_fresh", 5000)
+        assert sim_fresh.base_result is None
+        sim_fresh.run()
+        assert sim_long.bm.state == sim_fresh.bm.state
+        if save_full_traj:
+            assert np.array_equal(sim_long.get_state_trajectory(), sim_fresh.get_state_trajectory())
+        metric_history_long = sim_long.get_metric_history()
+        metric_history_fresh = sim_fresh.get_metric_history()
+        assert [(m.step, m.value) for m in metric_history_long] == \
+            [(m.step, m.value) for m in metric_history_fresh]
+
+    def test_extend_chooses_longest_shorter_run(self, make_simulator):
+        def get_simulator(total_step):
+            return make_simulator(
+                total_step=total_step, save_full_traj=False, extend_previous_runs=True)
+
+        sims = {total_step: get_simulator(total_step) for total_step in [100, 300, 2000]}
+        for sim in sims.values():
+            sim.run()
+
+        sim = get_simulator(1000)
+        assert sim.base_result["run_id"] == sims[300].run_id
+
+    @pytest.mark.parametrize("block_size", [1, 64, 10000])
+    def test_stop_condition(self, make_simulator, memory_tracker, block_size):
+        def get_simulator(exp_name, stop_condition):
+            return make_simulator(exp_name, stop_condition=stop_condition, block_size=block_size)
+
+        sim_full = get_simulator("test_full", ParamStopCondition())
+        sim_full.run()
+        assert sim_full.stopping_time is None
+        state_trajectory_full = sim_full.get_state_trajectory()
+        expected_stopping_time = int(np.argmax(np.abs(state_trajectory_full) > 10.))
+        assert expected_stopping_time > 0
+
+        sim = get_simulator(
+            "test", ParamStopCondition(kind="interval", lower=-10., upper=10.))
+        sim.run()
+        assert sim.stopping_time == expected_stopping_time
+        # 停止したところまでで軌跡が切り詰められている
+        state_trajectory = sim.get_state_trajectory()
+        assert np.array_equal(
+            state_trajectory, state_trajectory_full[:expected_stopping_time + 1])
+
+        metrics = memory_tracker.get_latest_metrics(sim.run_id)
+        assert metrics["stopping_time"] == expected_stopping_time
+        assert metrics["state"] == state_trajectory[-1]
+        assert memory_tracker.runs[sim.run_id].tags["stop_reason"] in ("lower", "upper")
+        steps = [metric.step for metric in sim.get_metric_history()]
+        assert len(steps) == len(set(steps))
+        for metric in sim.get_metric_history():
+            assert metric.step <= expected_stopping_time
+            assert state_trajectory[metric.step] == metric.value
+
+    @pytest.mark.parametrize("block_size", [1, 7, 10000])
+    def test_stop_at_recorded_step(self, make_simulator, block_size):
+        """
+        停止したステップが記録するステップにも選ばれていたら、状態は1回だけ記録する
+        """
+        sim = make_simulator(
+            param_bm=ParamBrownianMotion(seed=0, initial_state=0., sigma=1.),
+            stop_condition=ParamStopCondition(kind="level", level=5.),
+            block_size=block_size,
+        )
+        sim.run()
+        assert sim.stopping_time % 10 == 9
+        steps = [metric.step for metric in sim.get_metric_history()]
+        assert steps == sorted(set(steps))
+        assert steps[-1] == sim.stopping_time
+
+    def test_param_level_at_initial_state_fail(self, param_brownian_motion):
+        # デフォルトのlevelとinitial_stateはどちらも0
+        with pytest.raises(ValueError):
+            ParamSimulator(
+                param_bm=param_brownian_motion, stop_condition=ParamStopCondition(kind="level"))
+
+    def test_param_invalid_retention_fail(self, param_brownian_motion):
+        with pytest.raises(ValueError):
+            ParamSimulator(traj_retention="unknown", param_bm=param_brownian_motion)
+        with pytest.raises(ValueError):
+            ParamSimulator(traj_retention="last", param_bm=param_brownian_motion)
+
+    @pytest.mark.parametrize("traj_retention, traj_retention_size, expected_steps", [
+        ("full", 0, np.arange(1001)),
+        ("last", 100, np.arange(901, 1001)),
+        ("every", 100, np.arange(0, 1001, 100)),
+        ("log", 4, np.array([0, 1, 10, 100, 1000])),
+    ])
+    def test_traj_retention(
+        self, make_simulator, traj_retention, traj_retention_size, expected_steps
+    ):
+        def get_simulator(exp_name, traj_retention, traj_retention_size):
+            return make_simulator(
+                exp_name, traj_retention=traj_retention,
+                traj_retention_size=traj_retention_size, block_size=64)
+
+        sim_full = get_simulator("test_full", "full", 0)
+        sim_full.run()
+        state_trajectory_full = sim_full.get_state_trajectory()
+
+        sim1 = get_simulator("test", traj_retention, traj_retention_size)
+        sim1.run()
+        steps1, state_trajectory1 = sim1.get_state_trajectory(return_steps=True)
+        assert np.array_equal(steps1, expected_steps)
+        assert np.array_equal(state_trajectory1, state_trajectory_full[expected_steps])
+
+        # 以前の結果のartifactから読み出しても同じ
+        sim2 = get_simulator("test", traj_retention, traj_retention_size)
+        assert sim2.done
+        steps2, state_trajectory2 = sim2.get_state_trajectory(return_steps=True)
+        assert np.array_equal(steps2, expected_steps)
+        assert np.array_equal(state_trajectory2, state_trajectory1)
+
+    @pytest.mark.parametrize("block_size", [64, 10000])
+    def test_extend_previous_run_with_traj_retention(self, make_simulator, block_size):
+        def get_simulator(exp_name, total_step):
+            return make_simulator(
+                exp_name, total_step=total_step, traj_retention="last", traj_retention_size=300,
+                extend_previous_runs=True, block_size=block_size)
+
+        get_simulator("test", 500).run()
+        sim_long = get_simulator("test", 2000)
+        assert sim_long.base_result is not None
+        # 延長元の区間もblock_sizeステップずつ早送りする
+        n_steps = []
+        steps = sim_long.bm.steps
+
+        def record_steps(n_step, save=True):
+            n_steps.append(n_step)
+            return steps(n_step, save=save)
+
+        sim_long.bm.steps = record_steps
+        sim_long.run()
+        assert max(n_steps) <= block_size
+        sim_fresh = get_simulator("test_fresh", 2000)
+        sim_fresh.run()
+        steps_long, state_trajectory_long = sim_long.get_state_trajectory(return_steps=True)
+        steps_fresh, state_trajectory_fresh = sim_fresh.get_state_trajectory(return_steps=True)
+        assert np.array_equal(steps_long, steps_fresh)
+        assert np.array_equal(state_trajectory_long, state_trajectory_fresh)
+
+    def test_param_unknown_dtype_fail(self, param_brownian_motion):
+        with pytest.raises(ValueError):
+            ParamSimulator(dtype="float16", param_bm=param_brownian_motion)
+
+    def test_float32(self, make_simulator):
+        sim64 = make_simulator(dtype="float64")
+        sim64.run()
+        # dtypeが違う結果はキャッシュとして使わない
+        sim32 = make_simulator(dtype="float32")
+        assert not sim32.done
+        sim32.run()
+        assert sim32.run_id != sim64.run_id
+
+        sim32_cached = make_simulator(dtype="float32")
+        assert sim32_cached.done
+        assert sim32_cached.run_id == sim32.run_id
+        state_trajectory32 = sim32_cached.get_state_trajectory()
+        assert state_trajectory32.dtype == np.float32
+        assert np.array_equal(state_trajectory32, sim32.get_state_trajectory())
+        assert np.allclose(state_trajectory32, sim64.get_state_trajectory(), atol=1e-4)
+
+    def test_param_invalid_record_schedule_fail(self, param_brownian_motion):
+        with pytest.raises(ValueError):
+            ParamSimulator(record_schedule="unknown", param_bm=param_brownian_motion)
+        with pytest.raises(ValueError):
+            ParamSimulator(record_schedule="cap", param_bm=param_brownian_motion)
+        with pytest.raises(ValueError):
+            ParamSimulator(record_schedule="cap", record_points=1, param_bm=param_brownian_motion)
+        with pytest.raises(ValueError):
+            ParamSimulator(record_schedule="change", param_bm=param_brownian_motion)
+
+    @pytest.mark.parametrize("record_schedule, record_points, record_tolerance, expected_tag", [
+        ("every", 0, 0., "every:10"),
+        ("log", 4, 0., "log:4"),
+        ("cap", 20, 0., "cap:20(stride=53)"),
+        ("change", 0, 3., "change:3.0"),
+    ])
+    def test_record_schedule(
+        self, make_simulator, memory_tracker,
+        record_schedule, record_points, record_tolerance, expected_tag
+    ):
+        sim = make_simulator(
+            record_schedule=record_schedule,
+            record_points=record_points,
+            record_tolerance=record_tolerance,
+            block_size=64,
+        )
+        sim.run()
+        assert memory_tracker.runs[sim.run_id].tags["record_schedule"] == expected_tag
+
+        state_trajectory = sim.get_state_trajectory()
+        metric_history = sim.get_metric_history()
+        steps = [metric.step for metric in metric_history]
+        assert steps[0] == 0
+        assert steps == sorted(set(steps))
+        for metric in metric_history:
+            assert state_trajectory[metric.step] == metric.value
+        if record_schedule == "every":
+            assert len(steps) == 1000 // 10 + 1
+        else:
+            # every以外は最後のステップも記録する
+            assert steps[-1] == 1000
+        if record_schedule == "log":
+            assert steps == [0, 1, 10, 100, 1000]
+        elif record_schedule == "cap":
+            assert len(steps) <= 20
+        elif record_schedule == "change":
+            values = np.array([metric.value for metric in metric_history])
+            assert np.all(np.abs(np.diff(values[:-1])) > record_tolerance)
+
+    def test_no_extension_with_record_schedule(self, make_simulator):
+        def get_simulator(total_step):
+            return make_simulator(
+                total_step=total_step, record_schedule="log", record_points=10,
+                save_full_traj=False, extend_previous_runs=True)
+
+        get_simulator(100).run()
+        # 記録するステップがtotal_stepによって変わるので延長しない
+        assert get_simulator(1000).base_result is None
+
+    def test_find_run_without_new_params(
+        self, make_simulator, mlflow_cache_dir, param_brownian_motion
+    ):
+        # 後からパラメータを追加する前のバージョンで記録したRun
+        tracker = MlflowTracker(mlflow_cache_dir)
+        exp_id = tracker.get_experiment_id("test")
+        with tracker.start_run(exp_id) as old_run_id:
+            tracker.log_params(old_run_id, {
+                "total_step": 500,
+                "record_per": 10,
+                "save_full_traj": True,
+                "param_bm.seed": param_brownian_motion.seed,
+                "param_bm.initial_state": param_brownian_motion.initial_state,
+                "param_bm.sigma": param_brownian_motion.sigma,
+            })
+
+        def get_simulator(total_step=500, **kwargs):
+            return make_simulator(
+                total_step=total_step, cache_dir=mlflow_cache_dir, extend_previous_runs=True,
+                **kwargs)
+
+        # 追加したパラメータがデフォルト値なら同じ結果として見つかる
+        sim = get_simulator()
+        assert sim.done
+        assert sim.run_id == old_run_id
+        assert get_simulator(1000).base_result["run_id"] == old_run_id
+        # デフォルト値でなければ別の結果
+        assert not get_simulator(dtype="float32").done
+        assert not get_simulator(
+            stop_condition=ParamStopCondition(kind="level", level=3.)).done
+
+        # 新しいパラメータを全て記録したRunも引き続き見つかる
+        sim_new = get_simulator(dtype="float32")
+        sim_new.run()
+        sim_found = get_simulator(dtype="float32")
+        assert sim_found.done
+        assert sim_found.run_id == sim_new.run_id
+        assert get_simulator().run_id == old_run_id
+
+    def test_param_from_mlflow(self, memory_tracker, param_brownian_motion):
+        param = ParamSimulator(
+            total_step=100,
+            record_schedule="change",
+            record_tolerance=0.5,
+            dtype="float32",
+            param_bm=param_brownian_motion,
+            stop_condition=ParamStopCondition(kind="interval", lower=-3., upper=3.),
+        )
+        sim = Simulator("test", param, tracker=memory_tracker)
+        sim.run()
+        assert param_from_mlflow(memory_tracker.get_params(sim.run_id)) == param
+        # 保存されていないパラメータはデフォルト値になる
+        assert param_from_mlflow({"total_step": "100"}) == ParamSimulator(total_step=100)
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from lib4.brownian_motion import BrownianMotion, ParamBrownianMotion
+from lib4.stop_condition import (ParamStopCondition, check_stop_condition, find_stop,
+                                 simulate_first_passage)
+
+
+class TestStopCondition:
+    def test_param_unknown_kind_fail(self):
+        with pytest.raises(ValueError):
+            ParamStopCondition(kind="unknown")
+
+    def test_param_inverted_interval_fail(self):
+        with pytest.raises(ValueError):
+            ParamStopCondition(kind="interval", lower=1., upper=-1.)
+
+    def test_level_at_initial_state_fail(self):
+        param = ParamStopCondition(kind="level")
+        with pytest.raises(ValueError):
+            check_stop_condition(param, 0.)
+        check_stop_condition(param, 1.)
+        # intervalは初期状態が境界にあってもよい
+        check_stop_condition(ParamStopCondition(kind="interval", lower=0., upper=1.), 0.)
+        with pytest.raises(ValueError):
+            simulate_first_passage(
+                [ParamBrownianMotion(seed=0, initial_state=0., sigma=1.)], param, 100)
+
+    def test_find_stop_none(self):
+        param = ParamStopCondition()
+        assert find_stop(param, np.array([-100., 100.]), 0.) is None
+
+    @pytest.mark.parametrize("initial_state, states, expected", [
+        # 下から上に横切る
+        (0., np.array([0.5, 0.9, 1.0, 2.0]), (2, "level")),
+        # 上から下に横切る
+        (2., np.array([1.5, 0.9, 1.2]), (1, "level")),
+        (0., np.array([0.5, 0.9, -1.0]), None),
+    ])
+    def test_find_stop_level(self, initial_state, states, expected):
+        param = ParamStopCondition(kind="level", level=1.)
+        assert find_stop(param, states, initial_state) == expected
+
+    @pytest.mark.parametrize("states, expected", [
+        (np.array([0.5, -0.9, 1.5, -2.0]), (2, "upper")),
+        (np.array([0.5, -1.5, 1.5]), (1, "lower")),
+        (np.array([0.5, -1.0, 1.0]), None),
+    ])
+    def test_find_stop_interval(self, states, expected):
+        param = ParamStopCondition(kind="interval", lower=-1., upper=1.)
+        assert find_stop(param, states, 0.) == expected
+
+    @pytest.mark.parametrize("block_size", [1, 7, 10000])
+    def test_simulate_first_passage(self, block_size):
+        """
+        1stepずつ時間発展させて求めた初到達時刻と一致する
+        """
+        stop_condition = ParamStopCondition(kind="level", level=3.)
+        params_bm = [
+            ParamBrownianMotion(seed=seed, initial_state=0., sigma=0.5) for seed in range(20)
+        ]
+        total_step = 200
+        expected = []
+        for param in params_bm:
+            bm = BrownianMotion(param)
+            stopping_time = -1
+            for step in range(1, total_step + 1):
+                if bm.step() >= 3.:
+                    stopping_time = step
+                    break
+            expected.append(stopping_time)
+        assert -1 in expected and any(t > 0 for t in expected)
+
+        stopping_times = simulate_first_passage(
+            params_bm, stop_condition, total_step, block_size=block_size)
+        assert stopping_times.tolist() == expected
@@ -0,0 +1,160 @@
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+from lib4.brownian_motion import ParamBrownianMotion
+from lib4.simulator import ParamSimulator, Simulator
+from lib4.summary import ExperimentSummary
+from lib4.tracker import MlflowTracker
+
+
+def run_simulation(cache_dir: str, seed: int, sigma: float) -> Simulator:
+    sim = Simulator(
+        exp_name="test",
+        param=ParamSimulator(
+            total_step=100,
+            record_per=10,
+            save_full_traj=False,
+            param_bm=ParamBrownianMotion(seed=seed, initial_state=1., sigma=sigma),
+        ),
+        cache_dir=cache_dir,
+    )
+    sim.run()
+    return sim
+
+
+class TestExperimentSummary:
+    def test_load_before_sync(self, mlflow_cache_dir):
+        summary = ExperimentSummary("test", cache_dir=mlflow_cache_dir)
+        assert len(summary.load()) == 0
+
+    def test_sync_unknown_experiment_fail(self, mlflow_cache_dir):
+        summary = ExperimentSummary("unknown", cache_dir=mlflow_cache_dir)
+        with pytest.raises(ValueError):
+            summary.sync()
+
+    def test_sync(self, mlflow_cache_dir):
+        sims = [run_simulation(mlflow_cache_dir, seed, 0.5) for seed in range(3)]
+        summary = ExperimentSummary("test", cache_dir=mlflow_cache_dir)
+        assert summary.sync() == 3
+        assert summary.sync() == 0
+
+        df_summary = summary.load()
+        assert sorted(df_summary["run_id"]) == sorted(sim.run_id for sim in sims)
+        # パラメータが元の型で保存されている
+        assert df_summary["params.param_bm.sigma"].dtype == np.float64
+        assert df_summary["params.param_bm.seed"].dtype == np.int64
+        assert df_summary["params.save_full_traj"].dtype == bool
+        assert (df_summary["params.param_bm.sigma"] == 0.5).all()
+        for sim in sims:
+            row = df_summary[df_summary["run_id"] == sim.run_id].iloc[0]
+            assert row["metrics.state"] == sim.get_metric_history()[-1].value
+
+    def test_incremental_sync(self, mlflow_cache_dir, monkeypatch):
+        run_simulation(mlflow_cache_dir, 0, 0.5)
+        summary = ExperimentSummary("test", cache_dir=mlflow_cache_dir)
+        assert summary.sync() == 1
+
+        # 2回目は新しいRunだけを読み出す
+        read_run_ids = []
+        get_run = summary.mlflow_client.get_run
+
+        def counting_get_run(run_id):
+            read_run_ids.append(run_id)
+            return get_run(run_id)
+
+        monkeypatch.setattr(summary.mlflow_client, "get_run", counting_get_run)
+        new_sims = [run_simulation(mlflow_cache_dir, seed, 1.5) for seed in range(1, 3)]
+        assert summary.sync() == 2
+        assert sorted(read_run_ids) == sorted(sim.run_id for sim in new_sims)
+
+        df_summary = summary.load()
+        assert len(df_summary) == 3
+        assert sorted(df_summary["params.param_bm.sigma"]) == [0.5, 1.5, 1.5]
+
+    def test_sync_runs_before_new_params(self, mlflow_cache_dir):
+        # パラメータを追加する前に記録したRunと、追加したパラメータを使うRun
+        tracker = MlflowTracker(mlflow_cache_dir)
+        with tracker.start_run(tracker.get_experiment_id("test")) as old_run_id:
+            tracker.log_params(old_run_id, {
+                "total_step": 100, "record_per": 10, "save_full_traj": False,
+                "param_bm.seed": 0, "param_bm.initial_state": 1., "param_bm.sigma": 0.5,
+            })
+        sim = Simulator(
+            exp_name="test",
+            param=ParamSimulator(
+                total_step=100,
+                save_full_traj=False,
+                traj_retention="last",
+                traj_retention_size=10,
+                param_bm=ParamBrownianMotion(seed=0, initial_state=1., sigma=0.5, antithetic=True),
+            ),
+            cache_dir=mlflow_cache_dir,
+        )
+        sim.run()
+
+        summary = ExperimentSummary("test", cache_dir=mlflow_cache_dir)
+        assert summary.sync() == 2
+        df_summary = summary.load().set_index("run_id")
+        # 記録されていないパラメータはデフォルト値で埋まり、列の型が保たれる
+        assert df_summary["params.param_bm.antithetic"].dtype == bool
+        assert df_summary["params.traj_retention_size"].dtype == np.int64
+        assert not df_summary.loc[old_run_id, "params.param_bm.antithetic"]
+        assert df_summary.loc[sim.run_id, "params.param_bm.antithetic"]
+        assert df_summary.loc[old_run_id, "params.traj_retention"] == "full"
+        assert df_summary.loc[sim.run_id, "params.traj_retention_size"] == 10
+
+    def test_failed_runs_read_once(self, mlflow_cache_dir, monkeypatch):
+        run_simulation(mlflow_cache_dir, 0, 0.5)
+        tracker = MlflowTracker(mlflow_cache_dir)
+        with pytest.raises(RuntimeError):
+            with tracker.start_run(tracker.get_experiment_id("test")):
+                raise RuntimeError
+        summary = ExperimentSummary("test", cache_dir=mlflow_cache_dir)
+        assert summary.sync() == 1
+
+        # 終了したRunはFINISHEDでなくても次からは読み出さない
+        read_run_ids = []
+        get_run = summary.mlflow_client.get_run
+
+        def counting_get_run(run_id):
+            read_run_ids.append(run_id)
+            return get_run(run_id)
+
+        monkeypatch.setattr(summary.mlflow_client, "get_run", counting_get_run)
+        assert summary.sync() == 0
+        assert read_run_ids == []
+
+    def test_sync_appends_chunks(self, mlflow_cache_dir):
+        summary = ExperimentSummary("test", cache_dir=mlflow_cache_dir)
+        summary.max_chunks = 3
+        sims = []
+        for seed in range(5):
+            sims.append(run_simulation(mlflow_cache_dir, seed, 0.5))
+            chunk_paths = summary._get_chunk_paths()
+            assert summary.sync() == 1
+            # 既存のチャンクは書き直さずに新しいチャンクを追加する
+            if len(chunk_paths) < summary.max_chunks:
+                assert summary._get_chunk_paths()[:-1] == chunk_paths
+            assert len(summary._get_chunk_paths()) <= summary.max_chunks
+        df_summary = summary.load()
+        assert sorted(df_summary["run_id"]) == sorted(sim.run_id for sim in sims)
+        assert df_summary["params.param_bm.seed"].dtype == np.int64
+
+    def test_load_speed(self, mlflow_cache_dir):
+        """
+        10万件でも一度の読み出しですぐに読める
+        """
+        n_runs = 100000
+        summary = ExperimentSummary("test", cache_dir=mlflow_cache_dir)
+        summary._save(pd.DataFrame({
+            "run_id": [f"{i:032x}" for i in range(n_runs)],
+            "params.param_bm.sigma": np.linspace(0, 1, n_runs),
+            "metrics.state": np.zeros(n_runs),
+        }))
+        start = time.perf_counter()
+        df_summary = summary.load()
+        df_summary.groupby("params.param_bm.sigma")["metrics.state"].mean()
+        assert time.perf_counter() - start < 1.
+        assert len(df_summary) == n_runs
@@ -0,0 +1,163 @@
+import numpy as np
+import pytest
+from lib4.artifact_cache import ArtifactCache
+from lib4.brownian_motion import ParamBrownianMotion
+from lib4.simulator import ParamSimulator, Simulator
+from lib4.tracker import InMemoryTracker, MlflowTracker, NoOpTracker, Tracker
+
+
+@pytest.fixture(params=["mlflow", "memory"])
+def tracker(request, tmp_dir):
+    if request.param == "mlflow":
+        return MlflowTracker(str(tmp_dir.joinpath("mlruns")))
+    return InMemoryTracker()
+
+
+def get_param(total_step=100, seed=0):
+    return ParamSimulator(
+        total_step=total_step,
+        record_per=10,
+        save_full_traj=True,
+        param_bm=ParamBrownianMotion(seed=seed, initial_state=0., sigma=1.),
+    )
+
+
+class TestTracker:
+    def test_experiment_id(self, tracker):
+        exp_id = tracker.get_experiment_id("test")
+        assert tracker.get_experiment_id("test") == exp_id
+        assert tracker.get_experiment_id("other") != exp_id
+
+    def test_log_and_search(self, tracker, tmp_dir):
+        exp_id = tracker.get_experiment_id("test")
+        with tracker.start_run(exp_id, run_name="a", tags={"kind": "a"}) as run_id:
+            tracker.log_params(run_id, {"x": 1, "y": "b"})
+            tracker.log_metrics(run_id, {"m": 1.}, step=0)
+            tracker.log_metrics(run_id, {"m": 3.}, step=2)
+            tracker.log_metrics(run_id, {"m": 2.}, step=1)
+            tracker.set_tags(run_id, {"done": True})
+            artifact_path = tmp_dir.joinpath("data.bin")
+            with artifact_path.open("wb") as f:
+                np.save(f, np.arange(3))
+            tracker.log_artifact(run_id, str(artifact_path))
+        # 例外で終わったRunはFINISHEDにならないので検索されない
+        with pytest.raises(RuntimeError):
+            with tracker.start_run(exp_id) as failed_run_id:
+                tracker.log_params(failed_run_id, {"x": 1, "y": "b"})
+                raise RuntimeError
+
+        df_result = tracker.search_runs(exp_id, {"x": 1})
+        assert list(df_result["run_id"]) == [run_id]
+        assert df_result["params.y"].iloc[0] == "b"
+        assert df_result["metrics.m"].iloc[0] == 3.
+        assert df_result["tags.kind"].iloc[0] == "a"
+        assert df_result["tags.done"].iloc[0] == "True"
+        assert len(tracker.search_runs(exp_id, {"x": 2})) == 0
+
+        assert [(m.step, m.value) for m in tracker.get_metric_history(run_id, "m")] == \
+            [(0, 1.), (2, 3.), (1, 2.)]
+        assert tracker.get_latest_metrics(run_id) == {"m": 3.}
+        with tracker.open_artifact(run_id, "data.bin") as f:
+            assert np.array_equal(np.load(f), np.arange(3))
+        with pytest.raises(FileNotFoundError):
+            with tracker.open_artifact(run_id, "missing.bin"):
+                pass
+
+    def test_search_with_defaults(self, tracker):
+        exp_id = tracker.get_experiment_id("test")
+        run_ids = {}
+        for name, params in [
+            ("old", {"x": 1}), ("new", {"x": 1, "z": 0}), ("other", {"x": 1, "z": 5}),
+        ]:
+            with tracker.start_run(exp_id) as run_id:
+                tracker.log_params(run_id, params)
+            run_ids[name] = run_id
+
+        # 記録されていないパラメータはデフォルト値と一致したとみなす
+        df_result = tracker.search_runs(exp_id, {"x": 1}, defaults={"z": 0})
+        assert set(df_result["run_id"]) == {run_ids["new"], run_ids["old"]}
+        df_result = tracker.search_runs(exp_id, {"x": 1}, max_results=1, defaults={"z": 0})
+        assert len(df_result) == 1
+        assert df_result["run_id"].iloc[0] in {run_ids["new"], run_ids["old"]}
+        assert len(tracker.search_runs(exp_id, {"x": 2}, defaults={"z": 0})) == 0
+
+    def test_log_array(self, tracker):
+        exp_id = tracker.get_experiment_id("test")
+        with tracker.start_run(exp_id) as run_id:
+            tracker.log_array(run_id, "data.bin", np.arange(5, dtype=np.float32))
+        with tracker.open_artifact(run_id, "data.bin") as f:
+            array = np.load(f)
+        assert array.dtype == np.float32
+        assert np.array_equal(array, np.arange(5))
+
+    def test_abstract(self):
+        with pytest.raises(TypeError):
+            Tracker()
+
+    def test_log_metric_history(self, tracker):
+        exp_id = tracker.get_experiment_id("test")
+        with tracker.start_run(exp_id) as run_id1:
+            for step in range(2500):
+                tracker.log_metrics(run_id1, {"m": step}, step=step)
+        with tracker.start_run(exp_id) as run_id2:
+            tracker.log_metric_history(run_id2, tracker.get_metric_history(run_id1, "m"))
+        assert [m.step for m in tracker.get_metric_history(run_id2, "m")] == list(range(2500))
+
+
+class TestSimulatorTracker:
+    def test_in_memory_previous_run(self):
+        tracker = InMemoryTracker()
+        sim1 = Simulator("test", get_param(), tracker=tracker)
+        sim1.run()
+        sim2 = Simulator("test", get_param(), tracker=tracker)
+        assert sim2.done
+        assert sim2.run_id == sim1.run_id
+        assert np.array_equal(sim2.get_state_trajectory(), sim1.get_state_trajectory())
+        assert sim2.get_metric_history() == sim1.get_metric_history()
+        # 別のインスタンスとは共有されない
+        assert not Simulator("test", get_param(), tracker=InMemoryTracker()).done
+
+    def test_in_memory_matches_mlflow(self, tmp_dir):
+        sim_mlflow = Simulator("test", get_param(), cache_dir=str(tmp_dir.joinpath("mlruns")))
+        sim_mlflow.run()
+        sim_memory = Simulator("test", get_param(), tracker=InMemoryTracker())
+        sim_memory.run()
+        assert [(m.step, m.value) for m in sim_mlflow.get_metric_history()] == \
+            [(m.step, m.value) for m in sim_memory.get_metric_history()]
+
+    def test_in_memory_extend(self):
+        tracker = InMemoryTracker()
+        Simulator("test", get_param(300), tracker=tracker).run()
+        sim_long = Simulator("test", get_param(1000), tracker=tracker, extend_previous_runs=True)
+        assert sim_long.base_result is not None
+        sim_long.run()
+        sim_fresh = Simulator("test_fresh", get_param(1000), tracker=tracker)
+        sim_fresh.run()
+        assert np.array_equal(sim_long.get_state_trajectory(), sim_fresh.get_state_trajectory())
+        assert [(m.step, m.value) for m in sim_long.get_metric_history()] == \
+            [(m.step, m.value) for m in sim_fresh.get_metric_history()]
+
+    def test_no_op(self, tmp_dir, monkeypatch):
+        def fail(*args, **kwargs):
+            raise AssertionError("should not serialize")
+
+        # 記録しないので状態軌跡をシリアライズしない
+        monkeypatch.setattr(np, "save", fail)
+        sim1 = Simulator("test", get_param(), tracker=NoOpTracker())
+        sim1.run()
+        monkeypatch.undo()
+        assert sim1.done
+        # 実行した結果はSimulatorの中には残る
+        assert sim1.get_state_trajectory().shape == (101, )
+        assert sim1.get_metric_history() == []
+        # 記録されないので毎回計算し直す
+        assert not Simulator("test", get_param(), tracker=NoOpTracker()).done
+        assert list(tmp_dir.iterdir()) == []
+
+    def test_artifact_cache_with_tracker_fail(self, tmp_dir):
+        with pytest.raises(ValueError):
+            Simulator(
+                "test", get_param(),
+                tracker=InMemoryTracker(),
+                artifact_cache=ArtifactCache(str(tmp_dir.joinpath("artifact_cache"))),
+            )
@@ -0,0 +1,153 @@
+import multiprocessing
+import os
+import time
+
+import mlflow
+from lib4.brownian_motion import ParamBrownianMotion
+from lib4.simulator import ParamSimulator, Simulator
+from lib4.tracker import MlflowTracker
+from lib4.work_queue import LeaseQueue, LeaseRenewer, get_param_key, run_sweep_worker
+
+
+def get_params():
+    return [
+        ParamSimulator(
+            total_step=200,
+            record_per=10,
+            save_full_traj=False,
+            param_bm=ParamBrownianMotion(seed=seed, initial_state=x0, sigma=1.),
+        )
+        for seed in range(3)
+        for x0 in [1., -1.]
+    ]
+
+
+def run_worker(cache_dir: str, worker_id: str) -> int:
+    return run_sweep_worker(
+        "test", get_params(), cache_dir=cache_dir,
+        lease_seconds=5., poll_seconds=0.1, worker_id=worker_id,
+        report_exp_name="test_sweeps", report_tracker=MlflowTracker(cache_dir),
+    )
+
+
+class TestLeaseQueue:
+    def test_param_key(self):
+        params = get_params()
+        assert get_param_key(params[0]) == get_param_key(get_params()[0])
+        assert len(set(get_param_key(param) for param in params)) == len(params)
+
+    def test_claim(self, tmp_dir):
+        queue1 = LeaseQueue(str(tmp_dir), worker_id="worker1")
+        queue2 = LeaseQueue(str(tmp_dir), worker_id="worker2")
+        assert queue1.claim("a")
+        assert queue1.is_leased("a")
+        assert not queue2.claim("a")
+        assert queue2.claim("b")
+
+        # 解放すれば他のワーカーが取得できる
+        queue1.release("a")
+        assert queue2.claim("a")
+        queue2.complete("a")
+        assert queue2.is_done("a")
+        assert not queue1.claim("a")
+
+    def test_expired_lease(self, tmp_dir):
+        queue1 = LeaseQueue(str(tmp_dir), lease_seconds=0.2, worker_id="worker1")
+        queue2 = LeaseQueue(str(tmp_dir), lease_seconds=0.2, worker_id="worker2")
+        assert queue1.claim("a")
+        time.sleep(0.3)
+        assert not queue1.is_leased("a")
+        # 更新されなかったリースは他のワーカーが取得できる
+        assert queue2.claim("a")
+        assert queue2.owns("a")
+        assert not queue1.owns("a")
+        assert not queue1.renew("a")
+        # 元の持ち主が解放しても新しいリースは消えない
+        queue1.release("a")
+        assert queue2.owns("a")
+
+    def test_renewer(self, tmp_dir):
+        queue1 = LeaseQueue(str(tmp_dir), lease_seconds=0.3, worker_id="worker1")
+        queue2 = LeaseQueue(str(tmp_dir), lease_seconds=0.3, worker_id="worker2")
+        assert queue1.claim("a")
+        with LeaseRenewer(queue1, "a") as renewer:
+            time.sleep(0.8)
+            assert not queue2.claim("a")
+        assert not renewer.lost
+
+
+class TestRunSweepWorker:
+    def test_single_worker(self, tmp_dir):
+        cache_dir = str(tmp_dir.joinpath("mlruns"))
+        assert run_worker(cache_dir, "worker") == len(get_params())
+        # 2回目は全て終わっている
+        assert run_worker(cache_dir, "worker") == 0
+
+    def test_expired_lease_is_requeued(self, tmp_dir):
+        cache_dir = str(tmp_dir.joinpath("mlruns"))
+        # 落ちたワーカーが残したリース
+        queue_dir = tmp_dir.joinpath("queue", "test")
+        queue_dir.mkdir(parents=True)
+        lease_path = queue_dir.joinpath(f"{get_param_key(get_params()[0])}.lease")
+        lease_path.write_text("crashed")
+        old = time.time() - 60
+        os.utime(lease_path, (old, old))
+
+        assert run_worker(cache_dir, "worker") == len(get_params())
+
+    def test_lost_lease_does_not_finish_run(self, tmp_dir, monkeypatch):
+        cache_dir = str(tmp_dir.joinpath("mlruns"))
+        params = get_params()[:1]
+        key = get_param_key(params[0])
+        lease_path = tmp_dir.joinpath("queue", "test", f"{key}.lease")
+        run = Simulator.run
+        stolen = []
+
+        def run_and_lose_lease(self, before_finish=None):
+            if not stolen:
+                # 計算中にリースの期限が切れて他のワーカーに奪われた
+                lease_path.write_text("other-worker")
+                stolen.append(key)
+            run(self, before_finish=before_finish)
+
+        monkeypatch.setattr(Simulator, "run", run_and_lose_lease)
+        # 奪ったワーカーが落ちたのでリースが期限切れになってから計算し直す
+        n_run = run_sweep_worker(
+            "test", params, cache_dir=cache_dir,
+            lease_seconds=0.5, poll_seconds=0.1, worker_id="worker",
+        )
+        assert n_run == 1
+
+        client = mlflow.tracking.MlflowClient(tracking_uri=cache_dir)
+        exp = client.get_experiment_by_name("test")
+        runs = client.search_runs([exp.experiment_id])
+        assert sorted(run.info.status for run in runs) == ["FAILED", "FINISHED"]
+
+    def test_multiprocess(self, tmp_dir):
+        """
+        複数のワーカーを同時に動かしても各パラメータはちょうど1回だけ計算される
+        """
+        cache_dir = str(tmp_dir.joinpath("mlruns"))
+        n_workers = 4
+        with multiprocessing.Pool(n_workers) as pool:
+            n_runs = pool.starmap(
+                run_worker, [(cache_dir, f"worker{i}") for i in range(n_workers)])
+        params = get_params()
+        assert sum(n_runs) == len(params)
+
+        client = mlflow.tracking.MlflowClient(tracking_uri=cache_dir)
+        exp = client.get_experiment_by_name("test")
+        runs = client.search_runs([exp.experiment_id])
+        assert len(runs) == len(params)
+        seeds_x0s = sorted(
+            (run.data.params["param_bm.seed"], run.data.params["param_bm.initial_state"])
+            for run in runs
+        )
+        assert seeds_x0s == sorted(
+            (str(param.param_bm.seed), str(param.param_bm.initial_state)) for param in params)
+
+        # スイープの集計はどれか1つのワーカーだけが記録する
+        report_exp = client.get_experiment_by_name("test_sweeps")
+        report_runs = client.search_runs([report_exp.experiment_id])
+        assert len(report_runs) == 1
+        assert report_runs[0].data.metrics["n_finished"] == len(params)